@@ -16,10 +16,10 @@ from flask_socketio import SocketIO
 from PIL import Image, ImageOps
 from PIL.Image import Image as ImageType
 from uuid import uuid4
-from threading import Event
 
 from ldm.invoke.args import Args, APP_ID, APP_VERSION, calculate_init_img_hash
 from ldm.invoke.pngwriter import PngWriter, retrieve_metadata
+from ldm.invoke.output_pipeline import OutputPipeline
 from ldm.invoke.prompt_parser import split_weighted_subprompts
 from ldm.invoke.generator.inpaint import infill_methods
 
@@ -27,6 +27,13 @@ from backend.modules.parameters import parameters_to_command
 from backend.modules.get_canvas_generation_mode import (
     get_canvas_generation_mode,
 )
+from backend.modules.progress_preview import ProgressPreviewer
+from backend.modules.generation_scheduler import (
+    GenerationScheduler,
+    GenerationJob,
+    ModelChangeJob,
+    CanceledException,
+)
 
 # Loading Arguments
 opt = Args()
@@ -48,7 +55,9 @@ class InvokeAIWebServer:
         self.codeformer = codeformer
         self.esrgan = esrgan
 
-        self.canceled = Event()
+        self.scheduler = None
+        self.output_pipeline = None
+        self.previewer = None
         self.ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
 
     def allowed_file(self, filename: str) -> bool:
@@ -88,6 +97,18 @@ class InvokeAIWebServer:
 
         self.socketio = SocketIO(self.app, **socketio_args)
 
+        self.output_pipeline = OutputPipeline(args.output_workers)
+        self.scheduler = GenerationScheduler(
+            self.generate,
+            self.socketio,
+            window=args.web_batch_window,
+            max_batch_size=args.web_max_batch_size,
+            output_pipeline=self.output_pipeline,
+        )
+        self.previewer = ProgressPreviewer(
+            self.generate, self.socketio, max_fps=args.web_preview_fps
+        )
+
         # Keep Server Alive Route
         @self.app.route("/flaskwebgui-keep-server-alive")
         def keep_alive():
@@ -298,18 +319,25 @@ class InvokeAIWebServer:
         def handle_set_model(model_name: str):
             try:
                 print(f">> Model change requested: {model_name}")
-                model = self.generate.set_model(model_name)
-                model_list = self.generate.model_cache.list_models()
-                if model is None:
-                    socketio.emit(
-                        "modelChangeFailed",
-                        {"model_name": model_name, "model_list": model_list},
-                    )
-                else:
-                    socketio.emit(
-                        "modelChanged",
-                        {"model_name": model_name, "model_list": model_list},
-                    )
+
+                def model_changed(model):
+                    model_list = self.generate.model_cache.list_models()
+                    if model is None:
+                        socketio.emit(
+                            "modelChangeFailed",
+                            {"model_name": model_name, "model_list": model_list},
+                        )
+                    else:
+                        socketio.emit(
+                            "modelChanged",
+                            {"model_name": model_name, "model_list": model_list},
+                        )
+
+                # the model loads in the background and is swapped in
+                # once the requests queued before this one are done
+                self.scheduler.change_model(
+                    ModelChangeJob(request.sid, model_name, model_changed)
+                )
             except Exception as e:
                 self.socketio.emit("error", {"message": (str(e))})
                 print("\n")
@@ -557,6 +585,7 @@ class InvokeAIWebServer:
                     generation_parameters,
                     esrgan_parameters,
                     facetool_parameters,
+                    sid=request.sid,
                 )
             except Exception as e:
                 self.socketio.emit("error", {"message": (str(e))})
@@ -683,7 +712,11 @@ class InvokeAIWebServer:
         @socketio.on("cancel")
         def handle_cancel():
             print(f">> Cancel processing requested")
-            self.canceled.set()
+            self.scheduler.cancel(request.sid)
+
+        @socketio.on("disconnect")
+        def handle_disconnect():
+            self.previewer.forget(request.sid)
 
         # TODO: I think this needs a safety mechanism.
         @socketio.on("deleteImage")
@@ -727,11 +760,9 @@ class InvokeAIWebServer:
         }
 
     def generate_images(
-        self, generation_parameters, esrgan_parameters, facetool_parameters
+        self, generation_parameters, esrgan_parameters, facetool_parameters, sid=None
     ):
         try:
-            self.canceled.clear()
-
             step_index = 1
             prior_variations = (
                 generation_parameters["with_variations"]
@@ -744,7 +775,7 @@ class InvokeAIWebServer:
 
             progress = Progress(generation_parameters=generation_parameters)
 
-            self.socketio.emit("progressUpdate", progress.to_formatted_dict())
+            self.socketio.emit("progressUpdate", progress.to_formatted_dict(), to=sid)
             eventlet.sleep(0)
 
             """
@@ -849,7 +880,7 @@ class InvokeAIWebServer:
                 generation_parameters["init_img"] = Image.open(init_img_path).convert('RGB')
 
             def image_progress(sample, step):
-                if self.canceled.is_set():
+                if job.canceled.is_set():
                     raise CanceledException
 
                 nonlocal step_index
@@ -873,6 +904,7 @@ class InvokeAIWebServer:
                     generation_parameters["progress_images"]
                     and step % generation_parameters["save_intermediates"] == 0
                     and step < generation_parameters["steps"] - 1
+                    and self.previewer.is_listening(sid)
                 ):
                     image = self.generate.sample_to_image(sample)
                     metadata = self.parameters_to_generated_image_metadata(
@@ -903,37 +935,25 @@ class InvokeAIWebServer:
                             "generationMode": generation_parameters["generation_mode"],
                             "boundingBox": original_bounding_box,
                         },
+                        to=sid,
                     )
 
-                if generation_parameters["progress_latents"]:
-                    image = self.generate.sample_to_lowres_estimated_image(sample)
-                    (width, height) = image.size
-                    width *= 8
-                    height *= 8
-                    buffered = io.BytesIO()
-                    image.save(buffered, format="PNG")
-                    img_base64 = "data:image/png;base64," + base64.b64encode(
-                        buffered.getvalue()
-                    ).decode("UTF-8")
-                    self.socketio.emit(
-                        "intermediateResult",
-                        {
-                            "url": img_base64,
-                            "isBase64": True,
-                            "mtime": 0,
-                            "metadata": {},
-                            "width": width,
-                            "height": height,
-                            "generationMode": generation_parameters["generation_mode"],
-                            "boundingBox": original_bounding_box,
-                        },
-                    )
+                # rate limited, and skipped if the client has gone away
+                self.previewer.send(
+                    sid,
+                    sample,
+                    generation_parameters,
+                    {
+                        "generationMode": generation_parameters["generation_mode"],
+                        "boundingBox": original_bounding_box,
+                    },
+                )
 
-                self.socketio.emit("progressUpdate", progress.to_formatted_dict())
+                self.socketio.emit("progressUpdate", progress.to_formatted_dict(), to=sid)
                 eventlet.sleep(0)
 
             def image_done(image, seed, first_seed):
-                if self.canceled.is_set():
+                if job.canceled.is_set():
                     raise CanceledException
 
                 nonlocal generation_parameters
@@ -957,7 +977,7 @@ class InvokeAIWebServer:
 
                 progress.set_current_status("Generation Complete")
 
-                self.socketio.emit("progressUpdate", progress.to_formatted_dict())
+                self.socketio.emit("progressUpdate", progress.to_formatted_dict(), to=sid)
                 eventlet.sleep(0)
 
                 all_parameters = generation_parameters
@@ -978,13 +998,13 @@ class InvokeAIWebServer:
                 else:
                     all_parameters["seed"] = seed
 
-                if self.canceled.is_set():
+                if job.canceled.is_set():
                     raise CanceledException
 
                 if esrgan_parameters:
                     progress.set_current_status("Upscaling")
                     progress.set_current_status_has_steps(False)
-                    self.socketio.emit("progressUpdate", progress.to_formatted_dict())
+                    self.socketio.emit("progressUpdate", progress.to_formatted_dict(), to=sid)
                     eventlet.sleep(0)
 
                     image = self.esrgan.process(
@@ -1000,7 +1020,7 @@ class InvokeAIWebServer:
                         esrgan_parameters["strength"],
                     ]
 
-                if self.canceled.is_set():
+                if job.canceled.is_set():
                     raise CanceledException
 
                 if facetool_parameters:
@@ -1010,7 +1030,7 @@ class InvokeAIWebServer:
                         progress.set_current_status("Restoring Faces (Codeformer)")
 
                     progress.set_current_status_has_steps(False)
-                    self.socketio.emit("progressUpdate", progress.to_formatted_dict())
+                    self.socketio.emit("progressUpdate", progress.to_formatted_dict(), to=sid)
                     eventlet.sleep(0)
 
                     if facetool_parameters["type"] == "gfpgan":
@@ -1040,7 +1060,7 @@ class InvokeAIWebServer:
                     all_parameters["facetool_type"] = facetool_parameters["type"]
 
                 progress.set_current_status("Saving Image")
-                self.socketio.emit("progressUpdate", progress.to_formatted_dict())
+                self.socketio.emit("progressUpdate", progress.to_formatted_dict(), to=sid)
                 eventlet.sleep(0)
 
                 # restore the stashed URLS and discard the paths, we are about to send the result to client
@@ -1069,21 +1089,39 @@ class InvokeAIWebServer:
                     else self.temp_image_path
                 )
 
-                path = self.save_result_image(
+                generation_mode = generation_parameters["generation_mode"]
+
+                def image_saved(path, thumbnail_path):
+                    print(f'>> Image generated: "{path}"')
+                    self.write_log_message(f'[Generated] "{path}": {command}')
+
+                    self.socketio.emit(
+                        "generationResult",
+                        {
+                            "url": self.get_url_from_image_path(path),
+                            "thumbnail": self.get_url_from_image_path(thumbnail_path),
+                            "mtime": os.path.getmtime(path),
+                            "metadata": metadata,
+                            "dreamPrompt": command,
+                            "width": width,
+                            "height": height,
+                            "boundingBox": original_bounding_box,
+                            "generationMode": generation_mode,
+                        },
+                        to=sid,
+                    )
+                    eventlet.sleep(0)
+
+                # the image is written in the background while sampling goes on
+                self.save_result_image(
                     image,
                     command,
                     metadata,
                     generated_image_outdir,
                     postprocessing=postprocessing,
+                    callback=image_saved,
                 )
 
-                thumbnail_path = save_thumbnail(
-                    image, os.path.basename(path), self.thumbnail_image_path
-                )
-
-                print(f'>> Image generated: "{path}"')
-                self.write_log_message(f'[Generated] "{path}": {command}')
-
                 if progress.total_iterations > progress.current_iteration:
                     progress.set_current_step(1)
                     progress.set_current_status("Iteration complete")
@@ -1091,44 +1129,32 @@ class InvokeAIWebServer:
                 else:
                     progress.mark_complete()
 
-                self.socketio.emit("progressUpdate", progress.to_formatted_dict())
-                eventlet.sleep(0)
-
-                self.socketio.emit(
-                    "generationResult",
-                    {
-                        "url": self.get_url_from_image_path(path),
-                        "thumbnail": self.get_url_from_image_path(thumbnail_path),
-                        "mtime": os.path.getmtime(path),
-                        "metadata": metadata,
-                        "dreamPrompt": command,
-                        "width": width,
-                        "height": height,
-                        "boundingBox": original_bounding_box,
-                        "generationMode": generation_parameters["generation_mode"],
-                    },
-                )
+                self.socketio.emit("progressUpdate", progress.to_formatted_dict(), to=sid)
                 eventlet.sleep(0)
 
                 progress.set_current_iteration(progress.current_iteration + 1)
 
             print(generation_parameters)
 
-            self.generate.prompt2image(
-                **generation_parameters,
+            # the scheduler runs the job, possibly batched together with
+            # compatible requests from other clients
+            job = GenerationJob(
+                sid,
+                generation_parameters,
                 step_callback=image_progress,
                 image_callback=image_done,
             )
+            self.scheduler.submit(job)
 
         except KeyboardInterrupt:
-            self.socketio.emit("processingCanceled")
+            self.socketio.emit("processingCanceled", to=sid)
             raise
         except CanceledException:
-            self.socketio.emit("processingCanceled")
+            self.socketio.emit("processingCanceled", to=sid)
             pass
         except Exception as e:
             print(e)
-            self.socketio.emit("error", {"message": (str(e))})
+            self.socketio.emit("error", {"message": (str(e))}, to=sid)
             print("\n")
 
             traceback.print_exc()
@@ -1302,11 +1328,19 @@ class InvokeAIWebServer:
         output_dir,
         step_index=None,
         postprocessing=False,
+        callback=None,
     ):
+        """
+        Saves the image and returns its path. If a callback is given, the image and
+        its thumbnail are written in the background and callback(path, thumbnail_path)
+        is called once they are on disk.
+        """
         try:
             pngwriter = PngWriter(output_dir)
 
-            number_prefix = pngwriter.unique_prefix()
+            number_prefix = pngwriter.unique_prefix(
+                pending=self.output_pipeline.pending_keys()
+            )
 
             uuid = uuid4().hex
             truncated_uuid = uuid[:8]
@@ -1326,6 +1360,28 @@ class InvokeAIWebServer:
 
             filename += ".png"
 
+            if callback is not None:
+                path = os.path.abspath(os.path.join(output_dir, filename))
+
+                def write_image():
+                    pngwriter.save_image_and_prompt_to_png(
+                        image=image,
+                        dream_prompt=command,
+                        metadata=metadata,
+                        name=filename,
+                    )
+                    return save_thumbnail(
+                        image, filename, self.thumbnail_image_path
+                    )
+
+                self.output_pipeline.submit(
+                    write_image,
+                    callback=lambda thumbnail_path: callback(path, thumbnail_path),
+                    error_callback=lambda e: self.socketio.emit("error", {"message": (str(e))}),
+                    key=path,
+                )
+                return path
+
             path = pngwriter.save_image_and_prompt_to_png(
                 image=image,
                 dream_prompt=command,
@@ -1527,10 +1583,6 @@ class Progress:
         return math.floor(strength * steps) if has_init_image else steps
 
 
-class CanceledException(Exception):
-    pass
-
-
 """
 Returns a copy an image, cropped to a bounding box.
 """
@@ -0,0 +1,259 @@
+"""
+Queues image generation requests from web clients and runs them one after
+another. Requests that arrive within a short window of each other and that
+only differ in their prompt, seed and iteration count are merged into a
+single batched diffusion run. Results, progress and cancellation are routed
+back to the client that made each request.
+
+Model changes are queued in line with the requests. The model is loaded in
+the background as soon as the change is queued, while earlier requests are
+still running on the current model, and is swapped in once they are done.
+"""
+import traceback
+from threading import Event
+
+# settings that must agree for two requests to share a diffusion run
+BATCH_KEY_PARAMETERS = (
+    "sampler_name",
+    "steps",
+    "width",
+    "height",
+    "cfg_scale",
+    "ddim_eta",
+    "threshold",
+    "perlin",
+    "seamless",
+    "seamless_axes",
+    "karras_max",
+    "use_mps_noise",
+)
+
+
+class CanceledException(Exception):
+    pass
+
+
+class GenerationJob:
+    def __init__(self, sid, parameters, step_callback, image_callback) -> None:
+        self.sid = sid
+        self.parameters = parameters
+        self.step_callback = step_callback
+        self.image_callback = image_callback
+        self.canceled = Event()
+        self.reported_canceled = False
+
+    def batch_key(self):
+        """
+        Returns a key shared by all jobs that can be sampled together,
+        or None if this job has to run on its own.
+        """
+        p = self.parameters
+        if (
+            p.get("init_img")
+            or p.get("init_mask")
+            or p.get("hires_fix")
+            or p.get("tiled_diffusion")
+            or p.get("variation_amount")
+            or p.get("with_variations")
+        ):
+            return None
+        return tuple(str(p.get(k)) for k in BATCH_KEY_PARAMETERS)
+
+    def iterations(self):
+        return self.parameters.get("iterations") or 1
+
+
+class ModelChangeJob:
+    def __init__(self, sid, model_name, callback) -> None:
+        self.sid = sid
+        self.model_name = model_name
+        self.callback = callback  # called with the new model, or None if it could not be loaded
+
+
+class GenerationScheduler:
+    def __init__(
+        self, generate, socketio, window=0.0, max_batch_size=4, output_pipeline=None
+    ) -> None:
+        self.generate = generate
+        self.socketio = socketio
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.output_pipeline = output_pipeline
+        self.queue = []
+        self.running = []
+        self.worker = None
+
+    def submit(self, job: GenerationJob):
+        self.queue.append(job)
+        if self.worker is None:
+            self.worker = self.socketio.start_background_task(self.run)
+
+    def change_model(self, job: ModelChangeJob):
+        """
+        Queues a switch to another model, which starts loading right away.
+        """
+        self.generate.prefetch_model(job.model_name)
+        self.submit(job)
+
+    def cancel(self, sid):
+        for job in self.queue + self.running:
+            if job.sid == sid and isinstance(job, GenerationJob):
+                job.canceled.set()
+
+    def run(self):
+        try:
+            while len(self.queue) > 0:
+                if isinstance(self.queue[0], ModelChangeJob):
+                    self.switch_model(self.queue.pop(0))
+                    continue
+                # give other requests a moment to arrive so they can join this run
+                if self.window > 0:
+                    self.socketio.sleep(self.window)
+                self.running = self.next_batch()
+                if len(self.running) > 0:
+                    self.process(self.running)
+                    # deliver the results of images still being written
+                    if self.output_pipeline is not None:
+                        self.output_pipeline.flush()
+                self.running = []
+        finally:
+            self.running = []
+            self.worker = None
+
+    def next_batch(self) -> list:
+        """
+        Takes the oldest job off the queue, together with any later jobs
+        that can be merged with it, up to max_batch_size images in total.
+        """
+        batch = []
+        while len(self.queue) > 0 and len(batch) == 0:
+            if isinstance(self.queue[0], ModelChangeJob):
+                return batch
+            job = self.queue.pop(0)
+            if job.canceled.is_set():
+                self.report_canceled(job)
+            else:
+                batch.append(job)
+        if len(batch) == 0:
+            return batch
+
+        key = batch[0].batch_key()
+        if key is None:
+            return batch
+
+        image_count = batch[0].iterations()
+        for job in list(self.queue):
+            if isinstance(job, ModelChangeJob):
+                break  # later jobs run on another model
+            if job.canceled.is_set() or job.batch_key() != key:
+                continue
+            if image_count + job.iterations() > self.max_batch_size:
+                continue
+            self.queue.remove(job)
+            batch.append(job)
+            image_count += job.iterations()
+        return batch
+
+    def switch_model(self, job: ModelChangeJob):
+        """
+        Waits, without holding up other clients, for the background load of
+        the job's model and then makes it the current one.
+        """
+        future = self.generate.prefetch_model(job.model_name)
+        while future is not None and not future.done():
+            self.socketio.sleep(0.1)
+        try:
+            model = self.generate.set_model(job.model_name)
+        except Exception as e:
+            self.report_error([job], e)
+            model = None
+        job.callback(model)
+
+    def process(self, jobs: list):
+        if len(jobs) > 1:
+            print(f">> Sampling {len(jobs)} compatible requests as one batch")
+            try:
+                results = self.generate.prompts2images(
+                    [
+                        {**job.parameters, "image_callback": self.image_callback(job)}
+                        for job in jobs
+                    ],
+                    step_callback=self.step_callback(jobs),
+                )
+                if results is not None:
+                    return
+            except KeyboardInterrupt:
+                for job in jobs:
+                    self.report_canceled(job)
+                raise
+            except CanceledException:
+                return
+            except Exception as e:
+                self.report_error(jobs, e)
+                return
+
+        for job in jobs:
+            try:
+                self.generate.prompt2image(
+                    **job.parameters,
+                    step_callback=job.step_callback,
+                    image_callback=job.image_callback,
+                )
+            except KeyboardInterrupt:
+                self.report_canceled(job)
+                raise
+            except CanceledException:
+                self.report_canceled(job)
+            except Exception as e:
+                self.report_error([job], e)
+
+    def step_callback(self, jobs: list):
+        """
+        Hands each job the rows of the batch that belong to it. A canceled
+        job is dropped from the run; the run stops once every job is canceled.
+        """
+        slices = []
+        start = 0
+        for job in jobs:
+            slices.append((job, start, start + job.iterations()))
+            start += job.iterations()
+
+        def callback(sample, step):
+            for job, start, end in slices:
+                if not job.canceled.is_set():
+                    try:
+                        job.step_callback(sample[start:end], step)
+                        continue
+                    except CanceledException:
+                        job.canceled.set()
+                self.report_canceled(job)
+            if all(job.canceled.is_set() for job in jobs):
+                raise CanceledException
+
+        return callback
+
+    def image_callback(self, job: GenerationJob):
+        def callback(image, seed, first_seed=None):
+            if job.canceled.is_set():
+                return
+            try:
+                job.image_callback(image, seed, first_seed=first_seed)
+            except CanceledException:
+                job.canceled.set()
+                self.report_canceled(job)
+
+        return callback
+
+    def report_canceled(self, job: GenerationJob):
+        if not job.reported_canceled:
+            job.reported_canceled = True
+            self.socketio.emit("processingCanceled", to=job.sid)
+
+    def report_error(self, jobs: list, e: Exception):
+        print(e)
+        for job in jobs:
+            self.socketio.emit("error", {"message": (str(e))}, to=job.sid)
+        print("\n")
+
+        traceback.print_exc()
+        print("\n")
@@ -0,0 +1,110 @@
+"""
+Makes the in-progress previews sent to web clients while an image samples.
+Previews are rate limited per client, encoded as small WebP or JPEG frames
+and skipped entirely when the client is no longer connected.
+
+A client picks its preview decoder with the "progress_preview" parameter:
+
+    linear            the latents mapped to RGB, at latent resolution (cheap)
+    linear_upscaled   the same, upsampled to the output size
+    vae               a full VAE decode (expensive)
+
+Clients that set "progress_preview_binary" receive the encoded frame as a
+binary "image" field; other clients receive a data URL in "url".
+"""
+import base64
+import io
+import time
+
+from PIL import Image
+
+PREVIEW_MODES = ("linear", "linear_upscaled", "vae")
+PREVIEW_FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+
+
+class ProgressPreviewer:
+    def __init__(self, generate, socketio, max_fps=4.0, format="webp", quality=70) -> None:
+        self.generate = generate
+        self.socketio = socketio
+        self.min_interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.format = format
+        self.quality = quality
+        self.last_sent = {}  # sid -> time of the last preview
+
+    @classmethod
+    def preview_mode(cls, parameters):
+        """
+        Returns the preview decoder the client asked for, or None for no previews.
+        """
+        mode = parameters.get("progress_preview")
+        if mode in PREVIEW_MODES:
+            return mode
+        if parameters.get("progress_latents"):
+            return "linear"
+        return None
+
+    def is_listening(self, sid) -> bool:
+        if sid is None:
+            return True
+        try:
+            return self.socketio.server.manager.is_connected(sid, "/")
+        except Exception:
+            return True
+
+    def ready(self, sid) -> bool:
+        """
+        True if a preview is due for this client: it is still connected and the
+        last preview it got is older than the rate limit allows.
+        """
+        if not self.is_listening(sid):
+            return False
+        return time.monotonic() - self.last_sent.get(sid, 0.0) >= self.min_interval
+
+    def send(self, sid, sample, parameters, fields):
+        """
+        Decodes the sample with the client's preview decoder and emits it as an
+        "intermediateResult", merged with the given fields. Does nothing if no
+        preview is wanted or due.
+        """
+        mode = self.preview_mode(parameters)
+        if mode is None or not self.ready(sid):
+            return
+        self.last_sent[sid] = time.monotonic()
+
+        image = self.decode(sample, mode)
+        height, width = sample.shape[-2] * 8, sample.shape[-1] * 8
+
+        buffered = io.BytesIO()
+        image.save(buffered, format=self.format.upper(), quality=self.quality)
+        mime_type = PREVIEW_FORMATS[self.format]
+
+        binary = bool(parameters.get("progress_preview_binary"))
+        result = {
+            **fields,
+            "isBase64": not binary,
+            "mtime": 0,
+            "metadata": {},
+            "width": width,
+            "height": height,
+            "mimeType": mime_type,
+        }
+        if binary:
+            result["image"] = buffered.getvalue()
+        else:
+            result["url"] = f"data:{mime_type};base64," + base64.b64encode(
+                buffered.getvalue()
+            ).decode("UTF-8")
+        self.socketio.emit("intermediateResult", result, to=sid)
+
+    def decode(self, sample, mode) -> Image.Image:
+        if mode == "vae":
+            return self.generate.sample_to_image(sample)
+        image = self.generate.sample_to_lowres_estimated_image(sample)
+        if mode == "linear_upscaled":
+            image = image.resize(
+                (image.width * 8, image.height * 8), resample=Image.Resampling.BILINEAR
+            )
+        return image
+
+    def forget(self, sid):
+        self.last_sent.pop(sid, None)
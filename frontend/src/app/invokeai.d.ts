@@ -185,6 +185,8 @@ export declare type SystemConfigResponse = SystemConfig;
 export declare type ImageResultResponse = Omit<Image, 'uuid'> & {
   boundingBox?: IRect;
   generationMode: InvokeTabName;
+  image?: ArrayBuffer;
+  mimeType?: string;
 };
 
 export declare type ImageUploadResponse = {
@@ -50,6 +50,9 @@ const makeSocketIOListeners = (
 ) => {
   const { dispatch, getState } = store;
 
+  // object URL of the last binary progress preview, released when replaced
+  let previewObjectUrl: string | undefined;
+
   return {
     /**
      * Callback to run when we receive a 'connect' event.
@@ -164,6 +167,16 @@ const makeSocketIOListeners = (
      */
     onIntermediateResult: (data: InvokeAI.ImageResultResponse) => {
       try {
+        // previews may arrive as binary frames rather than data URLs
+        if (data.image) {
+          if (previewObjectUrl) URL.revokeObjectURL(previewObjectUrl);
+          previewObjectUrl = URL.createObjectURL(
+            new Blob([data.image], { type: data.mimeType })
+          );
+          const { image: _image, ...rest } = data;
+          // like a data URL, the object URL is an in-memory preview, not a saved file
+          data = { ...rest, url: previewObjectUrl, isBase64: true };
+        }
         dispatch(
           setIntermediateImage({
             uuid: uuidv4(),
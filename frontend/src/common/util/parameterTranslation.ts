@@ -86,6 +86,7 @@ export const frontendToBackendParameters = (
     seed,
     progress_images: shouldDisplayInProgressType === 'full-res',
     progress_latents: shouldDisplayInProgressType === 'latents',
+    progress_preview_binary: true,
     save_intermediates: saveIntermediatesInterval,
     generation_mode: generationMode,
     init_mask: '',
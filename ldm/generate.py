@@ -35,9 +35,11 @@ from ldm.invoke.pngwriter import PngWriter
 from ldm.invoke.args import metadata_from_png
 from ldm.invoke.image_util import InitImageResizer
 from ldm.invoke.devices import choose_torch_device, choose_precision
-from ldm.invoke.conditioning import get_uc_and_c_and_ec
+from ldm.invoke.conditioning import get_uc_and_c_and_ec, conditioning_cache
+from ldm.invoke.generator.latent_cache import init_latent_cache
 from ldm.invoke.model_cache import ModelCache
 from ldm.invoke.seamless import configure_model_padding
+from ldm.invoke.vae_tiling import configure_vae_tiling
 from ldm.invoke.txt2mask import Txt2Mask, SegmentedGrayscale
 from ldm.invoke.concepts_lib import Concepts
     
@@ -149,8 +151,16 @@ class Generate:
             codeformer=None,
             esrgan=None,
             free_gpu_mem=False,
+            vae_tiling_mb:int=0,
             safety_checker:bool=False,
             max_loaded_models:int=2,
+            max_cache_ram_mb:int=0,
+            max_cache_vram_mb:int=0,
+            converted_weights_dir:str=None,
+            conditioning_cache_size:int=32,
+            conditioning_cache_dir:str=None,
+            init_latent_cache_mb:int=64,
+            legacy_seeding:bool=False,
             # these are deprecated; if present they override values in the conf file
             weights = None,
             config = None,
@@ -183,6 +193,8 @@ class Generate:
         self.codeformer = codeformer
         self.esrgan = esrgan
         self.free_gpu_mem = free_gpu_mem
+        self.vae_tiling_mb = vae_tiling_mb
+        self.legacy_seeding = legacy_seeding
         self.max_loaded_models = max_loaded_models,
         self.size_matters = True  # used to warn once about large image sizes and VRAM
         self.txt2mask = None
@@ -204,8 +216,19 @@ class Generate:
         if self.precision == 'auto':
             self.precision = choose_precision(self.device)
 
+        # prompt conditioning is cached across requests
+        conditioning_cache.configure(max_entries=conditioning_cache_size,
+                                     cache_dir=conditioning_cache_dir)
+        # and so are the VAE encodings of init images
+        init_latent_cache.configure(max_bytes=init_latent_cache_mb * 1024 * 1024)
+
         # model caching system for fast switching
-        self.model_cache = ModelCache(mconfig,self.device,self.precision,max_loaded_models=max_loaded_models)
+        self.model_cache = ModelCache(mconfig,self.device,self.precision,
+                                      max_loaded_models=max_loaded_models,
+                                      max_ram_bytes=max_cache_ram_mb * 1024 * 1024 if max_cache_ram_mb else None,
+                                      max_vram_bytes=max_cache_vram_mb * 1024 * 1024 if max_cache_vram_mb else None,
+                                      converted_dir=converted_weights_dir,
+                                      )
         self.model_name  = model or self.model_cache.default_model() or FALLBACK_MODEL_NAME
 
         # for VRAM usage statistics
@@ -271,6 +294,7 @@ class Generate:
             # these are common
             prompt,
             iterations       = None,
+            batch_size       = 1,
             steps            = None,
             seed             = None,
             cfg_scale        = None,
@@ -314,11 +338,16 @@ class Generate:
             # This controls the size at which inpaint occurs (scaled up for inpaint, then back down for the result)
             inpaint_width    = None,
             inpaint_height   = None,
+            # Set this True to diffuse only the part of the image around the mask
+            inpaint_crop     = False,
+            inpaint_crop_padding: int = 64,
+            inpaint_crop_upscale = True,
             # This will help match inpainted areas to the original image more smoothly
             mask_blur_radius: int = 8,
             # Set this True to handle KeyboardInterrupt internally
             catch_interrupts = False,
             hires_fix        = False,
+            tiled_diffusion  = False,
             use_mps_noise    = False,
             # Seam settings for outpainting
             seam_size: int   = 0,
@@ -337,6 +366,7 @@ class Generate:
         It takes the following arguments:
            prompt                          // prompt string (no default)
            iterations                      // iterations (1); image count=iterations
+           batch_size                      // number of iterations to sample together in one batch (1)
            steps                           // refinement steps per iteration
            seed                            // seed for random number generator
            width                           // width of image, in multiples of 64 (512)
@@ -344,10 +374,13 @@ class Generate:
            cfg_scale                       // how strongly the prompt influences the image (7.5) (must be >1)
            seamless                        // whether the generated image should tile
            hires_fix                        // whether the Hires Fix should be applied during generation
+           tiled_diffusion                  // make large txt2img images by diffusing overlapping windows of the model's native size
            init_img                        // path to an initial image
            init_mask                       // path to a mask for the initial image
            text_mask                       // a text string that will be used to guide clipseg generation of the init_mask
            invert_mask                     // boolean, if true invert the mask
+           inpaint_crop                    // boolean, if true only the bounding box of the mask plus inpaint_crop_padding pixels of context is diffused,
+                                           //   scaled up to the model's native size unless inpaint_crop_upscale is False
            strength                        // strength for noising/unnoising init_img. 0.0 preserves image exactly, 1.0 replaces it completely
            facetool_strength               // strength for GFPGAN/CodeFormer. 0.0 preserves image exactly, 1.0 replaces it completely
            ddim_eta                        // image randomness (eta=0.0 means the same seed always produces the same image)
@@ -456,7 +489,8 @@ class Generate:
             uc, c, extra_conditioning_info = get_uc_and_c_and_ec(
                 prompt, model =self.model,
                 skip_normalize=skip_normalize,
-                log_tokens    =self.log_tokenization
+                log_tokens    =self.log_tokenization,
+                model_hash    =self.model_hash,
             )
 
             init_image, mask_image = self._make_images(
@@ -471,12 +505,13 @@ class Generate:
             )
 
             # TODO: Hacky selection of operation to perform. Needs to be refactored.
-            generator = self.select_generator(init_image, mask_image, embiggen, hires_fix, force_outpaint)
+            generator = self.select_generator(init_image, mask_image, embiggen, hires_fix, force_outpaint, tiled_diffusion)
 
             generator.set_variation(
                 self.seed, variation_amount, with_variations
             )
             generator.use_mps_noise = use_mps_noise
+            generator.legacy_seeding = self.legacy_seeding
 
             checker = {
                 'checker':self.safety_checker,
@@ -486,6 +521,7 @@ class Generate:
             results = generator.generate(
                 prompt,
                 iterations=iterations,
+                batch_size=batch_size,
                 seed=self.seed,
                 sampler=self.sampler,
                 steps=steps,
@@ -517,6 +553,9 @@ class Generate:
                 force_outpaint = force_outpaint,
                 inpaint_height = inpaint_height,
                 inpaint_width = inpaint_width,
+                inpaint_crop = inpaint_crop,
+                inpaint_crop_padding = inpaint_crop_padding,
+                inpaint_crop_upscale = inpaint_crop_upscale,
                 enable_image_debugging = enable_image_debugging,
             )
 
@@ -566,6 +605,94 @@ class Generate:
             )
         return results
 
+    def prompts2images(self, requests:list, step_callback=None):
+        """
+        Samples several txt2img requests together in a single batched diffusion run.
+        Each request is a dict of prompt2image() arguments with its own prompt, seed,
+        iterations, skip_normalize and image_callback; all other settings are taken
+        from the first request. The step_callback receives the latents for the whole
+        batch, with each request's images in consecutive rows in request order.
+
+        Returns one list of [image, seed] pairs per request, or None without doing
+        any work if the requests cannot be sampled together, in which case the
+        caller should run them through prompt2image() one by one.
+        """
+        first = requests[0]
+        if any(r.get('init_img') or r.get('hires_fix') or r.get('embiggen') or r.get('tiled_diffusion')
+               or r.get('variation_amount') or r.get('with_variations') for r in requests):
+            return None
+
+        steps     = first.get('steps') or self.steps
+        cfg_scale = first.get('cfg_scale') or self.cfg_scale
+        ddim_eta  = first.get('ddim_eta') or self.ddim_eta
+        threshold = first.get('threshold') or 0.0
+        perlin    = first.get('perlin') or 0.0
+        sampler_name = first.get('sampler_name')
+
+        model = self.set_model(self.model_name)
+        width, height, _ = self._resolution_check(first.get('width') or self.width,
+                                                  first.get('height') or self.height,
+                                                  log=True)
+        configure_model_padding(model,
+                                first.get('seamless') or self.seamless,
+                                first.get('seamless_axes') or self.seamless_axes)
+        assert cfg_scale > 1.0, 'CFG_Scale (-C) must be >1.0'
+
+        if sampler_name and (sampler_name != self.sampler_name):
+            self.sampler_name = sampler_name
+            self._set_sampler()
+
+        if first.get('karras_max') is not None and isinstance(self.sampler,KSampler):
+            self.sampler.adjust_settings(karras_max=first['karras_max'])
+
+        generator = self._make_txt2img()
+        generator.use_mps_noise = first.get('use_mps_noise', False)
+        generator.legacy_seeding = self.legacy_seeding
+
+        jobs = []
+        for request in requests:
+            prompt = self.concept_lib().replace_concepts_with_triggers(request['prompt'], lambda concepts: self.load_concepts(concepts))
+            conditioning = get_uc_and_c_and_ec(
+                prompt, model =self.model,
+                skip_normalize=request.get('skip_normalize', False),
+                log_tokens    =request.get('log_tokenization', False),
+                model_hash    =self.model_hash,
+            )
+            if not generator.can_batch(self.sampler, ddim_eta=ddim_eta, conditioning=conditioning):
+                return None
+            if len(jobs) > 0 and conditioning[1].shape != jobs[0][0][1].shape:
+                return None
+            jobs.append((conditioning,
+                         request.get('seed'),
+                         request.get('iterations') or self.iterations,
+                         request.get('image_callback')))
+
+        checker = {
+            'checker':self.safety_checker,
+            'extractor':self.safety_feature_extractor
+        } if self.safety_checker else None
+
+        tic = time.time()
+        results = generator.generate_merged(
+            jobs,
+            width=width,
+            height=height,
+            sampler=self.sampler,
+            steps=steps,
+            cfg_scale=cfg_scale,
+            ddim_eta=ddim_eta,
+            step_callback=step_callback,
+            threshold=threshold,
+            perlin=perlin,
+            safety_checker=checker,
+        )
+        toc = time.time()
+        print(
+            f'>>   {sum(len(r) for r in results)} image(s) for {len(requests)} requests generated in', '%4.2fs' % (
+                toc - tic)
+        )
+        return results
+
     # this needs to be generalized to all sorts of postprocessors, which should be wrapped
     # in a nice harmonized call signature. For now we have a bunch of if/elses!
     def apply_postprocessor(
@@ -608,7 +735,8 @@ class Generate:
         uc, c, extra_conditioning_info = get_uc_and_c_and_ec(
             prompt, model =self.model,
             skip_normalize=opt.skip_normalize,
-            log_tokens    =opt.log_tokenization
+            log_tokens    =opt.log_tokenization,
+            model_hash    =self.model_hash,
         )
 
         if tool in ('gfpgan','codeformer','upscale'):
@@ -698,9 +826,13 @@ class Generate:
             embiggen:bool=False,
             hires_fix:bool=False,
             force_outpaint:bool=False,
+            tiled_diffusion:bool=False,
     ):
         inpainting_model_in_use = self.sampler.uses_inpainting_model()
 
+        if tiled_diffusion and init_image is None and embiggen is None and not inpainting_model_in_use:
+            return self._make_tiled_txt2img()
+
         if hires_fix:
             return self._make_txt2img2img()
 
@@ -789,6 +921,13 @@ class Generate:
             self.generators['txt2img'].free_gpu_mem = self.free_gpu_mem
         return self.generators['txt2img']
 
+    def _make_tiled_txt2img(self):
+        if not self.generators.get('tiled_txt2img'):
+            from ldm.invoke.generator.tiled_txt2img import TiledTxt2Img
+            self.generators['tiled_txt2img'] = TiledTxt2Img(self.model, self.precision)
+            self.generators['tiled_txt2img'].free_gpu_mem = self.free_gpu_mem
+        return self.generators['tiled_txt2img']
+
     def _make_txt2img2img(self):
         if not self.generators.get('txt2img2'):
             from ldm.invoke.generator.txt2img2img import Txt2Img2Img
@@ -849,6 +988,7 @@ class Generate:
         self.width = model_data['width']
         self.height= model_data['height']
         self.model_hash = model_data['hash']
+        configure_vae_tiling(self.model, self.vae_tiling_mb)
 
         # uncache generators so they pick up new models
         self.generators = {}
@@ -858,13 +998,30 @@ class Generate:
             self.model.embedding_manager.load(
                 self.embedding_path, self.precision == 'float32' or self.precision == 'autocast'
             )
+            conditioning_cache.invalidate(self.model_hash)
 
         self._set_sampler()
         self.model_name = model_name
         return self.model
 
+    def prefetch_model(self,model_name):
+        """
+        Starts loading the named model in the background, so that a later
+        set_model() call for it does not have to wait for the whole load.
+        Returns the Future of the load, or None if there is nothing to do.
+        """
+        if self.model_name == model_name and self.model is not None:
+            return None
+        if not self.model_cache.valid_model(model_name):
+            print(f'** "{model_name}" is not a known model name. Please check your models.yaml file')
+            return None
+        return self.model_cache.prefetch(model_name)
+
     def load_concepts(self,concepts:list[str]):
+        terms = len(self.model.embedding_manager.string_to_param_dict)
         self.model.embedding_manager.load_concepts(concepts, self.precision=='float32' or self.precision=='autocast')
+        if len(self.model.embedding_manager.string_to_param_dict) != terms:
+            conditioning_cache.invalidate(self.model_hash)
 
     def concept_lib(self)->Concepts:
         return self.model.embedding_manager.concepts_library
@@ -957,7 +1114,8 @@ class Generate:
 
     # to help WebGUI - front end to generator util function
     def sample_to_image(self, samples):
-        return self._make_base().sample_to_image(samples)
+        # when iterations are batched, previews show the first image of the batch
+        return self._make_base().sample_to_image(samples[:1])
 
     def sample_to_lowres_estimated_image(self, samples):
         return self._make_base().sample_to_lowres_estimated_image(samples)
@@ -13,6 +13,7 @@ from ldm.invoke.prompt_parser import PromptParser
 from ldm.invoke.readline import get_completer, Completer
 from ldm.invoke.args import Args, metadata_dumps, metadata_from_png, dream_cmd_from_png
 from ldm.invoke.pngwriter import PngWriter, retrieve_metadata, write_metadata
+from ldm.invoke.output_pipeline import OutputPipeline
 from ldm.invoke.image_util import make_grid
 from ldm.invoke.log import write_log
 from ldm.invoke.concepts_lib import Concepts
@@ -97,8 +98,16 @@ def main():
             codeformer=codeformer,
             esrgan=esrgan,
             free_gpu_mem=opt.free_gpu_mem,
+            vae_tiling_mb=opt.vae_tiling_mb,
             safety_checker=opt.safety_checker,
             max_loaded_models=opt.max_loaded_models,
+            max_cache_ram_mb=opt.max_cache_ram_mb,
+            max_cache_vram_mb=opt.max_cache_vram_mb,
+            converted_weights_dir=opt.converted_weights_dir,
+            conditioning_cache_size=opt.conditioning_cache_size,
+            conditioning_cache_dir=opt.conditioning_cache_dir,
+            init_latent_cache_mb=opt.init_latent_cache_mb,
+            legacy_seeding=opt.legacy_seeding,
             )
     except (FileNotFoundError, TypeError, AssertionError):
         emergency_model_reconfigure()
@@ -150,6 +159,9 @@ def main_loop(gen, opt):
     add_embedding_terms(gen, completer)
     output_cntr = completer.get_current_history_length()+1
 
+    # finished images are compressed and written in the background
+    output_pipeline = OutputPipeline(opt.output_workers)
+
     # os.pathconf is not available on Windows
     if hasattr(os, 'pathconf'):
         path_max = os.pathconf(opt.outdir, 'PC_PATH_MAX')
@@ -277,7 +289,7 @@ def main_loop(gen, opt):
             grid_images      = dict()  # seed -> Image, only used if `opt.grid`
             prior_variations = opt.with_variations or []
             prefix = file_writer.unique_prefix()
-            step_callback = make_step_callback(gen, opt, prefix) if opt.save_intermediates > 0 else None
+            step_callback = make_step_callback(gen, opt, prefix, output_pipeline) if opt.save_intermediates > 0 else None
 
             def image_writer(image, seed, upscaled=False, first_seed=None, use_prefix=None):
                 # note the seed is the seed of the current image
@@ -295,14 +307,20 @@ def main_loop(gen, opt):
                     tm = opt.text_mask[0]
                     th = opt.text_mask[1] if len(opt.text_mask)>1 else 0.5
                     formatted_dream_prompt = f'!mask {opt.input_file_path} -tm {tm} {th}'
-                    path = file_writer.save_image_and_prompt_to_png(
-                        image           = image,
-                        dream_prompt    = formatted_dream_prompt,
-                        metadata        = {},
-                        name      = filename,
-                        compress_level = opt.png_compression,
+                    path = os.path.join(current_outdir, filename)
+                    output_pipeline.submit(
+                        file_writer.save_image_and_prompt_to_png,
+                        kwargs = dict(
+                            image           = image,
+                            dream_prompt    = formatted_dream_prompt,
+                            metadata        = {},
+                            name      = filename,
+                            compress_level = opt.png_compression,
+                        ),
+                        # only log the output once it is on disk
+                        callback = lambda _, entry=[path, formatted_dream_prompt]: results.append(entry),
+                        key      = path,
                     )
-                    results.append([path, formatted_dream_prompt])
 
                 else:
                     if use_prefix is not None:
@@ -318,32 +336,40 @@ def main_loop(gen, opt):
                         postprocessed,
                         first_seed
                     )
-                    path = file_writer.save_image_and_prompt_to_png(
-                        image           = image,
-                        dream_prompt    = formatted_dream_prompt,
-                        metadata        = metadata_dumps(
-                            opt,
-                            seeds      = [seed if opt.variation_amount==0 and len(prior_variations)==0 else first_seed],
-                            model_hash = gen.model_hash,
-                        ),
-                        name      = filename,
-                        compress_level = opt.png_compression,
+                    path = os.path.join(current_outdir, filename)
+                    metadata = metadata_dumps(
+                        opt,
+                        seeds      = [seed if opt.variation_amount==0 and len(prior_variations)==0 else first_seed],
+                        model_hash = gen.model_hash,
                     )
-
-                    # update rfc metadata
-                    if operation == 'postprocess':
-                        tool = re.match('postprocess:(\w+)',opt.last_operation).groups()[0]
-                        add_postprocessing_to_metadata(
-                            opt,
-                            opt.input_file_path,
-                            filename,
-                            tool,
-                            formatted_dream_prompt,
-                        )                           
-                        
+                    tool = re.match('postprocess:(\w+)',opt.last_operation).groups()[0] if operation == 'postprocess' else None
+                    input_file_path = opt.input_file_path
+
+                    def write_image():
+                        file_writer.save_image_and_prompt_to_png(
+                            image           = image,
+                            dream_prompt    = formatted_dream_prompt,
+                            metadata        = metadata,
+                            name      = filename,
+                            compress_level = opt.png_compression,
+                        )
+
+                        # update rfc metadata
+                        if tool is not None:
+                            add_postprocessing_to_metadata(
+                                opt,
+                                input_file_path,
+                                filename,
+                                tool,
+                                formatted_dream_prompt,
+                            )
+
+                    callback = None
                     if (not postprocessed) or opt.save_original:
-                        # only append to results if we didn't overwrite an earlier output
-                        results.append([path, formatted_dream_prompt])
+                        # only append to results if we didn't overwrite an earlier output,
+                        # and once the image is on disk
+                        callback = lambda _, entry=[path, formatted_dream_prompt]: results.append(entry)
+                    output_pipeline.submit(write_image, callback=callback, key=path)
 
                 # so that the seed autocompletes (on linux|mac when -S or --seed specified
                 if completer and operation == 'generate':
@@ -400,6 +426,9 @@ def main_loop(gen, opt):
             print(e)
             continue
 
+        finally:
+            output_pipeline.flush()
+
         print('Outputs:')
         log_path = os.path.join(current_outdir, 'invoke_log')
         output_cntr = write_log(results, log_path ,('txt', 'md'), output_cntr)
@@ -439,7 +468,7 @@ def do_command(command:str, gen, opt:Args, completer) -> tuple:
     elif command.startswith('!import'):
         path = shlex.split(command)
         if len(path) < 2:
-            print('** please provide a path to a .ckpt or .vae model file')
+            print('** please provide a path to a .ckpt, .safetensors or .vae model file')
         elif not os.path.exists(path[1]):
             print(f'** {path[1]}: file not found')
         else:
@@ -538,7 +567,7 @@ def add_weights_to_config(model_path:str, gen, opt, completer):
         done = os.path.exists(new_config['config'])
 
     done = False
-    completer.complete_extensions(('.vae.pt','.vae','.ckpt'))
+    completer.complete_extensions(('.vae.pt','.vae','.ckpt','.safetensors'))
     while not done:
         vae = input('VAE autoencoder file for this model [None]: ')
         if os.path.exists(vae):
@@ -587,7 +616,7 @@ def edit_config(model_name:str, gen, opt, completer):
 
     conf = config[model_name]
     new_config = {}
-    completer.complete_extensions(('.yaml','.yml','.ckpt','.vae.pt'))
+    completer.complete_extensions(('.yaml','.yml','.ckpt','.safetensors','.vae.pt'))
     for field in ('description', 'weights', 'vae', 'config', 'width','height'):
         completer.linebuffer = str(conf[field]) if field in conf else ''
         new_value = input(f'{field}: ')
@@ -855,7 +884,7 @@ def load_face_restoration(opt):
         print('>> You may need to install the ESRGAN and/or GFPGAN modules')
     return gfpgan,codeformer,esrgan
 
-def make_step_callback(gen, opt, prefix):
+def make_step_callback(gen, opt, prefix, output_pipeline):
     destination = os.path.join(opt.outdir,'intermediates',prefix)
     os.makedirs(destination,exist_ok=True)
     print(f'>> Intermediate images will be written into {destination}')
@@ -863,7 +892,7 @@ def make_step_callback(gen, opt, prefix):
         if step % opt.save_intermediates == 0 or step == opt.steps-1:
             filename = os.path.join(destination,f'{step:04}.png')
             image = gen.sample_to_image(img)
-            image.save(filename,'PNG')
+            output_pipeline.submit(image.save, args=(filename, 'PNG'), key=filename)
     return callback
     
 def retrieve_dream_command(opt,command,completer):
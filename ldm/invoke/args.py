@@ -253,6 +253,8 @@ class Args(object):
             switches.append('--seamless')
         if a['hires_fix']:
             switches.append('--hires_fix')
+        if a.get('tiled_diffusion'):
+            switches.append('--tiled_diffusion')
 
         # img2img generations have parameters relevant only to them and have special handling
         if a['init_img'] and len(a['init_img'])>0:
@@ -268,6 +270,10 @@ class Args(object):
                 switches.append(f'-f {a["strength"]}')
             if a['inpaint_replace']:
                 switches.append(f'--inpaint_replace')
+            if a.get('inpaint_crop'):
+                switches.append(f'--inpaint_crop --inpaint_crop_padding {a["inpaint_crop_padding"]}')
+                if not a.get('inpaint_crop_upscale', True):
+                    switches.append('--no-inpaint_crop_upscale')
             if a['text_mask']:
                 switches.append(f'-tm {" ".join([str(u) for u in a["text_mask"]])}')
         else:
@@ -447,12 +453,67 @@ class Args(object):
             default=2,
             help='Maximum number of models to keep in memory for fast switching, including the one in GPU',
         )
+        model_group.add_argument(
+            '--max_cache_ram_mb',
+            dest='max_cache_ram_mb',
+            type=int,
+            default=0,
+            help='Keep as many models in system RAM as fit in this many megabytes, instead of --max_loaded_models. 0 uses --max_loaded_models',
+        )
+        model_group.add_argument(
+            '--max_cache_vram_mb',
+            dest='max_cache_vram_mb',
+            type=int,
+            default=0,
+            help='Keep inactive models on the GPU as long as all fit in this many megabytes. 0 keeps only the active model on the GPU',
+        )
+        model_group.add_argument(
+            '--converted_weights_dir',
+            dest='converted_weights_dir',
+            type=str,
+            default=None,
+            help='Directory in which to save each model\'s weights, pruned, in the working precision and with its VAE merged, after its first load, so that later loads are faster. Not used unless given',
+        )
+        model_group.add_argument(
+            '--conditioning_cache_size',
+            dest='conditioning_cache_size',
+            type=int,
+            default=32,
+            help='Number of encoded prompts to keep in memory so that repeated prompts skip the text encoder. 0 disables the cache',
+        )
+        model_group.add_argument(
+            '--conditioning_cache_dir',
+            dest='conditioning_cache_dir',
+            type=str,
+            default=None,
+            help='Directory in which to keep encoded prompts between sessions. Not used unless given',
+        )
+        model_group.add_argument(
+            '--init_latent_cache_mb',
+            dest='init_latent_cache_mb',
+            type=int,
+            default=64,
+            help='Megabytes of encoded init images to keep so that img2img, inpaint and embiggen runs on the same image skip the VAE encoder. 0 disables the cache',
+        )
         model_group.add_argument(
             '--free_gpu_mem',
             dest='free_gpu_mem',
             action='store_true',
             help='Force free gpu memory before final decoding',
         )
+        model_group.add_argument(
+            '--vae_tiling_mb',
+            dest='vae_tiling_mb',
+            type=int,
+            default=0,
+            help='Encode and decode large images in overlapping tiles, each sized to fit in about this many megabytes. 0 (the default) disables tiling',
+        )
+        model_group.add_argument(
+            '--legacy_seeding',
+            dest='legacy_seeding',
+            action='store_true',
+            help='Reseed the global random number generators for each image, as earlier versions did, instead of giving each seed its own generator. Images are the same either way, but batches that use ancestral samplers or ddim_eta > 0 are then made one image at a time',
+        )
         model_group.add_argument(
             '--precision',
             dest='precision',
@@ -489,6 +550,13 @@ class Args(object):
             help='Directory to save generated images and a log of prompts and seeds. Default: outputs/img-samples',
             default='outputs/img-samples',
         )
+        file_group.add_argument(
+            '--output_workers',
+            dest='output_workers',
+            type=int,
+            default=2,
+            help='Number of background threads that compress and write finished images, so that sampling does not wait on them. 0 writes images on the generation thread',
+        )
         file_group.add_argument(
             '--prompt_as_dir',
             '-p',
@@ -649,6 +717,24 @@ class Args(object):
             default=None,
             help='Web server: Path to private key file to use for SSL. Use together with --certfile'
         )
+        web_server_group.add_argument(
+            '--web_batch_window',
+            type=float,
+            default=0.0,
+            help='Web server: Seconds to hold a generation request so that compatible requests from other clients can be sampled in the same batch. Default 0 (requests that queue up while another is running are still merged)'
+        )
+        web_server_group.add_argument(
+            '--web_max_batch_size',
+            type=int,
+            default=4,
+            help='Web server: Maximum number of images to sample together when merging requests. Use 1 to disable merging'
+        )
+        web_server_group.add_argument(
+            '--web_preview_fps',
+            type=float,
+            default=4.0,
+            help='Web server: Maximum number of in-progress previews sent to each client per second. Use 0 for no limit'
+        )
         web_server_group.add_argument(
             '--gui',
             dest='gui',
@@ -720,6 +806,12 @@ class Args(object):
             default=1,
             help='Number of samplings to perform (slower, but will provide seeds for individual images)',
         )
+        render_group.add_argument(
+            '--batch_size',
+            type=int,
+            default=1,
+            help='Number of iterations to sample together in a single batch. Each seed still produces the same image it would on its own.',
+        )
         render_group.add_argument(
             '-W',
             '--width',
@@ -802,6 +894,12 @@ class Args(object):
             dest='hires_fix',
             help='Create hires image using img2img to prevent duplicated objects'
         )
+        render_group.add_argument(
+            '--tiled_diffusion',
+            action='store_true',
+            dest='tiled_diffusion',
+            help='Make large txt2img images by denoising overlapping windows of the model\'s native size and blending them at every step. Memory grows linearly with the image area'
+        )
         render_group.add_argument(
             '--save_intermediates',
             type=int,
@@ -873,6 +971,23 @@ class Args(object):
             default=0.0,
             help='when inpainting, adjust how aggressively to replace the part of the picture under the mask, from 0.0 (a gentle merge) to 1.0 (replace entirely)',
         )
+        inpainting_group.add_argument(
+            '--inpaint_crop',
+            action='store_true',
+            help='when inpainting, only diffuse the part of the image around the mask, so that small edits to large images are fast',
+        )
+        inpainting_group.add_argument(
+            '--inpaint_crop_padding',
+            type=int,
+            default=64,
+            help='with --inpaint_crop, the number of pixels of context to keep around the mask',
+        )
+        inpainting_group.add_argument(
+            '--inpaint_crop_upscale',
+            action=argparse.BooleanOptionalAction,
+            default=True,
+            help='with --inpaint_crop, scale a crop smaller than the model\'s native size up to it before diffusing. Use --no-inpaint_crop_upscale to diffuse it as is',
+        )
         outpainting_group.add_argument(
             '-c',
             '--outcrop',
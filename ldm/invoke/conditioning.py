@@ -4,9 +4,14 @@ This module handles the generation of the conditioning tensors.
 Useful function exports:
 
 get_uc_and_c_and_ec()           get the conditioned and unconditioned latent, and edited conditioning if we're doing cross-attention control
+conditioning_cache              LRU cache of get_uc_and_c_and_ec() results, keyed on model, prompt, loaded embeddings and dtype
 
 '''
+import contextlib
+import hashlib
+import os
 import re
+from collections import OrderedDict
 from difflib import SequenceMatcher
 from typing import Union
 
@@ -19,7 +24,163 @@ from ..models.diffusion.shared_invokeai_diffusion import InvokeAIDiffuserCompone
 from ..modules.encoders.modules import WeightedFrozenCLIPEmbedder
 
 
-def get_uc_and_c_and_ec(prompt_string_uncleaned, model, log_tokens=False, skip_normalize=False):
+class ConditioningCache():
+    '''
+    A bounded LRU cache of the (uc, c, extra_conditioning_info) tuples returned by
+    get_uc_and_c_and_ec(). If a cache directory is given, entries are also written
+    there and survive restarts. Cached tensors are shared between callers and
+    must not be modified in place.
+    '''
+    def __init__(self, max_entries:int=32, cache_dir:str=None, max_disk_entries:int=1000):
+        self.max_entries      = max_entries
+        self.cache_dir        = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.entries          = OrderedDict()
+
+    def configure(self, max_entries:int=None, cache_dir:str=None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.cache_dir = cache_dir
+        while len(self.entries) > max(self.max_entries, 0):
+            self.entries.popitem(last=False)
+
+    @classmethod
+    def make_key(cls, model_hash:str, prompt:str, negative_prompt:str, skip_normalize:bool, embeddings:dict, dtype)->tuple:
+        '''
+        embeddings maps the loaded textual inversion trigger strings to their
+        embedding tensors; their contents are part of the key, so that an
+        embedding file replaced under the same name is not served stale.
+        '''
+        return (
+            model_hash,
+            prompt,
+            negative_prompt,
+            skip_normalize,
+            tuple(sorted(embeddings.keys())),
+            cls._embeddings_digest(embeddings),
+            str(dtype),
+            torch.is_autocast_enabled(),
+        )
+
+    @classmethod
+    def _embeddings_digest(cls, embeddings:dict)->str:
+        sha = hashlib.sha256()
+        for term in sorted(embeddings.keys()):
+            tensor = embeddings[term].detach().contiguous().cpu()
+            sha.update(term.encode('utf-8'))
+            sha.update(str(tensor.dtype).encode('utf-8'))
+            sha.update(tensor.flatten().view(torch.uint8).numpy().tobytes())
+        return sha.hexdigest()
+
+    def get(self, key:tuple, device=None):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        path = self._path(key)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            value = self._unpack(self._load(path, device))
+        except Exception as e:
+            print(f'** Could not read cached conditioning {path}: {str(e)}')
+            return None
+        self._remember(key, value)
+        return value
+
+    def put(self, key:tuple, value:tuple):
+        self._remember(key, value)
+        path = self._path(key)
+        if path is None or os.path.exists(path):
+            return
+        try:
+            tmpfile = f'{path}.tmp'
+            torch.save(self._pack(value), tmpfile)
+            os.replace(tmpfile, path)
+            self._prune_disk()
+        except Exception as e:
+            print(f'** Could not write cached conditioning {path}: {str(e)}')
+
+    def invalidate(self, model_hash:str=None):
+        '''
+        Drop the entries for the indicated model, or all entries if no model is given.
+        Entries on disk are left alone, since their keys record the loaded embeddings.
+        '''
+        for key in [k for k in self.entries if model_hash is None or k[0] == model_hash]:
+            del self.entries[key]
+
+    def _remember(self, key:tuple, value:tuple):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _path(self, key:tuple)->str:
+        if self.cache_dir is None:
+            return None
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'{digest}.pt')
+
+    def _prune_disk(self):
+        # other processes may be pruning the same directory, so files can vanish at any point
+        mtimes = {}
+        for x in os.listdir(self.cache_dir):
+            if x.endswith('.pt'):
+                path = os.path.join(self.cache_dir, x)
+                with contextlib.suppress(FileNotFoundError):
+                    mtimes[path] = os.path.getmtime(path)
+        if len(mtimes) <= self.max_disk_entries:
+            return
+        files = sorted(mtimes, key=mtimes.get)
+        for path in files[:len(files)-self.max_disk_entries]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    @classmethod
+    def _load(cls, path:str, device):
+        '''
+        Cached files hold only tensors, lists, dicts and plain values, so they
+        are loaded without unpickling arbitrary objects where torch allows it.
+        '''
+        try:
+            return torch.load(path, map_location=device, weights_only=True)
+        except TypeError:    # torch < 1.13 has no weights_only
+            return torch.load(path, map_location=device)
+
+    @classmethod
+    def _pack(cls, value:tuple)->dict:
+        uc, c, extra_conditioning_info = value
+        cac_args = extra_conditioning_info.cross_attention_control_args
+        return {
+            'uc': uc,
+            'c': c,
+            'cross_attention_control_args': None if cac_args is None else dict(vars(cac_args)),
+        }
+
+    @classmethod
+    def _unpack(cls, packed:dict)->tuple:
+        cac_args = None
+        if packed['cross_attention_control_args'] is not None:
+            # restored as saved, rather than built again from the per-edit options it was made from
+            cac_args = cross_attention_control.Arguments.__new__(cross_attention_control.Arguments)
+            vars(cac_args).update(packed['cross_attention_control_args'])
+        return (
+            packed['uc'],
+            packed['c'],
+            InvokeAIDiffuserComponent.ExtraConditioningInfo(cross_attention_control_args=cac_args),
+        )
+
+conditioning_cache = ConditioningCache()
+
+
+def get_uc_and_c_and_ec(prompt_string_uncleaned, model, log_tokens=False, skip_normalize=False, model_hash=None):
+    '''
+    Results are cached in conditioning_cache when the model_hash is given and
+    tokens are not being logged.
+    '''
 
     # Extract Unconditioned Words From Prompt
     unconditioned_words = ''
@@ -36,6 +197,25 @@ def get_uc_and_c_and_ec(prompt_string_uncleaned, model, log_tokens=False, skip_n
     else:
         prompt_string_cleaned = prompt_string_uncleaned
 
+    cache_key = None
+    if model_hash is not None and not log_tokens:
+        cache_key = ConditioningCache.make_key(model_hash,
+                                               prompt_string_cleaned,
+                                               unconditioned_words,
+                                               skip_normalize,
+                                               model.embedding_manager.string_to_param_dict,
+                                               next(model.cond_stage_model.parameters()).dtype)
+        cached = conditioning_cache.get(cache_key, device=model.device)
+        if cached is not None:
+            return cached
+
+    result = _get_uc_and_c_and_ec(prompt_string_cleaned, unconditioned_words, model, log_tokens=log_tokens)
+    if cache_key is not None:
+        conditioning_cache.put(cache_key, result)
+    return result
+
+
+def _get_uc_and_c_and_ec(prompt_string_cleaned, unconditioned_words, model, log_tokens=False):
     pp = PromptParser()
 
     parsed_prompt: Union[FlattenedPrompt, Blend] = None
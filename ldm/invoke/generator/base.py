@@ -8,18 +8,26 @@ import random
 import os
 import os.path as osp
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm, trange
 from PIL import Image, ImageFilter, ImageChops
 import cv2 as cv
 from einops import rearrange, repeat
 from pytorch_lightning import seed_everything
 from ldm.invoke.devices import choose_autocast
-from ldm.util import rand_perlin_2d
+from ldm.invoke.generator.latent_cache import init_latent_cache
+from ldm.models.diffusion.ksampler import KSampler
+from ldm.modules.diffusionmodules.util import seeded_noise
+from ldm.util import rand_perlin_2d_channels
 
 downsampling = 8
 CAUTION_IMG = 'assets/caution.png'
 
 class Generator():
+    # set to True in descendent classes whose make_image() accepts noise
+    # for several seeds stacked into one batch and returns a list of images
+    supports_batching = False
+
     def __init__(self, model, precision):
         self.model = model
         self.precision = precision
@@ -32,8 +40,13 @@ class Generator():
         self.variation_amount = 0
         self.with_variations = []
         self.use_mps_noise = False
+        self.legacy_seeding = False
+        self.noise_seed = None
+        self.rngs = None           # device type -> torch.Generator, by seed_noise()
+        self.seed_random = None    # the python RNG that picks the next seed
         self.free_gpu_mem = None
         self.caution_img = None
+        self.safety_check_executor = None
 
     # this is going to be overridden in img2img.py, txt2img.py and inpaint.py
     def get_make_image(self,prompt,**kwargs):
@@ -50,10 +63,36 @@ class Generator():
 
     def generate(self,prompt,init_image,width,height,sampler, iterations=1,seed=None,
                  image_callback=None, step_callback=None, threshold=0.0, perlin=0.0,
-                 safety_checker:dict=None,
+                 safety_checker:dict=None, batch_size=1,
                  **kwargs):
         scope = choose_autocast(self.precision)
         self.safety_checker = safety_checker
+        results = []
+        # (future, seeds) of the batch being safety checked while the next one samples
+        pending = None
+
+        def deliver(checked_images, seeds):
+            for image, image_seed in zip(checked_images(), seeds):
+                results.append([image, image_seed])
+
+                if image_callback is not None:
+                    image_callback(image, image_seed, first_seed=first_seed)
+
+        def deliver_pending(wait=True):
+            nonlocal pending
+            if pending is not None and (wait or pending[0].done()):
+                future, seeds = pending
+                pending = None
+                deliver(future.result, seeds)
+
+        if safety_checker is not None:
+            # hand out checked images at the first step after their check is done
+            outer_step_callback = step_callback
+            def step_callback(*args, **kwargs):
+                deliver_pending(wait=False)
+                if outer_step_callback is not None:
+                    outer_step_callback(*args, **kwargs)
+
         make_image = self.get_make_image(
             prompt,
             sampler = sampler,
@@ -65,59 +104,268 @@ class Generator():
             perlin        = perlin,
             **kwargs
         )
-        results             = []
         seed                = seed if seed is not None and seed >= 0 else self.new_seed()
         first_seed          = seed
         seed, initial_noise = self.generate_initial_noise(seed, width, height)
 
+        batch_size = max(1, min(batch_size or 1, iterations))
+        # with fixed variations every image's sampler noise comes from one shared chain of draws
+        shared_chain = initial_noise is not None and self.variation_amount == 0 and not self.legacy_seeding
+        if batch_size > 1 and (shared_chain or not self.can_batch(sampler, **kwargs)):
+            print('>> Batched generation is not reproducible with these settings; generating one image at a time')
+            batch_size = 1
+
         # There used to be an additional self.model.ema_scope() here, but it breaks
         # the inpaint-1.5 model. Not sure what it did.... ?
         with scope(self.model.device.type):
-            for n in trange(iterations, desc='Generating'):
-                x_T = None
-                if self.variation_amount > 0:
-                    seed_everything(seed)
-                    target_noise = self.get_noise(width,height)
-                    x_T = self.slerp(self.variation_amount, initial_noise, target_noise)
-                elif initial_noise is not None:
-                    # i.e. we specified particular variations
-                    x_T = initial_noise
+            for n in trange(0, iterations, batch_size, desc='Generating'):
+                # The noise for each seed is made exactly as it would be for
+                # a single image, so a seed gives the same picture whether or
+                # not it was sampled as part of a batch.
+                seeds  = []
+                noises = []
+                rngs   = []
+                for _ in range(min(batch_size, iterations - n)):
+                    noises.append(self.get_seed_noise(seed, initial_noise, width, height))
+                    rngs.append(self.sampler_rng())
+                    seeds.append(seed)
+                    seed = self.new_seed()
+
+                try:
+                    with seeded_noise(None if self.legacy_seeding else rngs):
+                        if len(seeds) == 1:
+                            images = [make_image(noises[0])]
+                        else:
+                            images = make_image(torch.cat(noises))
+                finally:
+                    # also when sampling was canceled or failed, so finished images are not lost
+                    deliver_pending()
+
+                if self.safety_checker is None:
+                    deliver(lambda: images, seeds)
                 else:
-                    seed_everything(seed)
-                    try:
-                        x_T = self.get_noise(width,height)
-                    except:
-                        print('** An error occurred while getting initial noise **')
-                        print(traceback.format_exc())
+                    pending = (self.start_safety_check(images), seeds)
+
+            deliver_pending()
+
+        return results
+
+    def generate_merged(self,jobs,width,height,sampler,
+                        step_callback=None, threshold=0.0, perlin=0.0,
+                        safety_checker:dict=None,
+                        **kwargs):
+        '''
+        Samples several independent requests as one batch. Each job is a
+        (conditioning, seed, iterations, image_callback) tuple. The noise for
+        each job's seeds is made just as generate() would make it, the
+        conditionings are stacked to match, and every image is handed to the
+        image_callback of the job it belongs to. Returns one list of
+        [image, seed] pairs per job.
+        '''
+        scope = choose_autocast(self.precision)
+        self.safety_checker = safety_checker
+        self.set_variation(None, 0.0, [])
+
+        # one row of conditioning per image, in job order
+        uc = torch.cat([job[0][0] for job in jobs for _ in range(job[2])])
+        c  = torch.cat([job[0][1] for job in jobs for _ in range(job[2])])
+        make_image = self.get_make_image(
+            None,
+            sampler       = sampler,
+            conditioning  = (uc, c, None),
+            width         = width,
+            height        = height,
+            step_callback = step_callback,
+            threshold     = threshold,
+            perlin        = perlin,
+            **kwargs
+        )
 
-                image = make_image(x_T)
+        results = [[] for _ in jobs]
+        with scope(self.model.device.type):
+            noises = []
+            rngs   = []
+            owners = []
+            for index, (_, seed, iterations, _) in enumerate(jobs):
+                seed       = seed if seed is not None and seed >= 0 else self.new_seed()
+                first_seed = seed
+                for _ in range(iterations):
+                    noises.append(self.get_seed_noise(seed, None, width, height))
+                    rngs.append(self.sampler_rng())
+                    owners.append((index, seed, first_seed))
+                    seed = self.new_seed()
+
+            with seeded_noise(None if self.legacy_seeding else rngs):
+                if len(noises) == 1:
+                    images = [make_image(noises[0])]
+                else:
+                    images = make_image(torch.cat(noises))
 
-                if self.safety_checker is not None:
-                    image = self.safety_check(image)
+            if self.safety_checker is not None:
+                images = self.safety_check_images(images)
 
-                results.append([image, seed])
+            for image, (index, seed, first_seed) in zip(images, owners):
+                results[index].append([image, seed])
 
+                image_callback = jobs[index][3]
                 if image_callback is not None:
                     image_callback(image, seed, first_seed=first_seed)
 
-                seed = self.new_seed()
-
         return results
-    
+
+    def can_batch(self, sampler, ddim_eta=0.0, conditioning=None, **kwargs)->bool:
+        '''
+        Returns True if make_image() can be handed the noise for several seeds
+        in one batch without changing the image that any one seed would make
+        on its own. This is the case when the sampler draws no random numbers
+        of its own once sampling has started, or when it draws them from the
+        generator of each row's seed (see seed_noise()).
+        '''
+        if not self.supports_batching:
+            return False
+        if isinstance(sampler, KSampler):
+            draws_noise = 'ancestral' in sampler.schedule
+        else:
+            draws_noise = ddim_eta > 0.0
+        if draws_noise and (self.legacy_seeding or not sampler.can_seed_noise()):
+            return False
+        if conditioning is not None:
+            uc, c, extra_conditioning_info = conditioning
+            if not isinstance(c, torch.Tensor):  # hybrid conditioning of the inpainting model
+                return False
+            if extra_conditioning_info is not None and extra_conditioning_info.wants_cross_attention_control:
+                return False
+        return True
+
+    def get_seed_noise(self, seed, initial_noise, width, height):
+        '''
+        Returns the initial noise (x_T) for a single seed, taking variations into account
+        '''
+        x_T = None
+        if self.variation_amount > 0:
+            self.seed_noise(seed)
+            target_noise = self.get_noise(width,height)
+            x_T = self.slerp(self.variation_amount, initial_noise, target_noise)
+        elif initial_noise is not None:
+            # i.e. we specified particular variations. The sampler's own noise
+            # carries on from the generators that made initial_noise, just as
+            # it carried on the global RNG before, rather than starting over
+            # at the seed that x_T was drawn from.
+            x_T = initial_noise
+        else:
+            self.seed_noise(seed)
+            try:
+                x_T = self.get_noise(width,height)
+            except:
+                print('** An error occurred while getting initial noise **')
+                print(traceback.format_exc())
+        return x_T
+
+    def seed_noise(self, seed):
+        '''
+        Makes the noise drawn from here on reproduce the given seed. Each seed
+        gets its own torch.Generator (one per device type, all seeded alike),
+        which leaves the global RNGs alone and lets the seeds of a batch be
+        sampled side by side. With legacy_seeding the global RNGs are reseeded
+        instead, as seed_everything() always did. Both produce the same noise.
+        '''
+        if self.legacy_seeding:
+            seed_everything(seed)
+            self.rngs = None
+            self.seed_random = None
+            return
+        self.noise_seed = seed
+        self.rngs = {}
+        # seed_everything() used to seed python's RNG too, which picked the next seed
+        self.seed_random = random.Random(seed)
+
+    def rng(self, device='cpu'):
+        '''
+        Returns the generator for the current seed on the given device,
+        or None if noise should come from the global RNG.
+        '''
+        if self.rngs is None:
+            return None
+        device = torch.device(device)
+        if device.type not in self.rngs:
+            self.rngs[device.type] = torch.Generator(device).manual_seed(self.noise_seed)
+        return self.rngs[device.type]
+
+    def sampler_rng(self):
+        '''
+        Returns the generator the sampler draws from for the current seed. It
+        is the one for the model's device, as the sampler drew from that
+        device's global RNG after seed_everything() before. If torch cannot
+        make generators for the device (MPS on older releases), the CPU
+        generator is used, which changes the sampler's noise for a given seed.
+        '''
+        device = self.model.device
+        try:
+            return self.rng(device)
+        except RuntimeError:
+            return self.rng('cpu')
+
+    def batch_conditioning(self, uc, c, batch_size):
+        '''
+        Repeats the unconditioned and conditioned embeddings along
+        the batch dimension to match a batch of latents.
+        '''
+        if uc.shape[0] == batch_size:    # already one row per latent
+            return uc, c
+        return uc.repeat(batch_size,1,1), c.repeat(batch_size,1,1)
+
+    def encode_init_image(self, init_image):
+        '''
+        Moves an init image tensor into latent space. The encoder pass is
+        skipped when the same image was encoded before with the same model.
+        '''
+        posterior = init_latent_cache.encode(self.model, init_image, self.precision)
+        return self.model.get_first_stage_encoding(posterior)
+
     def sample_to_image(self,samples)->Image.Image:
         """
         Given samples returned from a sampler, converts
         it into a PIL Image
         """
-        x_samples = self.model.decode_first_stage(samples)
-        x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
-        if len(x_samples) != 1:
+        if len(samples) != 1:
             raise Exception(
-                f'>> expected to get a single image, but got {len(x_samples)}')
-        x_sample = 255.0 * rearrange(
-            x_samples[0].cpu().numpy(), 'c h w -> h w c'
-        )
-        return Image.fromarray(x_sample.astype(np.uint8))
+                f'>> expected to get a single image, but got {len(samples)}')
+        return self.samples_to_images(samples)[0]
+
+    def samples_to_images(self,samples)->list:
+        """
+        Given a batch of samples returned from a sampler, decodes them
+        in chunks small enough to fit in memory and returns a list of
+        PIL Images in batch order
+        """
+        images = []
+        for chunk in torch.split(samples, self.decode_chunk_size(samples)):
+            x_samples = self.model.decode_first_stage(chunk)
+            x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
+            for x_sample in x_samples:
+                x_sample = 255.0 * rearrange(
+                    x_sample.cpu().numpy(), 'c h w -> h w c'
+                )
+                images.append(Image.fromarray(x_sample.astype(np.uint8)))
+        return images
+
+    def decode_chunk_size(self,samples)->int:
+        '''
+        Returns the number of latents the VAE can decode in one go. On CUDA
+        this is estimated from free memory, assuming the decoder peaks at about
+        eight float32 128-channel activations of the full output size. MPS
+        decodes one at a time, and the CPU decodes the whole batch.
+        '''
+        device = self.model.device
+        if len(samples) == 1 or device.type == 'cpu':
+            return len(samples)
+        if device.type != 'cuda':
+            return 1
+        free,_    = torch.cuda.mem_get_info(device)
+        height    = samples.shape[2] * self.downsampling_factor
+        width     = samples.shape[3] * self.downsampling_factor
+        per_image = width * height * 128 * 8 * 4
+        return max(1, min(len(samples), free // per_image))
 
         # write an approximate RGB image from latent samples for a single step to PNG
 
@@ -165,7 +413,7 @@ class Generator():
         else:
             blurred_init_mask = pil_init_mask
 
-        multiplied_blurred_init_mask = ImageChops.multiply(blurred_init_mask, self.pil_image.split()[-1])
+        multiplied_blurred_init_mask = ImageChops.multiply(blurred_init_mask, pil_init_image.split()[-1])
         
         # Paste original on color-corrected generation (using blurred mask)
         matched_result.paste(init_image, (0,0), mask = multiplied_blurred_init_mask)
@@ -198,11 +446,11 @@ class Generator():
         initial_noise = None
         if self.variation_amount > 0 or len(self.with_variations) > 0:
             # use fixed initial noise plus random noise per iteration
-            seed_everything(seed)
+            self.seed_noise(seed)
             initial_noise = self.get_noise(width,height)
             for v_seed, v_weight in self.with_variations:
                 seed = v_seed
-                seed_everything(seed)
+                self.seed_noise(seed)
                 next_noise = self.get_noise(width,height)
                 initial_noise = self.slerp(v_weight, initial_noise, next_noise)
             if self.variation_amount > 0:
@@ -221,11 +469,12 @@ class Generator():
         raise NotImplementedError("get_noise() must be implemented in a descendent class")
     
     def get_perlin_noise(self,width,height):
-        fixdevice = 'cpu' if (self.model.device.type == 'mps') else self.model.device
-        return torch.stack([rand_perlin_2d((height, width), (8, 8), device = self.model.device).to(fixdevice) for _ in range(self.latent_channels)], dim=0).to(self.model.device)
+        # all channels in one pass; MPS makes the noise on the CPU and moves it over once
+        device = 'cpu' if (self.model.device.type == 'mps') else self.model.device
+        return rand_perlin_2d_channels((height, width), (8, 8), self.latent_channels, device = device, generator = self.rng('cpu')).to(self.model.device)
     
     def new_seed(self):
-        self.seed = random.randrange(0, np.iinfo(np.uint32).max)
+        self.seed = (self.seed_random or random).randrange(0, np.iinfo(np.uint32).max)
         return self.seed
 
     def slerp(self, t, v0, v1, DOT_THRESHOLD=0.9995):
@@ -270,24 +519,47 @@ class Generator():
         If the CompViz safety checker flags an NSFW image, we
         blur it out.
         '''
+        return self.safety_check_images([image])[0]
+
+    def safety_check_images(self,images:list)->list:
+        '''
+        Runs the feature extractor and the CompViz safety checker once
+        over a list of images, and blurs out each image that is flagged.
+        '''
         import diffusers
 
         checker = self.safety_checker['checker']
         extractor = self.safety_checker['extractor']
-        features = extractor([image], return_tensors="pt")
+        features = extractor(images, return_tensors="pt")
         features.to(self.model.device)
 
         # unfortunately checker requires the numpy version, so we have to convert back
-        x_image = np.array(image).astype(np.float32) / 255.0
-        x_image = x_image[None].transpose(0, 3, 1, 2)
+        x_images = np.stack([np.array(image) for image in images]).astype(np.float32) / 255.0
+        x_images = x_images.transpose(0, 3, 1, 2)
 
         diffusers.logging.set_verbosity_error()
-        checked_image, has_nsfw_concept = checker(images=x_image, clip_input=features.pixel_values)
-        if has_nsfw_concept[0]:
-            print('** An image with potential non-safe content has been detected. A blurred image will be returned. **')
-            return self.blur(image)
-        else:
-            return image
+        checked_images, has_nsfw_concept = checker(images=x_images, clip_input=features.pixel_values)
+        checked = []
+        for image, nsfw in zip(images, has_nsfw_concept):
+            if nsfw:
+                print('** An image with potential non-safe content has been detected. A blurred image will be returned. **')
+                image = self.blur(image)
+            checked.append(image)
+        return checked
+
+    def start_safety_check(self,images:list):
+        '''
+        Starts safety checking the images on a background thread, so that
+        sampling can go on meanwhile. Returns the Future of the checked images.
+        '''
+        def check():
+            scope = choose_autocast(self.precision)
+            with torch.no_grad(), scope(self.model.device.type):
+                return self.safety_check_images(images)
+
+        if self.safety_check_executor is None:
+            self.safety_check_executor = ThreadPoolExecutor(1, thread_name_prefix='safety_check')
+        return self.safety_check_executor.submit(check)
 
     def blur(self,input):
         blurry = input.filter(filter=ImageFilter.GaussianBlur(radius=32))
@@ -11,6 +11,95 @@ from ldm.invoke.generator.base      import Generator
 from ldm.invoke.generator.img2img   import Img2Img
 from ldm.invoke.devices import choose_autocast
 from ldm.models.diffusion.ddim     import DDIMSampler
+from ldm.modules.diffusionmodules.util import seeded_noise
+from functools import lru_cache
+
+@lru_cache(maxsize=1)
+def radial_corner_gradient()->Image.Image:
+    '''
+    256x256 left-top corner: opaque at the lower right, fading out with the
+    distance from it and fully transparent beyond 255 pixels.
+    '''
+    y, x = np.mgrid[0:256, 0:256]
+    distance = np.minimum(np.sqrt((255 - x) ** 2 + (255 - y) ** 2), 255)
+    return Image.fromarray(np.round(255 - distance).astype(np.uint8), 'L')
+
+@lru_cache(maxsize=1)
+def asymmetric_corner_gradient()->Image.Image:
+    '''
+    256x256 diagonal corner used on "tailing" intersections to prevent hard edges.
+    Fits for a left-fading gradient on the bottom side and full opacity on the right side.
+    '''
+    y, x = np.mgrid[0:256, 0:256]
+    value = np.round(np.maximum(0, x - (255 - y)) * (255 / np.maximum(1, y)))
+    return Image.fromarray(np.clip(value, 0, 255).astype(np.uint8), 'L')
+
+@lru_cache(maxsize=4)
+def embiggen_alpha_layers(width:int, height:int, overlap_size_x:int, overlap_size_y:int, rerun:bool)->dict:
+    '''
+    Returns the alpha masks that blend a width x height tile into its
+    neighbours, as 'L' images keyed by the sides (L, T, R, B)
+    and corners (C, with aC the asymmetric corner) they fade out. AB*
+    layers fade all sides but one and AA fades all of them. The layers for
+    re-running single tiles are only made when rerun is True.
+    '''
+    # https://stackoverflow.com/questions/69321734/how-to-create-different-transparency-like-gradient-with-python-pil
+    # agradientL is Left-side transparent
+    agradientL = Image.linear_gradient('L').rotate(
+        90).resize((overlap_size_x, height))
+    # agradientT is Top-side transparent
+    agradientT = Image.linear_gradient('L').resize((width, overlap_size_y))
+    # radial corner is the left-top corner, made full circle then cut to just the left-top quadrant
+    agradientC = radial_corner_gradient()
+    agradientAsymC = asymmetric_corner_gradient()
+
+    def layer(*pastes):
+        alpha = Image.new("L", (width, height), 255)
+        for image, position in pastes:
+            alpha.paste(image, position)
+        return alpha
+
+    corner = agradientC.resize((overlap_size_x, overlap_size_y))
+    right_asym_corner = (agradientAsymC.rotate(270).resize((overlap_size_x, overlap_size_y)), (width - overlap_size_x, 0))
+    right = (agradientL.rotate(180), (width - overlap_size_x, 0))
+    bottom = (agradientT.rotate(180), (0, height - overlap_size_y))
+
+    layers = {}
+    layers['L'] = layer((agradientL, (0, 0)))
+    layers['T'] = layer((agradientT, (0, 0)))
+    layers['LTC'] = layer((agradientL, (0, 0)), (agradientT, (0, 0)), (corner, (0, 0)))
+    # masks with an asymmetric upper-right corner, so that when the curved transparent corner of the next tile
+    # to its right is placed it doesn't reveal a hard trailing semi-transparent edge in the overlapping space
+    layers['TaC'] = layer((layers['T'], (0, 0)), right_asym_corner)
+    layers['LTaC'] = layer((layers['LTC'], (0, 0)), right_asym_corner)
+
+    if rerun:
+        # Individual unconnected sides
+        layers['R'] = layer(right)
+        layers['B'] = layer(bottom)
+        layers['TB'] = layer((agradientT, (0, 0)), bottom)
+        layers['LR'] = layer((agradientL, (0, 0)), right)
+
+        # Sides and corner Layers
+        layers['RBC'] = layer(right, bottom,
+            (agradientC.rotate(180).resize((overlap_size_x, overlap_size_y)), (width - overlap_size_x, height - overlap_size_y)))
+        layers['LBC'] = layer((agradientL, (0, 0)), bottom,
+            (agradientC.rotate(90).resize((overlap_size_x, overlap_size_y)), (0, height - overlap_size_y)))
+        layers['RTC'] = layer(right, (agradientT, (0, 0)),
+            (agradientC.rotate(270).resize((overlap_size_x, overlap_size_y)), (width - overlap_size_x, 0)))
+
+        # All but X layers
+        lower_right_corner = (agradientC.rotate(180).resize((overlap_size_x, overlap_size_y)), (width - overlap_size_x, height - overlap_size_y))
+        layers['ABT'] = layer((layers['LBC'], (0, 0)), right, lower_right_corner)
+        layers['ABL'] = layer((layers['RTC'], (0, 0)), bottom, lower_right_corner)
+        layers['ABR'] = layer((layers['LBC'], (0, 0)), (agradientT, (0, 0)), (corner, (0, 0)))
+        layers['ABB'] = layer((layers['RTC'], (0, 0)), (agradientL, (0, 0)), (corner, (0, 0)))
+
+        # All-around layer
+        layers['AA'] = layer((layers['ABT'], (0, 0)), (agradientT, (0, 0)), (corner, (0, 0)),
+            (agradientC.rotate(270).resize((overlap_size_x, overlap_size_y)), (width - overlap_size_x, 0)))
+
+    return layers
 
 class Embiggen(Generator):
     def __init__(self, model, precision):
@@ -58,6 +147,7 @@ class Embiggen(Generator):
         embiggen,
         embiggen_tiles,
         step_callback=None,
+        batch_size=1,
         **kwargs
     ):
         """
@@ -95,6 +185,9 @@ class Embiggen(Generator):
 
         # Prep img2img generator, since we wrap over it
         gen_img2img = Img2Img(self.model,self.precision)
+        gen_img2img.use_mps_noise  = self.use_mps_noise
+        gen_img2img.legacy_seeding = self.legacy_seeding
+        sampler = DDIMSampler(self.model, device=self.model.device)
 
         # Open original init image (not a tensor) to manipulate
         initsuperimage = Image.open(init_img)
@@ -163,128 +256,8 @@ class Embiggen(Generator):
         # Sanity
         assert emb_tiles_x > 1 or emb_tiles_y > 1, f'ERROR: Based on the requested dimensions of {initsuperwidth}x{initsuperheight} and tiles of {width}x{height} you don\'t need to Embiggen! Check your arguments.'
 
-        # Prep alpha layers --------------
-        # https://stackoverflow.com/questions/69321734/how-to-create-different-transparency-like-gradient-with-python-pil
-        # agradientL is Left-side transparent
-        agradientL = Image.linear_gradient('L').rotate(
-            90).resize((overlap_size_x, height))
-        # agradientT is Top-side transparent
-        agradientT = Image.linear_gradient('L').resize((width, overlap_size_y))
-        # radial corner is the left-top corner, made full circle then cut to just the left-top quadrant
-        agradientC = Image.new('L', (256, 256))
-        for y in range(256):
-            for x in range(256):
-                # Find distance to lower right corner (numpy takes arrays)
-                distanceToLR = np.sqrt([(255 - x) ** 2 + (255 - y) ** 2])[0]
-                # Clamp values to max 255
-                if distanceToLR > 255:
-                    distanceToLR = 255
-                #Place the pixel as invert of distance     
-                agradientC.putpixel((x, y), round(255 - distanceToLR))
-        
-        # Create alternative asymmetric diagonal corner to use on "tailing" intersections to prevent hard edges
-        # Fits for a left-fading gradient on the bottom side and full opacity on the right side.
-        agradientAsymC = Image.new('L', (256, 256))
-        for y in range(256):
-            for x in range(256):
-                value = round(max(0, x-(255-y)) * (255 / max(1,y)))
-                #Clamp values
-                value = max(0, value)
-                value = min(255, value)
-                agradientAsymC.putpixel((x, y), value)
-
-        # Create alpha layers default fully white
-        alphaLayerL = Image.new("L", (width, height), 255)
-        alphaLayerT = Image.new("L", (width, height), 255)
-        alphaLayerLTC = Image.new("L", (width, height), 255)
-        # Paste gradients into alpha layers
-        alphaLayerL.paste(agradientL, (0, 0))
-        alphaLayerT.paste(agradientT, (0, 0))
-        alphaLayerLTC.paste(agradientL, (0, 0))
-        alphaLayerLTC.paste(agradientT, (0, 0))
-        alphaLayerLTC.paste(agradientC.resize((overlap_size_x, overlap_size_y)), (0, 0))
-        # make masks with an asymmetric upper-right corner so when the curved transparent corner of the next tile
-        # to its right is placed it doesn't reveal a hard trailing semi-transparent edge in the overlapping space
-        alphaLayerTaC = alphaLayerT.copy()
-        alphaLayerTaC.paste(agradientAsymC.rotate(270).resize((overlap_size_x, overlap_size_y)), (width - overlap_size_x, 0))
-        alphaLayerLTaC = alphaLayerLTC.copy()
-        alphaLayerLTaC.paste(agradientAsymC.rotate(270).resize((overlap_size_x, overlap_size_y)), (width - overlap_size_x, 0))
-
-        if embiggen_tiles:
-            # Individual unconnected sides
-            alphaLayerR = Image.new("L", (width, height), 255)
-            alphaLayerR.paste(agradientL.rotate(
-                180), (width - overlap_size_x, 0))
-            alphaLayerB = Image.new("L", (width, height), 255)
-            alphaLayerB.paste(agradientT.rotate(
-                180), (0, height - overlap_size_y))
-            alphaLayerTB = Image.new("L", (width, height), 255)
-            alphaLayerTB.paste(agradientT, (0, 0))
-            alphaLayerTB.paste(agradientT.rotate(
-                180), (0, height - overlap_size_y))
-            alphaLayerLR = Image.new("L", (width, height), 255)
-            alphaLayerLR.paste(agradientL, (0, 0))
-            alphaLayerLR.paste(agradientL.rotate(
-                180), (width - overlap_size_x, 0))
-
-            # Sides and corner Layers
-            alphaLayerRBC = Image.new("L", (width, height), 255)
-            alphaLayerRBC.paste(agradientL.rotate(
-                180), (width - overlap_size_x, 0))
-            alphaLayerRBC.paste(agradientT.rotate(
-                180), (0, height - overlap_size_y))
-            alphaLayerRBC.paste(agradientC.rotate(180).resize(
-                (overlap_size_x, overlap_size_y)), (width - overlap_size_x, height - overlap_size_y))
-            alphaLayerLBC = Image.new("L", (width, height), 255)
-            alphaLayerLBC.paste(agradientL, (0, 0))
-            alphaLayerLBC.paste(agradientT.rotate(
-                180), (0, height - overlap_size_y))
-            alphaLayerLBC.paste(agradientC.rotate(90).resize(
-                (overlap_size_x, overlap_size_y)), (0, height - overlap_size_y))
-            alphaLayerRTC = Image.new("L", (width, height), 255)
-            alphaLayerRTC.paste(agradientL.rotate(
-                180), (width - overlap_size_x, 0))
-            alphaLayerRTC.paste(agradientT, (0, 0))
-            alphaLayerRTC.paste(agradientC.rotate(270).resize(
-                (overlap_size_x, overlap_size_y)), (width - overlap_size_x, 0))
-
-            # All but X layers
-            alphaLayerABT = Image.new("L", (width, height), 255)
-            alphaLayerABT.paste(alphaLayerLBC, (0, 0))
-            alphaLayerABT.paste(agradientL.rotate(
-                180), (width - overlap_size_x, 0))
-            alphaLayerABT.paste(agradientC.rotate(180).resize(
-                (overlap_size_x, overlap_size_y)), (width - overlap_size_x, height - overlap_size_y))
-            alphaLayerABL = Image.new("L", (width, height), 255)
-            alphaLayerABL.paste(alphaLayerRTC, (0, 0))
-            alphaLayerABL.paste(agradientT.rotate(
-                180), (0, height - overlap_size_y))
-            alphaLayerABL.paste(agradientC.rotate(180).resize(
-                (overlap_size_x, overlap_size_y)), (width - overlap_size_x, height - overlap_size_y))
-            alphaLayerABR = Image.new("L", (width, height), 255)
-            alphaLayerABR.paste(alphaLayerLBC, (0, 0))
-            alphaLayerABR.paste(agradientT, (0, 0))
-            alphaLayerABR.paste(agradientC.resize(
-                (overlap_size_x, overlap_size_y)), (0, 0))
-            alphaLayerABB = Image.new("L", (width, height), 255)
-            alphaLayerABB.paste(alphaLayerRTC, (0, 0))
-            alphaLayerABB.paste(agradientL, (0, 0))
-            alphaLayerABB.paste(agradientC.resize(
-                (overlap_size_x, overlap_size_y)), (0, 0))
-
-            # All-around layer
-            alphaLayerAA = Image.new("L", (width, height), 255)
-            alphaLayerAA.paste(alphaLayerABT, (0, 0))
-            alphaLayerAA.paste(agradientT, (0, 0))
-            alphaLayerAA.paste(agradientC.resize(
-                (overlap_size_x, overlap_size_y)), (0, 0))
-            alphaLayerAA.paste(agradientC.rotate(270).resize(
-                (overlap_size_x, overlap_size_y)), (width - overlap_size_x, 0))
-
-        # Clean up temporary gradients
-        del agradientL
-        del agradientT
-        del agradientC
+        # Alpha layers for every tile position, cached per tile and overlap size
+        alpha_layers = embiggen_alpha_layers(width, height, overlap_size_x, overlap_size_y, bool(embiggen_tiles))
 
         def make_image():
             # Make main tiles -------------------------------------------------
@@ -294,13 +267,13 @@ class Embiggen(Generator):
                 print(
                     f'>> Making {(emb_tiles_x * emb_tiles_y)} Embiggen tiles ({emb_tiles_x}x{emb_tiles_y})...')
 
-            emb_tile_store = []
             # Although we could use the same seed for every tile for determinism, at higher strengths this may
             # produce duplicated structures for each tile and make the tiling effect more obvious
             # instead track and iterate a local seed we pass to Img2Img
             seed = self.seed
             seedintlimit = np.iinfo(np.uint32).max - 1 # only retreive this one from numpy
 
+            tile_jobs = []    # (tile, seed, init image crop) in tile order
             for tile in range(emb_tiles_x * emb_tiles_y):
                 # Don't iterate on first tile
                 if tile != 0:
@@ -329,45 +302,52 @@ class Embiggen(Generator):
                 bottom = top + height
 
                 # Cropped image of above dimension (does not modify the original)
-                newinitimage = initsuperimage.crop((left, top, right, bottom))
-                # DEBUG:
-                # newinitimagepath = init_img[0:-4] + f'_emb_Ti{tile}.png'
-                # newinitimage.save(newinitimagepath)
+                tile_jobs.append((tile, seed, initsuperimage.crop((left, top, right, bottom))))
 
-                if embiggen_tiles:
-                    print(
-                        f'Making tile #{tile + 1} ({embiggen_tiles.index(tile) + 1} of {len(embiggen_tiles)} requested)')
-                else:
-                    print(
-                        f'Starting {tile + 1} of {(emb_tiles_x * emb_tiles_y)} tiles')
+            # Tiles are sampled in batches, each tile with the noise of its own seed
+            group_size = 1
+            if gen_img2img.can_batch(sampler, ddim_eta=ddim_eta, conditioning=conditioning):
+                group_size = self.tile_batch_size(batch_size, width, height)
+
+            emb_tile_store = []
+            for group_start in range(0, len(tile_jobs), group_size):
+                group = tile_jobs[group_start:group_start+group_size]
+                for tile, _, _ in group:
+                    if embiggen_tiles:
+                        print(
+                            f'Making tile #{tile + 1} ({embiggen_tiles.index(tile) + 1} of {len(embiggen_tiles)} requested)')
+                    else:
+                        print(
+                            f'Starting {tile + 1} of {(emb_tiles_x * emb_tiles_y)} tiles')
 
-                # create a torch tensor from an Image
-                newinitimage = np.array(
-                    newinitimage).astype(np.float32) / 255.0
-                newinitimage = newinitimage[None].transpose(0, 3, 1, 2)
+                # create a torch tensor from the tile images
+                newinitimage = np.stack([np.array(image) for _, _, image in group]).astype(np.float32) / 255.0
+                newinitimage = newinitimage.transpose(0, 3, 1, 2)
                 newinitimage = torch.from_numpy(newinitimage)
                 newinitimage = 2.0 * newinitimage - 1.0
                 newinitimage = newinitimage.to(self.model.device)
 
-                tile_results = gen_img2img.generate(
+                make_tiles = gen_img2img.get_make_image(
                     prompt,
-                    iterations     = 1,
-                    seed           = seed,
-                    sampler        = DDIMSampler(self.model, device=self.model.device),
+                    sampler        = sampler,
                     steps          = steps,
                     cfg_scale      = cfg_scale,
-                    conditioning   = conditioning,
                     ddim_eta       = ddim_eta,
-                    image_callback = None,  # called only after the final image is generated
-                    step_callback  = step_callback,   # called after each intermediate image is generated
-                    width          = width,
-                    height         = height,
+                    conditioning   = conditioning,
                     init_image     = newinitimage,    # notice that init_image is different from init_img
-                    mask_image     = None,
                     strength       = strength,
+                    step_callback  = step_callback,   # called after each intermediate image is generated
                 )
-
-                emb_tile_store.append(tile_results[0][0])
+                noises = []
+                rngs   = []
+                for _, tile_seed, _ in group:
+                    noises.append(gen_img2img.get_seed_noise(tile_seed, None, width, height))
+                    rngs.append(gen_img2img.sampler_rng())
+                with seeded_noise(None if self.legacy_seeding else rngs):
+                    if len(group) == 1:
+                        emb_tile_store.append(make_tiles(noises[0]))
+                    else:
+                        emb_tile_store.extend(make_tiles(torch.cat(noises)))
                 # DEBUG (but, also has other uses), worth saving if you want tiles without a transparency overlap to manually composite
                 # emb_tile_store[-1].save(init_img[0:-4] + f'_emb_To{tile}.png')
                 del newinitimage
@@ -387,7 +367,7 @@ class Embiggen(Generator):
                             continue
                     else:
                         intileimage = emb_tile_store[tile]
-                    intileimage = intileimage.convert('RGBA')
+                    alpha = None    # fully opaque
                     # Get row and column entries
                     emb_row_i = tile // emb_tiles_x
                     emb_column_i = tile % emb_tiles_x
@@ -413,84 +393,87 @@ class Embiggen(Generator):
                                 if emb_column_i == 0:
                                     if (tile+1) in embiggen_tiles:  # Look-ahead right
                                         if (tile+emb_tiles_x) not in embiggen_tiles:  # Look-ahead down
-                                            intileimage.putalpha(alphaLayerB)
+                                            alpha = alpha_layers['B']
                                         # Otherwise do nothing on this tile
                                     elif (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down only
-                                        intileimage.putalpha(alphaLayerR)
+                                        alpha = alpha_layers['R']
                                     else:
-                                        intileimage.putalpha(alphaLayerRBC)
+                                        alpha = alpha_layers['RBC']
                                 elif emb_column_i == emb_tiles_x - 1:
                                     if (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down
-                                        intileimage.putalpha(alphaLayerL)
+                                        alpha = alpha_layers['L']
                                     else:
-                                        intileimage.putalpha(alphaLayerLBC)
+                                        alpha = alpha_layers['LBC']
                                 else:
                                     if (tile+1) in embiggen_tiles:  # Look-ahead right
                                         if (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down
-                                            intileimage.putalpha(alphaLayerL)
+                                            alpha = alpha_layers['L']
                                         else:
-                                            intileimage.putalpha(alphaLayerLBC)
+                                            alpha = alpha_layers['LBC']
                                     elif (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down only
-                                        intileimage.putalpha(alphaLayerLR)
+                                        alpha = alpha_layers['LR']
                                     else:
-                                        intileimage.putalpha(alphaLayerABT)
+                                        alpha = alpha_layers['ABT']
                             # bottom of image
                             elif emb_row_i == emb_tiles_y - 1:
                                 if emb_column_i == 0:
                                     if (tile+1) in embiggen_tiles: # Look-ahead right
-                                        intileimage.putalpha(alphaLayerTaC)
+                                        alpha = alpha_layers['TaC']
                                     else:
-                                        intileimage.putalpha(alphaLayerRTC)
+                                        alpha = alpha_layers['RTC']
                                 elif emb_column_i == emb_tiles_x - 1:
                                     # No tiles to look ahead to
-                                    intileimage.putalpha(alphaLayerLTC)
+                                    alpha = alpha_layers['LTC']
                                 else:
                                     if (tile+1) in embiggen_tiles: # Look-ahead right
-                                        intileimage.putalpha(alphaLayerLTaC)
+                                        alpha = alpha_layers['LTaC']
                                     else:
-                                        intileimage.putalpha(alphaLayerABB)
+                                        alpha = alpha_layers['ABB']
                             # vertical middle of image
                             else:
                                 if emb_column_i == 0:
                                     if (tile+1) in embiggen_tiles: # Look-ahead right
                                         if (tile+emb_tiles_x) in embiggen_tiles: # Look-ahead down
-                                            intileimage.putalpha(alphaLayerTaC)
+                                            alpha = alpha_layers['TaC']
                                         else:
-                                            intileimage.putalpha(alphaLayerTB)
+                                            alpha = alpha_layers['TB']
                                     elif (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down only
-                                        intileimage.putalpha(alphaLayerRTC)
+                                        alpha = alpha_layers['RTC']
                                     else:
-                                        intileimage.putalpha(alphaLayerABL)
+                                        alpha = alpha_layers['ABL']
                                 elif emb_column_i == emb_tiles_x - 1:
                                     if (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down
-                                        intileimage.putalpha(alphaLayerLTC)
+                                        alpha = alpha_layers['LTC']
                                     else:
-                                        intileimage.putalpha(alphaLayerABR)
+                                        alpha = alpha_layers['ABR']
                                 else:
                                     if (tile+1) in embiggen_tiles: # Look-ahead right
                                         if (tile+emb_tiles_x) in embiggen_tiles: # Look-ahead down
-                                            intileimage.putalpha(alphaLayerLTaC)
+                                            alpha = alpha_layers['LTaC']
                                         else:
-                                            intileimage.putalpha(alphaLayerABR)
+                                            alpha = alpha_layers['ABR']
                                     elif (tile+emb_tiles_x) in embiggen_tiles:  # Look-ahead down only
-                                        intileimage.putalpha(alphaLayerABB)
+                                        alpha = alpha_layers['ABB']
                                     else:
-                                        intileimage.putalpha(alphaLayerAA)
+                                        alpha = alpha_layers['AA']
                         # Handle normal tiling case (much simpler - since we tile left to right, top to bottom)
                         else:
                             if emb_row_i == 0 and emb_column_i >= 1:
-                                intileimage.putalpha(alphaLayerL)
+                                alpha = alpha_layers['L']
                             elif emb_row_i >= 1 and emb_column_i == 0:
                                 if emb_column_i + 1 == emb_tiles_x: # If we don't have anything that can be placed to the right
-                                    intileimage.putalpha(alphaLayerT)
+                                    alpha = alpha_layers['T']
                                 else:
-                                    intileimage.putalpha(alphaLayerTaC)
+                                    alpha = alpha_layers['TaC']
                             else:
                                 if emb_column_i + 1 == emb_tiles_x: # If we don't have anything that can be placed to the right
-                                    intileimage.putalpha(alphaLayerLTC)
+                                    alpha = alpha_layers['LTC']
                                 else:
-                                    intileimage.putalpha(alphaLayerLTaC)
+                                    alpha = alpha_layers['LTaC']
                     # Layer tile onto final image
+                    intileimage = intileimage.convert('RGBA')
+                    if alpha is not None:
+                        intileimage.putalpha(alpha)
                     outputsuperimage.alpha_composite(intileimage, (left, top))
             else:
                 print(f'Error: could not find all Embiggen output tiles in memory? Something must have gone wrong with img2img generation.')
@@ -499,3 +482,18 @@ class Embiggen(Generator):
             return outputsuperimage
         # end of function declaration
         return make_image
+
+    def tile_batch_size(self, batch_size, width, height)->int:
+        '''
+        Returns how many tiles to sample together: batch_size, less if on
+        CUDA the free memory would not hold that many. Assumes a tile peaks at
+        about eight float32 128-channel activations of its full size, as the
+        VAE decoder does.
+        '''
+        batch_size = max(1, batch_size or 1)
+        device = self.model.device
+        if batch_size == 1 or device.type != 'cuda':
+            return batch_size
+        free,_   = torch.cuda.mem_get_info(device)
+        per_tile = width * height * 128 * 8 * 4
+        return max(1, min(batch_size, free // per_tile))
@@ -10,13 +10,22 @@ from PIL import Image
 from ldm.invoke.devices import choose_autocast
 from ldm.invoke.generator.base import Generator
 from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.ksampler import KSampler
 from ldm.models.diffusion.shared_invokeai_diffusion import InvokeAIDiffuserComponent
 
 class Img2Img(Generator):
+    supports_batching = True
+
     def __init__(self, model, precision):
         super().__init__(model, precision)
         self.init_latent = None    # by get_noise()
 
+    def can_batch(self, sampler, **kwargs)->bool:
+        # the k* samplers add fresh random noise to the init latent
+        if isinstance(sampler, KSampler) and self.legacy_seeding:
+            return False
+        return super().can_batch(sampler, **kwargs)
+
     def get_make_image(self,prompt,sampler,steps,cfg_scale,ddim_eta,
                        conditioning,init_image,strength,step_callback=None,threshold=0.0,perlin=0.0,**kwargs):
         """
@@ -34,14 +43,14 @@ class Img2Img(Generator):
 
         scope = choose_autocast(self.precision)
         with scope(self.model.device.type):
-            self.init_latent = self.model.get_first_stage_encoding(
-                self.model.encode_first_stage(init_image)
-            ) # move to latent space
+            self.init_latent = self.encode_init_image(init_image) # move to latent space
 
         t_enc = int(strength * steps)
         uc, c, extra_conditioning_info   = conditioning
 
         def make_image(x_T):
+            batch_size = 1 if x_T is None else x_T.shape[0]
+            batch_uc, batch_c = self.batch_conditioning(uc, c, batch_size)
             # encode (scaled latent)
             z_enc = sampler.stochastic_encode(
                 self.init_latent,
@@ -51,28 +60,36 @@ class Img2Img(Generator):
             # decode it
             samples = sampler.decode(
                 z_enc,
-                c,
+                batch_c,
                 t_enc,
                 img_callback = step_callback,
                 unconditional_guidance_scale=cfg_scale,
-                unconditional_conditioning=uc,
+                unconditional_conditioning=batch_uc,
                 init_latent = self.init_latent, # changes how noising is performed in ksampler
                 extra_conditioning_info = extra_conditioning_info,
                 all_timesteps_count = steps
             )
 
+            if batch_size > 1:
+                return self.samples_to_images(samples)
             return self.sample_to_image(samples)
 
         return make_image
 
     def get_noise(self,width,height):
+        assert self.init_latent is not None,'call to get_noise() when init_latent not set'
+        return self.get_latent_noise(self.init_latent)
+
+    def get_latent_noise(self,init_latent):
+        '''
+        Returns the noise for one seed, shaped like a row of init_latent
+        '''
         device      = self.model.device
-        init_latent = self.init_latent
-        assert init_latent is not None,'call to get_noise() when init_latent not set'
+        shape = (1, *init_latent.shape[1:])    # one seed's worth, even for a batch of init images
         if device.type == 'mps':
-            x = torch.randn_like(init_latent, device='cpu').to(device)
+            x = torch.randn(shape, dtype=init_latent.dtype, device='cpu', generator=self.rng('cpu')).to(device)
         else:
-            x = torch.randn_like(init_latent, device=device)
+            x = torch.randn(shape, dtype=init_latent.dtype, device=device, generator=self.rng(device))
         if self.perlin > 0.0:
             shape = init_latent.shape
             x = (1-self.perlin)*x + self.perlin*self.get_perlin_noise(shape[3], shape[2])
@@ -35,12 +35,8 @@ infill_methods.append('tile')
 
 
 class Inpaint(Img2Img):
-    def __init__(self, model, precision):
-        self.init_latent = None
-        self.pil_image = None
-        self.pil_mask = None
-        self.mask_blur_radius = 0
-        super().__init__(model, precision)
+    # make_image() inpaints, seam paints and color corrects one image at a time
+    supports_batching = False
 
     # Outpaint support code
     def get_tile_images(self, image: np.ndarray, width=8, height=8):
@@ -139,41 +135,104 @@ class Inpaint(Img2Img):
         return ImageOps.invert(new_mask)
 
 
-    def seam_paint(self,
-        im: Image.Image,
-        seam_size: int,
-        seam_blur: int,
-        prompt,sampler,steps,cfg_scale,ddim_eta,
-        conditioning,strength,
-        noise,
-        step_callback
-    ) -> Image.Image:
-        hard_mask = self.pil_image.split()[-1].copy()
-        mask = self.mask_edge(hard_mask, seam_size, seam_blur)
-
-        make_image = self.get_make_image(
-            prompt,
-            sampler,
-            steps,
-            cfg_scale,
-            ddim_eta,
-            conditioning,
-            init_image = im.copy().convert('RGBA'),
-            mask_image = mask.convert('RGB'), # Code currently requires an RGB mask
-            strength = strength,
+    def seam_context(self, context: 'InpaintContext', im: Image.Image, seam_size: int, seam_blur: int) -> 'InpaintContext':
+        '''
+        Returns the context for repainting the seam around the inpainted region
+        of im, the result of inpainting with the given context. The mask covers
+        the edge of the original transparent region; im needs no infill.
+        '''
+        hard_mask = context.pil_image.split()[-1].copy()
+        mask = self.mask_edge(hard_mask, seam_size, seam_blur).convert('RGB')
+        debug_image(mask, "seam mask", debug_status=context.debug)
+
+        scope = choose_autocast(self.precision)
+        with scope(self.model.device.type):
+            init_latent = self.encode_init_image(self._image_to_tensor(im.convert('RGB')))
+
+        return InpaintContext(
+            pil_image        = im.convert('RGBA'),
+            pil_mask         = mask,
+            init_latent      = init_latent,
+            mask             = self._mask_to_latent_mask(mask),
             mask_blur_radius = 0,
-            seam_size = 0,
-            step_callback = step_callback,
-            inpaint_width = im.width,
-            inpaint_height = im.height
+            inpaint_size     = None,
+            debug            = context.debug,
         )
 
-        seam_noise = self.get_noise(im.width, im.height)
+    def prepare_context(self, init_image, mask_image, infill_method, tile_size: int,
+                        mask_blur_radius: int, inpaint_width=None, inpaint_height=None,
+                        debug: bool=False) -> 'InpaintContext':
+        '''
+        Does everything a request needs before sampling starts, once: infills the
+        init image, combines the mask with its transparency, scales both to the
+        inpainting size and moves the image into latent space.
+        '''
+        pil_image = None
+        pil_mask  = None
+        if isinstance(init_image, PIL.Image.Image):
+            pil_image = init_image.copy()
+
+            # Do infill
+            if infill_method == 'patchmatch' and patch_match.patchmatch_available:
+                init_filled = self.infill_patchmatch(pil_image.copy())
+            else: # if infill_method == 'tile': # Only two methods right now, so always use 'tile' if not patchmatch
+                init_filled = self.tile_fill_missing(
+                    pil_image.copy(),
+                    seed = self.seed,
+                    tile_size = tile_size
+                )
+            init_filled.paste(init_image, (0,0), init_image.split()[-1])
+
+            # Resize if requested for inpainting
+            if inpaint_width and inpaint_height:
+                init_filled = init_filled.resize((inpaint_width, inpaint_height))
+
+            debug_image(init_filled, "init_filled", debug_status=debug)
+
+            # Create init tensor
+            init_image = self._image_to_tensor(init_filled.convert('RGB'))
+
+        if isinstance(mask_image, PIL.Image.Image):
+            debug_image(mask_image, "mask_image BEFORE multiply with pil_image", debug_status=debug)
+
+            mask_image = ImageChops.multiply(mask_image, pil_image.split()[-1].convert('RGB'))
+            pil_mask = mask_image
+
+            # Resize if requested for inpainting
+            if inpaint_width and inpaint_height:
+                mask_image = mask_image.resize((inpaint_width, inpaint_height))
 
-        result = make_image(seam_noise)
+            debug_image(mask_image, "mask_image AFTER multiply with pil_image", debug_status=debug)
+            mask = self._mask_to_latent_mask(mask_image)
+        else:
+            mask = mask_image[0][0].unsqueeze(0).repeat(4,1,1).unsqueeze(0)
+            mask = repeat(mask, '1 ... -> b ...', b=1)
 
-        return result
+        scope = choose_autocast(self.precision)
+        with scope(self.model.device.type):
+            init_latent = self.encode_init_image(init_image) # move to latent space
+
+        return InpaintContext(
+            pil_image        = pil_image,
+            pil_mask         = pil_mask,
+            init_latent      = init_latent,
+            mask             = mask,
+            mask_blur_radius = mask_blur_radius,
+            inpaint_size     = (inpaint_width, inpaint_height) if inpaint_width and inpaint_height else None,
+            debug            = debug,
+        )
 
+    def _mask_to_latent_mask(self, mask_image: Image.Image) -> torch.Tensor:
+        mask_image = mask_image.resize(
+            (
+                mask_image.width // downsampling,
+                mask_image.height // downsampling
+            ),
+            resample=Image.Resampling.NEAREST
+        )
+        mask = self._image_to_tensor(mask_image,normalize=False)
+        mask = mask[0][0].unsqueeze(0).repeat(4,1,1).unsqueeze(0)
+        return repeat(mask, '1 ... -> b ...', b=1)
 
     @torch.no_grad()
     def get_make_image(self,prompt,sampler,steps,cfg_scale,ddim_eta,
@@ -190,6 +249,9 @@ class Inpaint(Img2Img):
                        infill_method = infill_methods[0], # The infill method to use
                        inpaint_width=None,
                        inpaint_height=None,
+                       inpaint_crop=False,
+                       inpaint_crop_padding: int = 64,
+                       inpaint_crop_upscale=True,
                        **kwargs):
         """
         Returns a function returning an image derived from the prompt and
@@ -197,56 +259,43 @@ class Inpaint(Img2Img):
         the time you call it.  kwargs are 'init_latent' and 'strength'
         """
 
-        self.enable_image_debugging = enable_image_debugging
-
-        self.inpaint_width = inpaint_width
-        self.inpaint_height = inpaint_height
-
-        if isinstance(init_image, PIL.Image.Image):
-            self.pil_image = init_image.copy()
-
-            # Do infill
-            if infill_method == 'patchmatch' and patch_match.patchmatch_available:
-                init_filled = self.infill_patchmatch(self.pil_image.copy())
-            else: # if infill_method == 'tile': # Only two methods right now, so always use 'tile' if not patchmatch
-                init_filled = self.tile_fill_missing(
-                    self.pil_image.copy(),
-                    seed = self.seed,
-                    tile_size = tile_size
+        if inpaint_crop and isinstance(init_image, PIL.Image.Image) and isinstance(mask_image, PIL.Image.Image):
+            box = self.mask_crop_box(init_image, mask_image, inpaint_crop_padding)
+            if box is not None:
+                crop_width, crop_height = box[2] - box[0], box[3] - box[1]
+                if inpaint_crop_upscale:
+                    inpaint_width, inpaint_height = self.native_inpaint_size(crop_width, crop_height)
+                else:
+                    inpaint_width, inpaint_height = None, None
+                print(f'>> Inpainting the {crop_width}x{crop_height} region around the mask at {box[:2]}')
+                make_crop = self.get_make_image(
+                    prompt, sampler, steps, cfg_scale, ddim_eta, conditioning,
+                    init_image.crop(box), mask_image.crop(box), strength,
+                    mask_blur_radius, seam_size, seam_blur, seam_strength,
+                    seam_steps, tile_size, step_callback,
+                    inpaint_replace, enable_image_debugging,
+                    infill_method = infill_method,
+                    inpaint_width = inpaint_width,
+                    inpaint_height = inpaint_height,
+                    **kwargs
                 )
-            init_filled.paste(init_image, (0,0), init_image.split()[-1])
-
-            # Resize if requested for inpainting
-            if inpaint_width and inpaint_height:
-                init_filled = init_filled.resize((inpaint_width, inpaint_height))
 
-            debug_image(init_filled, "init_filled", debug_status=self.enable_image_debugging)
-            
-            # Create init tensor
-            init_image = self._image_to_tensor(init_filled.convert('RGB'))
-
-        if isinstance(mask_image, PIL.Image.Image):
-            self.pil_mask = mask_image.copy()
-            debug_image(mask_image, "mask_image BEFORE multiply with pil_image", debug_status=self.enable_image_debugging)
-
-            mask_image = ImageChops.multiply(mask_image, self.pil_image.split()[-1].convert('RGB'))
-            self.pil_mask = mask_image
-
-            # Resize if requested for inpainting
-            if inpaint_width and inpaint_height:
-                mask_image = mask_image.resize((inpaint_width, inpaint_height))
+                @torch.no_grad()
+                def make_cropped_image(x_T):
+                    result = init_image.convert('RGB')
+                    result.paste(make_crop(x_T), box[:2])
+                    return result
 
-            debug_image(mask_image, "mask_image AFTER multiply with pil_image", debug_status=self.enable_image_debugging)
-            mask_image = mask_image.resize(
-                (
-                    mask_image.width // downsampling,
-                    mask_image.height // downsampling
-                ),
-                resample=Image.Resampling.NEAREST
-            )
-            mask_image = self._image_to_tensor(mask_image,normalize=False)
+                return make_cropped_image
 
-        self.mask_blur_radius = mask_blur_radius
+        context = self.prepare_context(
+            init_image, mask_image, infill_method, tile_size, mask_blur_radius,
+            inpaint_width, inpaint_height, debug=enable_image_debugging,
+        )
+        # Generator.generate() draws each seed's noise through get_noise() before
+        # calling make_image(), so the init latent is also kept on the generator.
+        # This makes an Inpaint instance serve one request at a time.
+        self.init_latent = context.init_latent
 
         # klms samplers not supported yet, so ignore previous sampler
         if isinstance(sampler,KSampler):
@@ -254,107 +303,140 @@ class Inpaint(Img2Img):
                 f">> Using recommended DDIM sampler for inpainting."
             )
             sampler = DDIMSampler(self.model, device=self.model.device)
-        
-        sampler.make_schedule(
-            ddim_num_steps=steps, ddim_eta=ddim_eta, verbose=False
-        )
-
-        mask_image = mask_image[0][0].unsqueeze(0).repeat(4,1,1).unsqueeze(0)
-        mask_image = repeat(mask_image, '1 ... -> b ...', b=1)
-
-        scope = choose_autocast(self.precision)
-        with scope(self.model.device.type):
-            self.init_latent = self.model.get_first_stage_encoding(
-                self.model.encode_first_stage(init_image)
-            ) # move to latent space
-
-        t_enc   = int(strength * steps)
-        # todo: support cross-attention control
-        uc, c, _ = conditioning
 
-        print(f">> target t_enc is {t_enc} steps")
+        print(f">> target t_enc is {int(strength * steps)} steps")
 
         @torch.no_grad()
         def make_image(x_T):
-            # encode (scaled latent)
-            z_enc = sampler.stochastic_encode(
-                self.init_latent,
-                torch.tensor([t_enc]).to(self.model.device),
-                noise=x_T
-            )
-
-            # to replace masked area with latent noise, weighted by inpaint_replace strength
-            if inpaint_replace > 0.0:
-                print(f'>> inpaint will replace what was under the mask with a strength of {inpaint_replace}')
-                l_noise = self.get_noise(kwargs['width'],kwargs['height'])
-                inverted_mask = 1.0-mask_image  # there will be 1s where the mask is
-                masked_region = (1.0-inpaint_replace) * inverted_mask * z_enc + inpaint_replace * inverted_mask * l_noise
-                z_enc   = z_enc * mask_image + masked_region
-
-            # decode it
-            samples = sampler.decode(
-                z_enc,
-                c,
-                t_enc,
-                img_callback                 = step_callback,
-                unconditional_guidance_scale = cfg_scale,
-                unconditional_conditioning = uc,
-                mask                       = mask_image,
-                init_latent                = self.init_latent
+            result = self.inpaint(
+                context, sampler, steps, strength, cfg_scale, ddim_eta,
+                conditioning, x_T, step_callback, inpaint_replace,
             )
 
-            result = self.sample_to_image(samples)
-
-            # Seam paint if this is our first pass (seam_size set to 0 during seam painting)
+            # Repaint the seam between the original and the inpainted region
             if seam_size > 0:
-                old_image = self.pil_image or init_image
-                old_mask = self.pil_mask or mask_image
-
-                result = self.seam_paint(
-                    result,
-                    seam_size,
-                    seam_blur,
-                    prompt,
-                    sampler,
-                    seam_steps,
-                    cfg_scale,
-                    ddim_eta,
-                    conditioning,
-                    seam_strength,
-                    x_T,
-                    step_callback)
-
-                # Restore original settings
-                self.get_make_image(prompt,sampler,steps,cfg_scale,ddim_eta,
-                       conditioning,
-                       old_image,
-                       old_mask,
-                       strength,
-                       mask_blur_radius, seam_size, seam_blur, seam_strength,
-                       seam_steps, tile_size, step_callback,
-                       inpaint_replace, enable_image_debugging,
-                       inpaint_width = inpaint_width,
-                       inpaint_height = inpaint_height,
-                       infill_method = infill_method,
-                       **kwargs)
+                seam_context = self.seam_context(context, result, seam_size, seam_blur)
+                result = self.inpaint(
+                    seam_context, sampler, seam_steps, seam_strength, cfg_scale, ddim_eta,
+                    conditioning, self.get_latent_noise(seam_context.init_latent), step_callback,
+                )
 
             return result
 
         return make_image
 
+    @torch.no_grad()
+    def inpaint(self, context: 'InpaintContext', sampler, steps, strength, cfg_scale, ddim_eta,
+                conditioning, x_T, step_callback=None, inpaint_replace=0.0) -> Image.Image:
+        '''
+        Runs one inpainting pass over the prepared context and returns the
+        color-corrected image.
+        '''
+        sampler.make_schedule(
+            ddim_num_steps=steps, ddim_eta=ddim_eta, verbose=False
+        )
+        t_enc = int(strength * steps)
+        # todo: support cross-attention control
+        uc, c, _ = conditioning
+
+        # encode (scaled latent)
+        z_enc = sampler.stochastic_encode(
+            context.init_latent,
+            torch.tensor([t_enc]).to(self.model.device),
+            noise=x_T
+        )
+
+        # to replace masked area with latent noise, weighted by inpaint_replace strength
+        if inpaint_replace > 0.0:
+            print(f'>> inpaint will replace what was under the mask with a strength of {inpaint_replace}')
+            l_noise = self.get_latent_noise(context.init_latent)
+            inverted_mask = 1.0-context.mask  # there will be 1s where the mask is
+            masked_region = (1.0-inpaint_replace) * inverted_mask * z_enc + inpaint_replace * inverted_mask * l_noise
+            z_enc   = z_enc * context.mask + masked_region
+
+        # decode it
+        samples = sampler.decode(
+            z_enc,
+            c,
+            t_enc,
+            img_callback                 = step_callback,
+            unconditional_guidance_scale = cfg_scale,
+            unconditional_conditioning = uc,
+            mask                       = context.mask,
+            init_latent                = context.init_latent
+        )
+
+        return self.sample_to_inpainted_image(samples, context)
+
+    def mask_crop_box(self, init_image: Image.Image, mask_image: Image.Image, padding: int) -> tuple:
+        '''
+        Returns the (left, top, right, bottom) box around the region to inpaint
+        - the transparent part of the init image and the black part of the mask -
+        padded with context and grown to a multiple of 64 pixels each way. Returns
+        None if there is nothing to inpaint or the box would cover most of the image.
+        '''
+        keep = np.asarray(mask_image.convert('L'))
+        if init_image.mode == 'RGBA':
+            keep = np.minimum(keep, np.asarray(init_image.getchannel('A')))
+        ys, xs = np.nonzero(keep < 255)
+        if len(xs) == 0:
+            return None
+
+        def span(low, high, size):
+            length = min(size, -(-(high - low) // 64) * 64)
+            low = max(0, min(low - (length - (high - low)) // 2, size - length))
+            return low, low + length
+
+        left, right = span(max(0, xs.min() - padding), min(init_image.width, xs.max() + 1 + padding), init_image.width)
+        top, bottom = span(max(0, ys.min() - padding), min(init_image.height, ys.max() + 1 + padding), init_image.height)
+        if (right - left) * (bottom - top) > 0.8 * init_image.width * init_image.height:
+            return None
+        return (int(left), int(top), int(right), int(bottom))
+
+    def native_inpaint_size(self, width: int, height: int) -> tuple:
+        '''
+        Returns the size, in multiples of 64, to which a crop is scaled up so
+        that its longer side matches the size the model was trained at, or
+        (None, None) if it is already that large.
+        '''
+        native = int(self.model.image_size) * downsampling
+        if max(width, height) >= native:
+            return None, None
+        scale = native / max(width, height)
+        return (
+            max(64, round(width * scale / 64) * 64),
+            max(64, round(height * scale / 64) * 64),
+        )
 
-    def sample_to_image(self, samples)->Image.Image:
+    def sample_to_inpainted_image(self, samples, context: 'InpaintContext')->Image.Image:
         gen_result = super().sample_to_image(samples).convert('RGB')
-        debug_image(gen_result, "gen_result", debug_status=self.enable_image_debugging)
+        debug_image(gen_result, "gen_result", debug_status=context.debug)
+
+        if context.pil_image is None or context.pil_mask is None:
+            return gen_result
 
         # Resize if necessary
-        if self.inpaint_width and self.inpaint_height:
-            gen_result = gen_result.resize(self.pil_image.size)
+        if context.inpaint_size is not None:
+            gen_result = gen_result.resize(context.pil_image.size)
 
-        if self.pil_image is None or self.pil_mask is None:
-            return gen_result
-        
-        corrected_result = super().repaste_and_color_correct(gen_result, self.pil_image, self.pil_mask, self.mask_blur_radius)
-        debug_image(corrected_result, "corrected_result", debug_status=self.enable_image_debugging)
+        corrected_result = super().repaste_and_color_correct(gen_result, context.pil_image, context.pil_mask, context.mask_blur_radius)
+        debug_image(corrected_result, "corrected_result", debug_status=context.debug)
 
         return corrected_result
+
+
+class InpaintContext():
+    '''
+    What Inpaint.prepare_context() derives from one request: the original
+    image and combined mask (for the final color correction), the init
+    latent, the latent-sized mask and whether to show debugging images. It is
+    built once and only read afterwards, so repeated and seam passes can share it.
+    '''
+    def __init__(self, pil_image, pil_mask, init_latent, mask, mask_blur_radius, inpaint_size, debug=False):
+        self.pil_image        = pil_image
+        self.pil_mask         = pil_mask
+        self.init_latent      = init_latent
+        self.mask             = mask
+        self.mask_blur_radius = mask_blur_radius
+        self.inpaint_size     = inpaint_size
+        self.debug            = debug
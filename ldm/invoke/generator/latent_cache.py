@@ -0,0 +1,111 @@
+'''
+ldm.invoke.generator.latent_cache keeps the first stage (VAE) encodings of
+init images, so that img2img, inpaint and embiggen runs over the same image
+can skip the encoder.
+
+Useful exports:
+
+init_latent_cache - the cache shared by all generators
+'''
+import hashlib
+from collections import OrderedDict
+
+import torch
+from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
+
+
+class InitLatentCache():
+    '''
+    A content-addressed LRU cache of encoded init images, bounded by the number
+    of bytes it holds. What is kept is the encoder posterior rather than a sample
+    drawn from it, so each use still draws fresh (seeded) noise and produces
+    exactly the latent that encoding the image again would have produced.
+    '''
+    def __init__(self, max_bytes:int=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.bytes     = 0
+        self.entries   = OrderedDict()
+
+    def configure(self, max_bytes:int=None):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._shrink()
+
+    def encode(self, model, image:torch.Tensor, precision:str):
+        '''
+        Returns model.encode_first_stage(image), using the cached result if the
+        same pixels were encoded before by the same weights, at the same size and
+        precision. Models that do not carry a model_hash are never cached.
+        '''
+        key = self.make_key(model, image, precision)
+        if key is not None and key in self.entries:
+            self.entries.move_to_end(key)
+            return self._to_posterior(self.entries[key])
+
+        posterior = model.encode_first_stage(image)
+        if key is not None:
+            self._remember(key, posterior)
+        return posterior
+
+    def invalidate(self, model_hash:str=None):
+        '''
+        Drop the entries for the indicated model, or all entries if no model is given.
+        '''
+        for key in [k for k in self.entries if model_hash is None or k[0] == model_hash]:
+            self.bytes -= self._size(self.entries.pop(key))
+
+    @classmethod
+    def make_key(cls, model, image:torch.Tensor, precision:str)->tuple:
+        model_hash = getattr(model, 'model_hash', None)
+        if model_hash is None:
+            return None
+        pixels = image.detach().contiguous().cpu()
+        digest = hashlib.sha256(pixels.flatten().view(torch.uint8).numpy().tobytes()).hexdigest()
+        return (
+            model_hash,
+            precision,
+            str(image.device),
+            str(image.dtype),
+            tuple(image.shape),
+            cls._padding_mode(model),
+            torch.is_autocast_enabled(),
+            digest,
+        )
+
+    @classmethod
+    def _padding_mode(cls, model)->tuple:
+        # seamless mode swaps the padding of every conv layer, which changes the encoding
+        for m in model.first_stage_model.modules():
+            if isinstance(m, torch.nn.Conv2d):
+                return tuple(sorted(getattr(m, 'asymmetric_padding_mode', {}).items()))
+        return ()
+
+    def _remember(self, key:tuple, posterior):
+        if isinstance(posterior, DiagonalGaussianDistribution):
+            value = (posterior.parameters.detach(), posterior.deterministic)
+        elif isinstance(posterior, torch.Tensor):
+            value = posterior.detach()
+        else:
+            return
+        if self._size(value) > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.bytes += self._size(value)
+        self._shrink()
+
+    def _shrink(self):
+        while self.bytes > max(self.max_bytes, 0) and len(self.entries) > 0:
+            _, value = self.entries.popitem(last=False)
+            self.bytes -= self._size(value)
+
+    def _to_posterior(self, value):
+        if isinstance(value, tuple):
+            parameters, deterministic = value
+            return DiagonalGaussianDistribution(parameters, deterministic=deterministic)
+        return value
+
+    def _size(self, value)->int:
+        tensor = value[0] if isinstance(value, tuple) else value
+        return tensor.numel() * tensor.element_size()
+
+init_latent_cache = InitLatentCache()
@@ -10,6 +10,8 @@ from ldm.invoke.generator.img2img import Img2Img
 from ldm.invoke.generator.txt2img import Txt2Img
 
 class Omnibus(Img2Img,Txt2Img):
+    supports_batching = False
+
     def __init__(self, model, precision):
         super().__init__(model, precision)
         self.pil_mask = None
@@ -67,9 +69,7 @@ class Omnibus(Img2Img,Txt2Img):
             scope = choose_autocast(self.precision)
 
             with scope(self.model.device.type):
-                self.init_latent = self.model.get_first_stage_encoding(
-                    self.model.encode_first_stage(init_image)
-                ) # move to latent space
+                self.init_latent = self.encode_init_image(init_image) # move to latent space
 
             # create a completely black mask  (1s)
             mask_image = torch.ones(1, 1, init_image.shape[2], init_image.shape[3], device=self.model.device)
@@ -0,0 +1,118 @@
+'''
+ldm.invoke.generator.tiled_txt2img descends from ldm.invoke.generator.txt2img
+and makes images larger than the model was trained on by diffusing
+overlapping windows of the latent (MultiDiffusion).
+'''
+
+import torch
+from contextlib import contextmanager
+from ldm.invoke.generator.txt2img import Txt2Img
+from ldm.invoke.vae_tiling import tile_starts, tile_ramp
+
+
+class TiledTxt2Img(Txt2Img):
+    '''
+    At each step the model predicts the noise for overlapping windows of the
+    size it was trained on, several windows to a batch, and the predictions
+    are averaged with weights that fall off across the overlaps. Memory then
+    grows with the number of windows, that is linearly with the canvas area,
+    rather than quadratically as self-attention over the whole latent does.
+    '''
+    def __init__(self, model, precision):
+        super().__init__(model, precision)
+        self.window_overlap = 0.25    # fraction of a window shared with each neighbour
+
+    @torch.no_grad()
+    def get_make_image(self,prompt,sampler,steps,cfg_scale,ddim_eta,
+                       conditioning,width,height,step_callback=None,threshold=0.0,perlin=0.0,**kwargs):
+        """
+        Returns a function returning an image derived from the prompt
+        Return value depends on the seed at the time you call it
+        """
+        make_image = super().get_make_image(
+            prompt, sampler, steps, cfg_scale, ddim_eta, conditioning, width, height,
+            step_callback=step_callback, threshold=threshold, perlin=perlin, **kwargs
+        )
+
+        extra_conditioning_info = conditioning[2]
+        if extra_conditioning_info is not None and extra_conditioning_info.wants_cross_attention_control:
+            print('>> Tiled diffusion cannot be combined with cross-attention control; sampling the whole image at once')
+            return make_image
+
+        window = int(self.model.image_size)
+
+        @torch.no_grad()
+        def tiled_make_image(x_T):
+            with self.windowed_model(window):
+                return make_image(x_T)
+
+        return tiled_make_image
+
+    @contextmanager
+    def windowed_model(self, window:int):
+        '''
+        Within this context self.model.apply_model() works over overlapping
+        windows of window x window latent pixels, and blends their outputs.
+        '''
+        model       = self.model
+        apply_model = model.apply_model
+        was_patched = 'apply_model' in model.__dict__
+        overlap     = int(window * self.window_overlap)
+
+        def windowed_apply_model(x, t, cond, *args, **kwargs):
+            height, width = x.shape[-2:]
+            if (height <= window and width <= window) or not isinstance(cond, torch.Tensor) or args or kwargs:
+                return apply_model(x, t, cond, *args, **kwargs)
+
+            win_h, win_w = min(window, height), min(window, width)
+            windows = [
+                (top, left)
+                for top in tile_starts(height, win_h, overlap)
+                for left in tile_starts(width, win_w, overlap)
+            ]
+            per_batch = self.windows_per_batch(x.shape[0], win_h, win_w, len(windows))
+
+            output  = None
+            weights = None
+            for start in range(0, len(windows), per_batch):
+                group = windows[start:start+per_batch]
+                result = apply_model(
+                    torch.cat([x[:, :, top:top+win_h, left:left+win_w] for top, left in group]),
+                    t.repeat(len(group)) if t.dim() > 0 else t,
+                    cond.repeat(len(group), *([1] * (cond.dim() - 1))),
+                )
+                if output is None:
+                    output  = torch.zeros(x.shape[0], result.shape[1], height, width, dtype=result.dtype, device=result.device)
+                    weights = torch.zeros(1, 1, height, width, dtype=result.dtype, device=result.device)
+                for (top, left), result_window in zip(group, result.chunk(len(group))):
+                    weight = (
+                        tile_ramp(win_h, overlap, top > 0, top + win_h < height, result)[:, None] *
+                        tile_ramp(win_w, overlap, left > 0, left + win_w < width, result)[None, :]
+                    )
+                    output[:, :, top:top+win_h, left:left+win_w] += result_window * weight
+                    weights[:, :, top:top+win_h, left:left+win_w] += weight
+            return output / weights
+
+        model.apply_model = windowed_apply_model
+        try:
+            yield
+        finally:
+            if was_patched:
+                model.apply_model = apply_model
+            else:
+                del model.apply_model
+
+    def windows_per_batch(self, batch_size:int, win_h:int, win_w:int, count:int)->int:
+        '''
+        Returns how many windows to send through the model at once. On CUDA
+        this is as many as free memory allows, assuming each window of each
+        image costs about as much as the attention scores of the model's
+        highest resolution self-attention layer. Elsewhere it is all of them.
+        '''
+        device = self.model.device
+        if device.type != 'cuda':
+            return count
+        free,_     = torch.cuda.mem_get_info(device)
+        tokens     = win_h * win_w
+        per_window = batch_size * 8 * tokens * tokens * 4
+        return max(1, min(count, free // per_window))
@@ -9,6 +9,8 @@ from ldm.models.diffusion.shared_invokeai_diffusion import InvokeAIDiffuserCompo
 
 
 class Txt2Img(Generator):
+    supports_batching = True
+
     def __init__(self, model, precision):
         super().__init__(model, precision)
 
@@ -25,6 +27,8 @@ class Txt2Img(Generator):
 
         @torch.no_grad()
         def make_image(x_T):
+            batch_size = 1 if x_T is None else x_T.shape[0]
+            batch_uc, batch_c = self.batch_conditioning(uc, c, batch_size)
             shape = [
                 self.latent_channels,
                 height // self.downsampling_factor,
@@ -37,14 +41,14 @@ class Txt2Img(Generator):
             sampler.make_schedule(ddim_num_steps=steps, ddim_eta=ddim_eta, verbose=False)
 
             samples, _ = sampler.sample(
-                batch_size                   = 1,
+                batch_size                   = batch_size,
                 S                            = steps,
                 x_T                          = x_T,
-                conditioning                 = c,
+                conditioning                 = batch_c,
                 shape                        = shape,
                 verbose                      = False,
                 unconditional_guidance_scale = cfg_scale,
-                unconditional_conditioning   = uc,
+                unconditional_conditioning   = batch_uc,
                 extra_conditioning_info      = extra_conditioning_info,
                 eta                          = ddim_eta,
                 img_callback                 = step_callback,
@@ -54,6 +58,8 @@ class Txt2Img(Generator):
             if self.free_gpu_mem:
                 self.model.model.to("cpu")
 
+            if batch_size > 1:
+                return self.samples_to_images(samples)
             return self.sample_to_image(samples)
 
         return make_image
@@ -67,13 +73,13 @@ class Txt2Img(Generator):
                                 self.latent_channels,
                                 height // self.downsampling_factor,
                                 width  // self.downsampling_factor],
-                               device='cpu').to(device)
+                               device='cpu', generator=self.rng('cpu')).to(device)
         else:
             x = torch.randn([1,
                                 self.latent_channels,
                                 height // self.downsampling_factor,
                                 width  // self.downsampling_factor],
-                               device=device)
+                               device=device, generator=self.rng(device))
         if self.perlin > 0.0:
             x = (1-self.perlin)*x + self.perlin*self.get_perlin_noise(width  // self.downsampling_factor, height // self.downsampling_factor)
         return x
@@ -7,33 +7,49 @@ cleared and loaded from disk when next needed.
 
 import torch
 import os
-import io
 import time
 import gc
 import hashlib
+import itertools
 import psutil
 import sys
 import transformers
 import traceback
 import textwrap
 import contextlib
-from typing import Union
+from concurrent.futures import Future, ThreadPoolExecutor
 from omegaconf import OmegaConf
 from omegaconf.errors import ConfigAttributeError
-from ldm.util import instantiate_from_config, ask_user
+from ldm.util import instantiate_from_config, ask_user, no_weight_init
 from ldm.invoke.globals import Globals
-from picklescan.scanner import scan_file_path
+from ldm.invoke.weights_index import weights_index
 
 DEFAULT_MAX_MODELS=2
 
+# submodules whose weights are often identical across checkpoints, and are shared between cached models when they are
+SHARED_SUBMODULES=('cond_stage_model','first_stage_model')
+
 class ModelCache(object):
-    def __init__(self, config:OmegaConf, device_type:str, precision:str, max_loaded_models=DEFAULT_MAX_MODELS):
+    def __init__(self, config:OmegaConf, device_type:str, precision:str, max_loaded_models=DEFAULT_MAX_MODELS,
+                 max_ram_bytes:int=None, max_vram_bytes:int=None, converted_dir:str=None):
         '''
         Initialize with the path to the models.yaml config file,
-        the torch device type, and precision. The optional
-        min_avail_mem argument specifies how much unused system
-        (CPU) memory to preserve. The cache of models in RAM will
-        grow until this value is approached. Default is 2G.
+        the torch device type, and precision. Without a memory budget
+        at most max_loaded_models models are kept, and only the active
+        one is on the GPU.
+
+        max_ram_bytes, if given, replaces max_loaded_models: models are
+        kept in system RAM as long as their parameters and buffers fit
+        in this many bytes. max_vram_bytes, if given, lets inactive models
+        stay on the GPU while they fit in this many bytes, so switching
+        back to them does not move them at all. Either way the least
+        recently used models make way first: on the GPU they are offloaded
+        to RAM, in RAM they are dropped.
+
+        converted_dir, if given, is where the weights of each model are
+        saved after their first load: pruned to the model's own state
+        dict, in the working precision and with the VAE merged in, as
+        safetensors. Later loads memory-map that file instead.
         '''
         # prevent nasty-looking CLIP log message
         transformers.logging.set_verbosity_error()
@@ -41,9 +57,16 @@ class ModelCache(object):
         self.precision = precision
         self.device = torch.device(device_type)
         self.max_loaded_models = max_loaded_models
+        self.max_ram_bytes = max_ram_bytes
+        self.max_vram_bytes = max_vram_bytes
+        self.converted_dir = converted_dir
         self.models = {}
         self.stack = []  # this is an LRU FIFO
         self.current_model = None
+        self.model_bytes = {}  # model name -> total bytes when last loaded
+        self.stats = dict(hits=0, misses=0, prefetches=0, offloads=0, evictions=0)
+        self.prefetcher = None
+        self.prefetching = {}  # model name -> Future of a model being loaded in the background
 
     def valid_model(self, model_name:str)->bool:
         '''
@@ -62,20 +85,27 @@ class ModelCache(object):
             print(f'** "{model_name}" is not a known model name. Please check your models.yaml file')
             return self.current_model
 
+        self._adopt_prefetched_model(model_name)
+
         if self.current_model != model_name:
+            self._make_device_room(model_name)
             if model_name not in self.models: # make room for a new one
-                self._make_cache_room()
-            self.offload_model(self.current_model)
+                self._make_cache_room(model_name)
         
         if model_name in self.models:
+            self.stats['hits'] += 1
             requested_model = self.models[model_name]['model']
-            print(f'>> Retrieving model {model_name} from system RAM cache')
+            if self._device_bytes(requested_model) > 0:
+                print(f'>> Retrieving model {model_name} from VRAM cache')
+            else:
+                print(f'>> Retrieving model {model_name} from system RAM cache')
             self.models[model_name]['model'] = self._model_from_cpu(requested_model)
             width = self.models[model_name]['width']
             height = self.models[model_name]['height']
             hash = self.models[model_name]['hash']
 
         else: # we're about to load a new model, so potentially offload the least recently used one
+            self.stats['misses'] += 1
             try:
                 requested_model, width, height, hash = self._load_model(model_name)
                 self.models[model_name] = {
@@ -84,6 +114,10 @@ class ModelCache(object):
                     'height': height,
                     'hash': hash,
                 }
+                self.model_bytes[model_name] = sum(self._tensor_bytes(requested_model).values())
+                # now that its real size is known, check the budgets again
+                self._make_device_room(model_name)
+                self._make_cache_room(model_name)
 
             except Exception as e:
                 print(f'** model {model_name} could not be loaded: {str(e)}')
@@ -102,6 +136,30 @@ class ModelCache(object):
             'hash': hash
         }
 
+    def prefetch(self, model_name:str) -> Future:
+        '''
+        Starts loading the named model into system RAM on a background thread,
+        while the current model stays in use. The next get_model() call for it
+        waits for the load to finish, if need be, and then takes the model into
+        the cache. Returns the Future of the load, or None if there is nothing
+        to prefetch or the model would not fit in the cache even with every
+        model but the current one evicted.
+        '''
+        if not self.valid_model(model_name) or model_name in self.models:
+            return None
+        if model_name in self.prefetching:
+            return self.prefetching[model_name]
+        if not self._make_prefetch_room(model_name):
+            print(f'>> Not enough room in the model cache to prefetch {model_name}')
+            return None
+
+        if self.prefetcher is None:
+            self.prefetcher = ThreadPoolExecutor(1, thread_name_prefix='prefetch')
+        print(f'>> Prefetching {model_name} in the background')
+        future = self.prefetcher.submit(self._prefetch_model, model_name)
+        self.prefetching[model_name] = future
+        return future
+
     def default_model(self) -> str:
         '''
         Returns the name of the default model, or None
@@ -161,6 +219,9 @@ class ModelCache(object):
             if models[name]['status'] == 'active':
                 line = f'\033[1m{line}\033[0m'
             print(line)
+        print(f'>> Model cache: {self.stats["hits"]} hits, {self.stats["misses"]} misses, '
+              f'{self.stats["prefetches"]} prefetches, {self.stats["offloads"]} offloads, '
+              f'{self.stats["evictions"]} evictions')
 
     def del_model(self, model_name:str) -> None:
         '''
@@ -192,8 +253,10 @@ class ModelCache(object):
         if clobber:
             self._invalidate_cached_model(model_name)
     
-    def _load_model(self, model_name:str):
+    def _load_model(self, model_name:str, device:torch.device=None):
         """Load and initialize the model from configuration variables passed at object creation time"""
+        device = device or self.device
+        to_gpu = self._has_cuda() and device == self.device
         if model_name not in self.config:
             print(f'"{model_name}" is not a known model name. Please check your models.yaml file')
 
@@ -204,15 +267,14 @@ class ModelCache(object):
         width = mconfig.width
         height = mconfig.height
 
-        if not os.path.isabs(weights):
-            weights = os.path.normpath(os.path.join(Globals.root,weights))
+        weights = self._weights_path(model_name)
         # scan model
         self.scan_model(model_name, weights)
 
         print(f'>> Loading {model_name} from {weights}')
 
         # for usage statistics
-        if self._has_cuda():
+        if to_gpu:
             torch.cuda.reset_peak_memory_stats()
             torch.cuda.empty_cache()
 
@@ -222,36 +284,64 @@ class ModelCache(object):
         if not os.path.isabs(config):
             config = os.path.join(Globals.root,config)
         omega_config = OmegaConf.load(config)
-        with open(weights,'rb') as f:
-            weight_bytes = f.read()
-        model_hash  = self._cached_sha256(weights,weight_bytes)
-        sd = torch.load(io.BytesIO(weight_bytes), map_location='cpu')
-        del weight_bytes
-        sd = sd['state_dict']
-        model = instantiate_from_config(omega_config.model)
-        model.load_state_dict(sd, strict=False)
+        model_hash  = weights_index.sha256(weights)
+        if vae and not os.path.isabs(vae):
+            vae = os.path.normpath(os.path.join(Globals.root,vae))
+
+        # weights already pruned, converted and merged with the VAE on an earlier load
+        converted = self._converted_path(model_name, model_hash, vae) if self.converted_dir else None
+        use_converted = converted is not None and os.path.exists(converted)
+        sd = None
+        if use_converted:
+            print(f'   | Using converted weights from {converted}')
+            try:
+                sd = self._load_state_dict(converted)
+            except Exception as e:
+                print(f'** Converted weights {converted} could not be read ({str(e)}); loading the original weights')
+                with contextlib.suppress(OSError):
+                    os.remove(converted)
+                use_converted = False
+        if sd is None:
+            sd = self._load_state_dict(weights)
 
         if self.precision == 'float16':
             print('   | Using faster float16 precision')
-            model.to(torch.float16)
         else:
             print('   | Using more accurate float32 precision')
 
+        # the random initial weights would only be overwritten by the checkpoint
+        with no_weight_init():
+            model = self._instantiate_model(omega_config)
+        load_result = model.load_state_dict(sd, strict=False)
+        missing = self._missing_parameters(model, load_result)
+        if len(missing) > 0:
+            print(f'   | {len(missing)} parameters are not in the checkpoint; initializing the model in full')
+            model = self._instantiate_model(omega_config)
+            model.load_state_dict(sd, strict=False)
+        elif any(key.startswith('embedding_manager.') for key in load_result.missing_keys):
+            self._rebuild_embedding_manager(model, omega_config)
+        del sd
+
         # look and load a matching vae file. Code borrowed from AUTOMATIC1111 modules/sd_models.py
-        if vae:
-            if not os.path.isabs(vae):
-                vae = os.path.normpath(os.path.join(Globals.root,vae))
+        if vae and not use_converted:
             if os.path.exists(vae):
                 print(f'   | Loading VAE weights from: {vae}')
-                vae_ckpt = torch.load(vae, map_location="cpu")
-                vae_dict = {k: v for k, v in vae_ckpt["state_dict"].items() if k[0:4] != "loss"}
+                vae_ckpt = self._load_state_dict(vae)
+                vae_dict = {k: v for k, v in vae_ckpt.items() if k[0:4] != "loss"}
                 model.first_stage_model.load_state_dict(vae_dict, strict=False)
             else:
                 print(f'   | VAE file {vae} not found. Skipping.')
 
-        model.to(self.device)
+        if converted is not None and not use_converted:
+            self._save_converted(model, converted)
+
+        # identifies the loaded weights to caches keyed on model output, such as the init latent cache
+        # the VAE's contents rather than its path, so a VAE replaced in place is not mistaken for the old one
+        model.model_hash = f'{model_hash}:{weights_index.sha256(vae)}' if vae and os.path.exists(vae) else model_hash
+
+        model.to(device)
         # model.to doesn't change the cond_stage_model.device used to move the tokenizer output, so set it here
-        model.cond_stage_model.device = self.device
+        model.cond_stage_model.device = device
         
         model.eval()
 
@@ -263,7 +353,7 @@ class ModelCache(object):
         toc = time.time()
         print(f'>> Model loaded in', '%4.2fs' % (toc - tic))
 
-        if self._has_cuda():
+        if to_gpu:
             print(
                 '>> Max VRAM used to load the model:',
                 '%4.2fG' % (torch.cuda.max_memory_allocated() / 1e9),
@@ -283,16 +373,55 @@ class ModelCache(object):
 
         print(f'>> Offloading {model_name} to CPU')
         model = self.models[model_name]['model']
+        if self._device_bytes(model) > 0:
+            self.stats['offloads'] += 1
         self.models[model_name]['model'] = self._model_to_cpu(model)
+        self._share_weights(model_name)
 
         gc.collect()
         if self._has_cuda():
             torch.cuda.empty_cache()
     
+    def _prefetch_model(self, model_name:str):
+        # a model that fails the scan is left to get_model(), which asks the user what to do
+        scan_result = weights_index.scan(self._weights_path(model_name))
+        if scan_result.infected_files != 0:
+            print(f'** {model_name} did not pass the model scan and will not be prefetched')
+            return None
+        return self._load_model(model_name, device=torch.device('cpu'))
+
+    def _adopt_prefetched_model(self, model_name:str) -> None:
+        '''
+        Takes a model loaded by prefetch() into the cache, making room for it first.
+        '''
+        future = self.prefetching.pop(model_name, None)
+        if future is None:
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f'** model {model_name} could not be prefetched: {str(e)}')
+            return
+        if result is None:
+            return
+
+        model, width, height, hash = result
+        self.model_bytes[model_name] = sum(self._tensor_bytes(model).values())
+        self._make_cache_room(model_name)
+        self.models[model_name] = {
+            'model': model,
+            'width': width,
+            'height': height,
+            'hash': hash,
+        }
+        self.stats['prefetches'] += 1
+
     def scan_model(self, model_name, checkpoint):
         # scan model
+        if self._is_safetensors(checkpoint):
+            return    # safetensors files hold no pickled code to scan for
         print(f'>> Scanning Model: {model_name}')
-        scan_result = scan_file_path(checkpoint)
+        scan_result = weights_index.scan(checkpoint)
         if scan_result.infected_files != 0:
             if scan_result.infected_files == 1:
                 print(f'\n### Issues Found In Model: {scan_result.issues_count}')
@@ -310,14 +439,201 @@ class ModelCache(object):
         else:
             print('>> Model Scanned. OK!!')
 
-    def _make_cache_room(self) -> None:
-        num_loaded_models = len(self.models)
-        if num_loaded_models >= self.max_loaded_models:
-            least_recent_model = self._pop_oldest_model()
-            print(f'>> Cache limit (max={self.max_loaded_models}) reached. Purging {least_recent_model}')
-            if least_recent_model is not None:
-                del self.models[least_recent_model]
-                gc.collect()
+    def _make_cache_room(self, model_name:str) -> None:
+        '''
+        Drops the least recently used models until the named one, which is
+        about to be loaded or has just been, fits.
+        '''
+        if self.max_ram_bytes is None:
+            num_loaded_models = len(self.models)
+            if model_name not in self.models and num_loaded_models >= self.max_loaded_models:
+                least_recent_model = self._pop_oldest_model()
+                print(f'>> Cache limit (max={self.max_loaded_models}) reached. Purging {least_recent_model}')
+                if least_recent_model is not None:
+                    del self.models[least_recent_model]
+                    self.stats['evictions'] += 1
+                    gc.collect()
+            return
+
+        # a new model is loaded into RAM before it moves to the GPU
+        incoming = 0 if model_name in self.models else self._expected_bytes(model_name)
+        for victim in [m for m in self.stack if m != model_name and m in self.models]:
+            used = self._ram_used()
+            if used + incoming <= self.max_ram_bytes:
+                break
+            if self._ram_freed_by(victim) == 0:
+                continue    # on the GPU, or all its weights are shared with models that stay
+            self._evict_model(victim, f'{self.max_ram_bytes/1e9:4.2f}G of RAM')
+
+    def _make_prefetch_room(self, model_name:str) -> bool:
+        '''
+        Drops the least recently used models other than the current one until
+        the named model, and those already being prefetched, fit alongside the
+        cached models. Returns False if they do not fit even so.
+        '''
+        victims = [m for m in self.stack if m != self.current_model and m in self.models]
+        if self.max_ram_bytes is None:
+            while len(self.models) + len(self.prefetching) >= self.max_loaded_models:
+                if len(victims) == 0:
+                    return False
+                self._evict_model(victims.pop(0), f'max={self.max_loaded_models}')
+            return True
+
+        incoming = sum(self._expected_bytes(m) for m in [model_name, *self.prefetching])
+        for victim in victims:
+            if self._ram_used() + incoming <= self.max_ram_bytes:
+                break
+            if self._ram_freed_by(victim) == 0:
+                continue    # on the GPU, or all its weights are shared with models that stay
+            self._evict_model(victim, f'{self.max_ram_bytes/1e9:4.2f}G of RAM')
+        return self._ram_used() + incoming <= self.max_ram_bytes
+
+    def _evict_model(self, model_name:str, limit:str) -> None:
+        print(f'>> Cache limit ({limit}) reached. Purging {model_name}')
+        with contextlib.suppress(ValueError):
+            self.stack.remove(model_name)
+        del self.models[model_name]
+        self.stats['evictions'] += 1
+        gc.collect()
+
+    def _make_device_room(self, model_name:str) -> None:
+        '''
+        Offloads the least recently used models other than the named one to
+        the CPU until the named one fits in the VRAM budget. Without a
+        budget, offloads the active model, so only one model is on the GPU.
+        '''
+        if self.device.type == 'cpu':
+            return
+        if self.max_vram_bytes is None:
+            if self.current_model != model_name:
+                self.offload_model(self.current_model)
+            return
+
+        model = self.models.get(model_name, {}).get('model')
+        needed = self._expected_bytes(model_name) - (self._device_bytes(model) if model is not None else 0)
+        for victim in [m for m in self.stack if m != model_name and m in self.models]:
+            used = sum(self._device_bytes(self.models[m]['model']) for m in self.models)
+            if used + needed <= self.max_vram_bytes:
+                break
+            if self._device_bytes(self.models[victim]['model']) > 0:
+                self.offload_model(victim)
+
+    def _expected_bytes(self, model_name:str) -> int:
+        '''
+        Bytes the named model takes up: as measured when it was last loaded,
+        or else estimated from the size of its weights file.
+        '''
+        if model_name in self.model_bytes:
+            return self.model_bytes[model_name]
+        try:
+            return os.path.getsize(self._weights_path(model_name))
+        except OSError:
+            return 0
+
+    def _tensor_bytes(self, model) -> dict:
+        '''
+        Returns the bytes taken by the model's parameters and buffers on each device type.
+        '''
+        sizes = {}
+        for tensor in itertools.chain(model.parameters(), model.buffers()):
+            sizes[tensor.device.type] = sizes.get(tensor.device.type, 0) + tensor.numel() * tensor.element_size()
+        return sizes
+
+    def _ram_used(self) -> int:
+        '''
+        Bytes of system RAM taken by the cached models, counting shared weights once.
+        '''
+        used = {}
+        for entry in self.models.values():
+            used.update(self._cpu_data_ptrs(entry['model']))
+        return sum(used.values())
+
+    def _ram_freed_by(self, model_name:str) -> int:
+        '''
+        Bytes of system RAM that dropping the named model would free: those of
+        its weights in RAM that no other cached model shares.
+        '''
+        others = set()
+        for name, entry in self.models.items():
+            if name != model_name:
+                others.update(self._cpu_data_ptrs(entry['model']))
+        freed = 0
+        for data_ptr, size in self._cpu_data_ptrs(self.models[model_name]['model']).items():
+            if data_ptr not in others:
+                freed += size
+        return freed
+
+    def _cpu_data_ptrs(self, model) -> dict:
+        '''
+        Maps the data pointer of each of the model's tensors in system RAM to its size in bytes.
+        '''
+        return {
+            tensor.data_ptr(): tensor.numel() * tensor.element_size()
+            for tensor in itertools.chain(model.parameters(), model.buffers())
+            if tensor.device.type == 'cpu'
+        }
+
+    def _weights_digest(self, param) -> str:
+        '''
+        Returns a digest of the parameter's dtype, shape and contents, hashing
+        it on first use. The digest is kept on the Parameter object, so it
+        follows the parameter across devices, and is absent from any parameter
+        that replaces it later, such as a token embedding resized to hold
+        textual inversion terms.
+        '''
+        digest = getattr(param, 'weights_digest', None)
+        if digest is None:
+            data = param.detach().cpu().contiguous()
+            sha = hashlib.sha256(data.flatten().view(torch.uint8).numpy())
+            digest = param.weights_digest = f'{data.dtype}:{tuple(data.shape)}:{sha.hexdigest()}'
+        return digest
+
+    def _share_weights(self, model_name:str) -> None:
+        '''
+        Points the parameters of the named model's shareable submodules at the
+        identical weights of other models in system RAM, freeing its own copy.
+        Only inactive models in RAM ever share: the active model's weights are
+        always its own copy on the GPU, so nothing done during inference can
+        change the weights of another model. Parameters are only hashed when
+        another model in RAM has one of the same dtype and shape.
+        '''
+        if self.device.type == 'cpu':
+            return    # the models are used in place, so they could not be kept apart
+        candidates = {}
+        for name, entry in self.models.items():
+            if name == model_name:
+                continue
+            for submodule in SHARED_SUBMODULES:
+                for param in getattr(entry['model'], submodule).parameters():
+                    if param.device.type == 'cpu':
+                        candidates.setdefault((param.dtype, tuple(param.shape)), []).append(param)
+        if len(candidates) == 0:
+            return
+
+        saved = 0
+        model = self.models[model_name]['model']
+        for submodule in SHARED_SUBMODULES:
+            for param in getattr(model, submodule).parameters():
+                if param.device.type != 'cpu':
+                    continue
+                for other in candidates.get((param.dtype, tuple(param.shape)), []):
+                    if other.data_ptr() == param.data_ptr():
+                        break
+                    if self._weights_digest(other) == self._weights_digest(param):
+                        param.data = other.data
+                        saved += param.numel() * param.element_size()
+                        break
+        if saved > 0:
+            print(f'>> {model_name} shares {saved/1e9:4.2f}G of weights with other cached models')
+
+    def _device_bytes(self, model) -> int:
+        return self._tensor_bytes(model).get(self.device.type, 0) if self.device.type != 'cpu' else 0
+
+    def _weights_path(self, model_name:str) -> str:
+        weights = self.config[model_name].weights
+        if not os.path.isabs(weights):
+            weights = os.path.normpath(os.path.join(Globals.root,weights))
+        return weights
         
     def print_vram_usage(self) -> None:
         if self._has_cuda:
@@ -353,9 +669,14 @@ class ModelCache(object):
         if model_name in self.stack:
             self.stack.remove(model_name)
         self.models.pop(model_name,None)
+        self.model_bytes.pop(model_name,None)
+        self.prefetching.pop(model_name,None)
         
     def _model_to_cpu(self,model):
         if self.device != 'cpu':
+            # the cached empty-prompt embeddings would keep GPU memory in use
+            if hasattr(model.cond_stage_model, 'empty_embeddings'):
+                model.cond_stage_model.empty_embeddings.clear()
             model.cond_stage_model.device = 'cpu'
             model.first_stage_model.to('cpu')
             model.cond_stage_model.to('cpu') 
@@ -392,25 +713,113 @@ class ModelCache(object):
     def _has_cuda(self) -> bool:
         return self.device.type == 'cuda'
 
-    def _cached_sha256(self,path,data) -> Union[str, bytes]:
-        dirname    = os.path.dirname(path)
-        basename   = os.path.basename(path)
-        base, _    = os.path.splitext(basename)
-        hashpath   = os.path.join(dirname,base+'.sha256')
+    def _load_state_dict(self,path:str) -> dict:
+        '''
+        Returns the state dict in the weights file at path, leaving its tensors
+        on the CPU. .safetensors files are memory-mapped, so tensors are paged
+        in as the model copies them. Pickled checkpoints are read straight from
+        the file rather than from a copy of it in memory, and memory-mapped
+        too when the installed torch supports it.
+        '''
+        if self._is_safetensors(path):
+            try:
+                from safetensors.torch import load_file
+            except ImportError:
+                raise ImportError(f'** {path} is a safetensors file. Please "pip install safetensors" to load it.')
+            return load_file(path, device='cpu')
+
+        try:
+            sd = torch.load(path, map_location='cpu', mmap=True)
+        except (TypeError, RuntimeError):
+            # older torch, or a checkpoint in the legacy (non-zip) format
+            sd = torch.load(path, map_location='cpu')
+        return sd.get('state_dict', sd)
+
+    def convert_model(self, model_name:str) -> str:
+        '''
+        Writes the converted weights of the named model to the converted
+        weights directory, unless they are there already, and returns their path.
+        '''
+        assert self.converted_dir, 'no directory for converted weights was given'
+        weights = self._weights_path(model_name)
+        vae = self.config[model_name].get('vae')
+        if vae and not os.path.isabs(vae):
+            vae = os.path.normpath(os.path.join(Globals.root,vae))
+        converted = self._converted_path(model_name, weights_index.sha256(weights), vae)
+        if os.path.exists(converted):
+            print(f'>> {model_name} is already converted: {converted}')
+        else:
+            model = self._load_model(model_name, device=torch.device('cpu'))[0]
+            del model
+            gc.collect()
+        return converted
+
+    def _instantiate_model(self, omega_config):
+        model = instantiate_from_config(omega_config.model)
+        if self.precision == 'float16':
+            # casting first means the checkpoint is converted as it is copied in
+            model.to(torch.float16)
+        return model
 
-        if os.path.exists(hashpath) and os.path.getmtime(path) <= os.path.getmtime(hashpath):
-            with open(hashpath) as f:
-                hash = f.read()
-            return hash
+    def _converted_path(self, model_name:str, model_hash:str, vae:str) -> str:
+        '''
+        Where the converted weights of the model go. They depend on the hash of
+        the weights file, the precision and the hash of the VAE file, if any.
+        '''
+        vae_hash = weights_index.sha256(vae)[:16] if vae and os.path.exists(vae) else 'novae'
+        converted_dir = self.converted_dir
+        if not os.path.isabs(converted_dir):
+            converted_dir = os.path.join(Globals.root,converted_dir)
+        return os.path.join(converted_dir, f'{model_name}-{model_hash[:16]}-{self.precision}-{vae_hash}.safetensors')
 
-        print(f'>> Calculating sha256 hash of weights file')
-        tic = time.time()
-        sha = hashlib.sha256()
-        sha.update(data)
-        hash = sha.hexdigest()
-        toc = time.time()
-        print(f'>> sha256 = {hash}','(%4.2fs)' % (toc - tic))
+    def _save_converted(self, model, path:str) -> None:
+        '''
+        Saves the model's own state dict, without the EMA, optimizer and other
+        training state of the checkpoint, as a safetensors file.
+        '''
+        try:
+            from safetensors.torch import save_file
+        except ImportError:
+            print('** Converted weights are saved in safetensors format. Please "pip install safetensors" to use them.')
+            return
+        print(f'   | Saving converted weights to {path}')
+        tmpfile = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            save_file({k: v.contiguous() for k, v in model.state_dict().items()}, tmpfile)
+            os.replace(tmpfile, path)
+        except Exception as e:
+            print(f'** Could not save converted weights to {path}: {str(e)}')
+            with contextlib.suppress(OSError):
+                os.remove(tmpfile)
+
+    def _missing_parameters(self,model,load_result) -> list:
+        '''
+        Returns the names of the model's parameters that load_state_dict() did
+        not find. Missing buffers do not count, as they are not left uninitialized,
+        and neither does the embedding manager, which checkpoints never contain
+        and _rebuild_embedding_manager() derives from the loaded text encoder.
+        '''
+        parameters = {name for name, _ in model.named_parameters()}
+        return [key for key in load_result.missing_keys
+                if key in parameters and not key.startswith('embedding_manager.')]
+
+    def _rebuild_embedding_manager(self, model, omega_config) -> None:
+        '''
+        The embedding manager's initial embeddings are copied from the text
+        encoder when it is constructed, which under no_weight_init() is before
+        the encoder has its weights. Builds it again now that it does.
+        '''
+        personalization_config = omega_config.model.params.get('personalization_config')
+        if personalization_config is None:
+            return
+        model.embedding_manager = model.instantiate_embedding_manager(
+            personalization_config, model.cond_stage_model
+        )
+        for param in model.embedding_manager.embedding_parameters():
+            param.requires_grad = True
+        if self.precision == 'float16':
+            model.embedding_manager.to(torch.float16)
 
-        with open(hashpath,'w') as f:
-            f.write(hash)
-        return hash
+    def _is_safetensors(self,path:str) -> bool:
+        return os.path.splitext(path)[1].lower() == '.safetensors'
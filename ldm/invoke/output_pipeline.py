@@ -0,0 +1,106 @@
+'''
+ldm.invoke.output_pipeline moves the work of writing finished images to
+disk (PNG compression, metadata, thumbnails) off the generation thread.
+
+Writes run on a small thread pool. Their completion callbacks are run in
+submission order on the thread that submits and flushes, so callers can
+report file paths in the order the images were made, and callbacks that
+are not thread-safe (such as socketio emits) are safe to use.
+
+Useful exports:
+
+OutputPipeline
+'''
+import atexit
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class OutputPipeline():
+    def __init__(self, max_workers:int=2, max_pending:int=None):
+        '''
+        max_workers is the number of writer threads, 0 to write synchronously.
+        submit() blocks while max_pending writes (default twice the number of
+        workers) are still in flight, so that images cannot pile up in memory
+        faster than they can be written.
+        '''
+        self.max_workers = max_workers
+        self.max_pending = max_pending or 2 * max(max_workers, 1)
+        self.executor    = ThreadPoolExecutor(max_workers, thread_name_prefix='output') if max_workers > 0 else None
+        self.pending     = []    # (future, callback, error_callback, key) in submission order
+        atexit.register(self.shutdown)
+
+    def submit(self, task, args:tuple=(), kwargs:dict=None, callback=None, error_callback=None, key:str=None):
+        '''
+        Runs task(*args, **kwargs) in the background. callback, if given, is called
+        with the task's return value once it and every earlier task are done. If
+        the task fails, the error is reported and error_callback, if given, is
+        called with the exception instead, so that callers only report outputs
+        that were written. Tasks sharing a key (such as an output path) never
+        overlap. Anything passed to the task, images included, must not be
+        modified afterwards.
+        '''
+        kwargs = kwargs or {}
+        self.dispatch()
+        if self.executor is None:
+            future = Future()
+            try:
+                future.set_result(task(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            self._complete((future, callback, error_callback, key))
+            return
+
+        if key is not None and any(k == key for _, _, _, k in self.pending):
+            self.flush(key=key)
+        while len(self.pending) >= self.max_pending:
+            self._complete(self.pending.pop(0))
+
+        future = self.executor.submit(task, *args, **kwargs)
+        self.pending.append((future, callback, error_callback, key))
+
+    def dispatch(self):
+        '''
+        Runs the callbacks of the writes that have finished, stopping at the
+        first write that is still in flight so that callbacks stay in order.
+        '''
+        while len(self.pending) > 0 and self.pending[0][0].done():
+            self._complete(self.pending.pop(0))
+
+    def flush(self, key:str=None):
+        '''
+        Waits for all pending writes and runs their callbacks. If a key is given,
+        only waits until the last write with that key, and those before it, are done.
+        '''
+        if key is not None:
+            keys = [k for _, _, _, k in self.pending]
+            if key not in keys:
+                return
+            last = len(keys) - 1 - keys[::-1].index(key)
+            for _ in range(last + 1):
+                self._complete(self.pending.pop(0))
+            return
+        while len(self.pending) > 0:
+            self._complete(self.pending.pop(0))
+
+    def pending_keys(self)->list:
+        return [k for _, _, _, k in self.pending if k is not None]
+
+    def shutdown(self):
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def _complete(self, entry):
+        future, callback, error_callback, key = entry
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f'** Could not write {key or "output"}: {str(e)}')
+            traceback.print_exc()
+            if error_callback is not None:
+                error_callback(e)
+            return
+        if callback is not None:
+            callback(result)
@@ -19,10 +19,13 @@ class PngWriter:
         self.outdir = outdir
         os.makedirs(outdir, exist_ok=True)
 
-    # gives the next unique prefix in outdir
-    def unique_prefix(self):
+    # gives the next unique prefix in outdir, also counting any
+    # pending (not yet written) paths that are passed in
+    def unique_prefix(self, pending=()):
+        outdir = os.path.abspath(self.outdir)
+        pending = [os.path.basename(p) for p in pending if os.path.dirname(os.path.abspath(p)) == outdir]
         # sort reverse alphabetically until we find max+1
-        dirlist = sorted(os.listdir(self.outdir), reverse=True)
+        dirlist = sorted(os.listdir(self.outdir) + pending, reverse=True)
         # find the first filename that matches our pattern or return 000000.0.png
         existing_name = next(
             (f for f in dirlist if re.match('^(\d+)\..*\.png', f)),
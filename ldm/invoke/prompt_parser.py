@@ -1,4 +1,7 @@
+import copy
+import functools
 import string
+from collections import OrderedDict
 from typing import Union, Optional
 import re
 import pyparsing as pp
@@ -255,8 +258,13 @@ class PromptParser():
         def __init__(self, operator:str):
             super().__init__("Unrecognized operator: " + operator)
 
+    # flattened parse results shared by all PromptParsers, keyed on (attention bases, prompt string)
+    parse_cache = OrderedDict()
+    parse_cache_size = 256
+
     def __init__(self, attention_plus_base=1.1, attention_minus_base=0.9):
 
+        self.attention_bases = (attention_plus_base, attention_minus_base)
         self.conjunction, self.prompt = build_parser_syntax(attention_plus_base, attention_minus_base)
 
 
@@ -270,12 +278,24 @@ class PromptParser():
         if len(prompt.strip()) == 0:
             return Conjunction(prompts=[FlattenedPrompt([('', 1.0)])], weights=[1.0])
 
+        key = (self.attention_bases, prompt)
+        cache = PromptParser.parse_cache
+        if key in cache:
+            cache.move_to_end(key)
+            # callers are free to modify what they get back, so hand out a copy
+            return copy.deepcopy(cache[key])
+
         root = self.conjunction.parse_string(prompt)
         #print(f"'{prompt}' parsed to root", root)
         #fused = fuse_fragments(parts)
         #print("fused to", fused)
 
-        return self.flatten(root[0])
+        flattened = self.flatten(root[0])
+        if PromptParser.parse_cache_size > 0:
+            cache[key] = copy.deepcopy(flattened)
+            while len(cache) > PromptParser.parse_cache_size:
+                cache.popitem(last=False)
+        return flattened
 
     def parse_legacy_blend(self, text: str) -> Optional[Blend]:
         weighted_subprompts = split_weighted_subprompts(text, skip_normalize=False)
@@ -371,7 +391,19 @@ class PromptParser():
 
 
 
+# The grammar backtracks a lot over nested attention and blends; memoizing
+# (expression, location) results keeps long prompts from going exponential.
+# Packrat parsing is a pyparsing-wide setting, so it is switched on once here,
+# on import, rather than each time a grammar is built.
+pp.ParserElement.enable_packrat()
+
+@functools.lru_cache(maxsize=8)
 def build_parser_syntax(attention_plus_base: float, attention_minus_base: float):
+    '''
+    Builds the pyparsing grammar for the given attention bases. The grammar is
+    expensive to build and holds no per-parse state, so it is built once per pair
+    of bases and shared by every PromptParser.
+    '''
     def make_operator_object(x):
         #print('making operator for', x)
         target = x[0]
@@ -24,7 +24,7 @@ except (ImportError,ModuleNotFoundError) as e:
     readline_available = False
 
 IMG_EXTENSIONS     = ('.png','.jpg','.jpeg','.PNG','.JPG','.JPEG','.gif','.GIF')
-WEIGHT_EXTENSIONS  = ('.ckpt','.bae')
+WEIGHT_EXTENSIONS  = ('.ckpt','.safetensors','.bae')
 TEXT_EXTENSIONS  = ('.txt','.TXT')
 CONFIG_EXTENSIONS  = ('.yaml','.yml')
 COMMANDS = (
@@ -31,7 +31,43 @@ class Outcrop(object):
             preferred_seed = orig_opt.seed if orig_opt.seed is not None and orig_opt.seed >= 0 else seed
             image_callback(img,preferred_seed,use_prefix=prefix,**kwargs)
 
-        result= self.generate.prompt2image(
+        callback = wrapped_callback if image_callback else None
+
+        # all sides are outpainted together in one pass over the expanded canvas
+        result = self._outpaint(extended_image, opt, orig_opt, callback)
+
+        # if that did not work out (most likely the whole canvas does not fit in
+        # memory), extend one side at a time, diffusing only the new strip
+        if len(result) == 0 and len(extents) > 1:
+            print('>> Could not outcrop all sides at once; extending one side at a time')
+            result = self._extend_each(extents, opt, orig_opt, callback)
+
+        # swap sampler back
+        self.generate.sampler = curr_sampler
+        return result
+
+    def _extend_each(self, extents:dict, opt, orig_opt, callback) -> list:
+        '''
+        Fallback for process(): outpaints one direction per pass, feeding the
+        result of each pass into the next. Only the last pass is reported to
+        the callback.
+        '''
+        image = self.image
+        directions = list(extents)
+        for i, direction in enumerate(directions):
+            last = i == len(directions) - 1
+            extended_image = self._extend_all({direction: extents[direction]}, image)
+            result = self._outpaint(
+                extended_image, opt, orig_opt,
+                callback if last else None,
+                inpaint_crop = True,
+            )
+            if len(result) == 0 or last:
+                return result
+            image = result[0][0]
+
+    def _outpaint(self, extended_image:Image, opt, orig_opt, callback, inpaint_crop=False) -> list:
+        return self.generate.prompt2image(
             opt.prompt,
             seed        = opt.seed or orig_opt.seed,
             sampler     = self.generate.sampler,
@@ -42,7 +78,7 @@ class Outcrop(object):
             height      = extended_image.height,
             init_img    = extended_image,
             strength    = 0.90,
-            image_callback = wrapped_callback if image_callback else None,
+            image_callback = callback,
             seam_size = opt.seam_size or 96,
             seam_blur = opt.seam_blur or 16,
             seam_strength = opt.seam_strength or 0.7,
@@ -50,59 +86,34 @@ class Outcrop(object):
             tile_size = 32,
             color_match = True,
             force_outpaint = True,  # this just stops the warning about erased regions
+            inpaint_crop = inpaint_crop,
         )
-        
-        # swap sampler back
-        self.generate.sampler = curr_sampler
-        return result
 
     def _extend_all(
             self,
             extents:dict,
+            image:Image = None,
     ) -> Image:
         '''
-        Extend the image in direction ('top','bottom','left','right') by
-        the indicated value. The image canvas is extended, and the empty
-        rectangular section will be filled with a blurred copy of the
-        adjacent image.
+        Extend the image (by default self.image) in direction ('top','bottom',
+        'left','right') by the indicated value. The image is pasted once into
+        a canvas grown on all the requested sides, and the new area is left
+        transparent to use as the mask.
         '''
-        image = self.image
+        image = image or self.image
+        padding = dict(top=0, left=0, bottom=0, right=0)
         for direction in extents:
             assert direction in ['top', 'left', 'bottom', 'right'],'Direction must be one of "top", "left", "bottom", "right"'
             pixels = extents[direction]
             # round pixels up to the nearest 64
             pixels = math.ceil(pixels/64) * 64
             print(f'>> extending image {direction}ward by {pixels} pixels')
-            image = self._rotate(image,direction)
-            image = self._extend(image,pixels)
-            image = self._rotate(image,direction,reverse=True)
-        return image
-
-    def _rotate(self,image:Image,direction:str,reverse=False) -> Image:
-        '''
-        Rotates image so that the area to extend is always at the top top.
-        Simplifies logic later. The reverse argument, if true, will undo the
-        previous transpose.
-        '''
-        transposes = {
-            'right':  ['ROTATE_90','ROTATE_270'],
-            'bottom': ['ROTATE_180','ROTATE_180'],
-            'left':   ['ROTATE_270','ROTATE_90']
-        }
-        if direction not in transposes:
-            return image
-        transpose = transposes[direction][1 if reverse else 0]
-        return image.transpose(Image.Transpose.__dict__[transpose])
-
-    def _extend(self,image:Image,pixels:int)-> Image:
-        extended_img = Image.new('RGBA',(image.width,image.height+pixels))
-
-        extended_img.paste((0,0,0),[0,0,image.width,image.height+pixels])
-        extended_img.paste(image,box=(0,pixels))
-
-        # now make the top part transparent to use as a mask
-        alpha = extended_img.getchannel('A')
-        alpha.paste(0,(0,0,extended_img.width,pixels))
-        extended_img.putalpha(alpha)
+            padding[direction] = pixels
 
+        extended_img = Image.new(
+            'RGBA',
+            (image.width + padding['left'] + padding['right'], image.height + padding['top'] + padding['bottom']),
+            (0,0,0,0),
+        )
+        extended_img.paste(image.convert('RGBA'), box=(padding['left'], padding['top']))
         return extended_img
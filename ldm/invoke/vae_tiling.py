@@ -0,0 +1,149 @@
+'''
+ldm.invoke.vae_tiling lets the first stage (VAE) model encode and decode
+large images in overlapping tiles, so that its memory use is bounded by the
+tile size rather than growing with the pixel count. Neighbouring tiles are
+blended with linear ramps across their overlap to hide the seams.
+
+Useful exports:
+
+configure_vae_tiling()    turn tiling on or off for a model
+tile_starts()             where overlapping tiles start along one side
+tile_ramp()               blending weights along one side of a tile
+'''
+import torch
+import torch.nn as nn
+from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
+
+MIN_TILE = 16   # smallest tile side, in latent pixels
+
+def configure_vae_tiling(model, max_mb:int=0):
+    """
+    Makes model.decode_first_stage() and model.encode_first_stage() work in
+    tiles small enough to fit in about max_mb megabytes. 0 turns tiling off.
+    """
+    model.vae_tiling = VaeTiling(max_mb * 1024 * 1024) if max_mb and max_mb > 0 else None
+
+def tile_starts(size:int, tile:int, overlap:int)->list:
+    '''
+    Returns the offsets of tiles of the given size that cover size with at
+    least overlap pixels in common between neighbours. The last tile is
+    flush with the end.
+    '''
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile, tile - overlap))
+    starts.append(size - tile)
+    return starts
+
+def tile_ramp(length:int, overlap:int, ramp_start:bool, ramp_end:bool, like:torch.Tensor)->torch.Tensor:
+    '''
+    Weights along one side of a tile, rising across the overlap with each neighbouring tile.
+    '''
+    weight = torch.ones(length, dtype=like.dtype, device=like.device)
+    ramp = torch.arange(1, overlap + 1, dtype=like.dtype, device=like.device) / (overlap + 1)
+    if ramp_start:
+        weight[:overlap] = ramp
+    if ramp_end:
+        weight[-overlap:] = ramp.flip(0)
+    return weight
+
+class VaeTiling():
+    def __init__(self, max_bytes:int, downsampling:int=8):
+        self.max_bytes    = max_bytes
+        self.downsampling = downsampling
+
+    def decode(self, first_stage_model, z:torch.Tensor):
+        '''
+        Returns first_stage_model.decode(z), or None if z is small enough to decode in one go.
+        '''
+        tile = self.tile_size(first_stage_model, z.shape[-2:], z.element_size())
+        if tile is None:
+            return None
+        return self._tiled(first_stage_model.decode, z, tile, self.downsampling)
+
+    def encode(self, first_stage_model, x:torch.Tensor):
+        '''
+        Returns first_stage_model.encode(x), or None if x is small enough to encode in one go.
+        '''
+        f = self.downsampling
+        if x.shape[-2] % f or x.shape[-1] % f:
+            return None
+        tile = self.tile_size(first_stage_model, (x.shape[-2] // f, x.shape[-1] // f), x.element_size())
+        if tile is None:
+            return None
+
+        is_posterior = False
+
+        def encode_tile(x_tile):
+            nonlocal is_posterior
+            posterior = first_stage_model.encode(x_tile)
+            if isinstance(posterior, DiagonalGaussianDistribution):
+                is_posterior = True
+                return posterior.parameters
+            return posterior
+
+        blended = self._tiled(encode_tile, x, tile * f, 1.0 / f)
+        return DiagonalGaussianDistribution(blended) if is_posterior else blended
+
+    def tile_size(self, first_stage_model, latent_size, element_size:int):
+        '''
+        Returns the side in latent pixels of the largest square tile that fits the
+        memory budget, or None if the whole latent fits.
+        '''
+        if self._is_seamless(first_stage_model):
+            return None    # circular padding only works on the whole image
+        h, w = latent_size
+        if self.estimate_bytes(h, w, element_size) <= self.max_bytes:
+            return None
+        tile = max(h, w) - max(h, w) % 8
+        while tile > MIN_TILE and self.estimate_bytes(tile, tile, element_size) > self.max_bytes:
+            tile -= 8
+        return tile if tile < max(h, w) else None
+
+    def estimate_bytes(self, h:int, w:int, element_size:int)->int:
+        '''
+        Rough peak memory of a VAE pass over a latent of h x w: the attention
+        matrix of the mid block, plus a handful of 128-channel activations at
+        full resolution in the outermost blocks.
+        '''
+        f = self.downsampling
+        attention = 2 * (h * w) ** 2
+        convolutions = 6 * 128 * (h * f) * (w * f)
+        return (attention + convolutions) * element_size
+
+    def _tiled(self, fn, x:torch.Tensor, tile:int, scale:float):
+        '''
+        Runs fn over overlapping tiles of x and blends the results.
+        scale is the ratio between the output and input resolutions.
+        '''
+        height, width = x.shape[-2:]
+        tile_h, tile_w = min(tile, height), min(tile, width)
+        overlap = tile // 4
+        out_overlap = int(overlap * scale)
+
+        output = None
+        weights = None
+        for top in tile_starts(height, tile_h, overlap):
+            for left in tile_starts(width, tile_w, overlap):
+                result = fn(x[:, :, top:top+tile_h, left:left+tile_w])
+                if output is None:
+                    output = torch.zeros(
+                        result.shape[0], result.shape[1], int(height * scale), int(width * scale),
+                        dtype=result.dtype, device=result.device
+                    )
+                    weights = torch.zeros(1, 1, output.shape[-2], output.shape[-1], dtype=result.dtype, device=result.device)
+                weight = (
+                    tile_ramp(result.shape[-2], out_overlap, top > 0, top + tile_h < height, result)[:, None] *
+                    tile_ramp(result.shape[-1], out_overlap, left > 0, left + tile_w < width, result)[None, :]
+                )
+                out_top, out_left = int(top * scale), int(left * scale)
+                out_h, out_w = result.shape[-2:]
+                output[:, :, out_top:out_top+out_h, out_left:out_left+out_w] += result * weight
+                weights[:, :, out_top:out_top+out_h, out_left:out_left+out_w] += weight
+        return output / weights
+
+    def _is_seamless(self, first_stage_model)->bool:
+        for m in first_stage_model.modules():
+            if isinstance(m, nn.Conv2d):
+                return hasattr(m, 'asymmetric_padding_mode')
+        return False
@@ -0,0 +1,148 @@
+'''
+ldm.invoke.weights_index remembers the sha256 hash and the picklescan
+verdict of weights files (models, VAEs and embeddings), so that loading the
+same file again skips both passes over it.
+
+Entries are keyed on the file's real path, size, modification time and
+inode, and are kept in a single JSON file under the runtime directory
+(models/weights_index.json by default) rather than next to the weights, so
+read-only model volumes are indexed too. The index is rewritten atomically
+and merged with whatever other processes have written in the meantime.
+
+Useful exports:
+
+weights_index - the index shared by the model cache and embedding manager
+'''
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+from picklescan.scanner import scan_file_path
+from ldm.invoke.globals import Globals
+
+try:
+    import fcntl
+except ImportError:    # Windows: writes are still atomic, but concurrent updates may be lost
+    fcntl = None
+
+HASH_CHUNK_SIZE=16*1024*1024
+
+class WeightsIndex():
+    def __init__(self, index_path:str=None):
+        '''
+        index_path is the JSON file holding the index. If not given it is
+        models/weights_index.json under Globals.root, looked up at first use.
+        '''
+        self.index_path = index_path
+        self.entries    = {}
+        self.loaded     = None    # (path, mtime) of the index file last read
+        self.lock       = threading.Lock()
+        self.warned     = False
+
+    def sha256(self, path:str)->str:
+        '''
+        Returns the sha256 hash of the file at path, hashing it only if it is
+        not in the index.
+        '''
+        entry = self._entry(path)
+        if 'sha256' in entry:
+            return entry['sha256']
+
+        print(f'>> Calculating sha256 hash of weights file')
+        tic = time.time()
+        sha = hashlib.sha256()
+        with open(path,'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        hash = sha.hexdigest()
+        toc = time.time()
+        print(f'>> sha256 = {hash}','(%4.2fs)' % (toc - tic))
+
+        self._update(path, sha256=hash)
+        return hash
+
+    def scan(self, path:str):
+        '''
+        Returns the picklescan result for the file at path, as an object with
+        the infected_files, issues_count and scan_err attributes of a
+        picklescan ScanResult. Files are only scanned if not in the index.
+        Failed scans are not remembered, so they are retried next time.
+        '''
+        entry = self._entry(path)
+        if 'scan' in entry:
+            return SimpleNamespace(**entry['scan'], scan_err=False)
+
+        result = scan_file_path(path)
+        if not result.scan_err:
+            self._update(path, scan=dict(infected_files=result.infected_files, issues_count=result.issues_count))
+        return result
+
+    def _entry(self, path:str)->dict:
+        with self.lock:
+            self._read()
+            return dict(self.entries.get(self._key(path), {}))
+
+    def _update(self, path:str, **fields):
+        with self.lock:
+            self._write(self._key(path), fields)
+
+    def _key(self, path:str)->str:
+        realpath = os.path.realpath(path)
+        st = os.stat(realpath)
+        return f'{realpath}|{st.st_size}|{st.st_mtime_ns}|{st.st_ino}'
+
+    def _path(self)->str:
+        return self.index_path or os.path.join(Globals.root,'models','weights_index.json')
+
+    def _read(self):
+        '''
+        (Re)loads the index file if it changed since it was last read.
+        '''
+        path = self._path()
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+        if self.loaded == (path, mtime):
+            return
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+            self.loaded = (path, mtime)
+        except (OSError, ValueError):
+            pass
+
+    def _write(self, key:str, fields:dict):
+        '''
+        Merges the changes into the index file on disk, holding an exclusive
+        lock so other processes' changes are not lost, and replaces the file
+        in one step so readers never see a partial index.
+        '''
+        path = self._path()
+        tmpfile = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.lock', 'w') as lockfile:
+                if fcntl is not None:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX)
+                self.loaded = None
+                self._read()
+                self.entries.setdefault(key, {}).update(fields)
+                with open(tmpfile,'w') as f:
+                    json.dump(self.entries, f, indent=1)
+                os.replace(tmpfile, path)
+                self.loaded = (path, os.stat(path).st_mtime_ns)
+        except OSError as e:
+            # keep the entries in memory for the rest of this session
+            self.entries.setdefault(key, {}).update(fields)
+            if not self.warned:
+                print(f'** Could not write the weights index {path}: {str(e)}')
+                self.warned = True
+            with contextlib.suppress(OSError):
+                os.remove(tmpfile)
+
+weights_index = WeightsIndex()
@@ -46,6 +46,7 @@ from ldm.modules.diffusionmodules.util import (
     make_beta_schedule,
     extract_into_tensor,
     noise_like,
+    seeded_randn_like,
 )
 from ldm.models.diffusion.ddim import DDIMSampler
 
@@ -416,7 +417,7 @@ class DDPM(pl.LightningModule):
         )
 
     def q_sample(self, x_start, t, noise=None):
-        noise = default(noise, lambda: torch.randn_like(x_start))
+        noise = default(noise, lambda: seeded_randn_like(x_start))
         return (
             extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape)
             * x_start
@@ -660,6 +661,7 @@ class LatentDiffusion(DDPM):
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None
+        self.vae_tiling = None     # see ldm.invoke.vae_tiling
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -1047,6 +1049,11 @@ class LatentDiffusion(DDPM):
 
         z = 1.0 / self.scale_factor * z
 
+        if self.vae_tiling is not None and not isinstance(self.first_stage_model, VQModelInterface):
+            decoded = self.vae_tiling.decode(self.first_stage_model, z)
+            if decoded is not None:
+                return decoded
+
         if hasattr(self, 'split_input_params'):
             if self.split_input_params['patch_distributed_vq']:
                 ks = self.split_input_params['ks']  # eg. (128, 128)
@@ -1203,6 +1210,11 @@ class LatentDiffusion(DDPM):
 
     @torch.no_grad()
     def encode_first_stage(self, x):
+        if self.vae_tiling is not None and not isinstance(self.first_stage_model, VQModelInterface):
+            encoded = self.vae_tiling.encode(self.first_stage_model, x)
+            if encoded is not None:
+                return encoded
+
         if hasattr(self, 'split_input_params'):
             if self.split_input_params['patch_distributed_vq']:
                 ks = self.split_input_params['ks']  # eg. (128, 128)
@@ -1,11 +1,13 @@
 """wrapper around part of Katherine Crowson's k-diffusion library, making it call compatible with other Samplers"""
 
+import inspect
 import k_diffusion as K
 import torch
 from torch import nn
 
 from .sampler import Sampler
 from .shared_invokeai_diffusion import InvokeAIDiffuserComponent
+from ldm.modules.diffusionmodules.util import seeded_randn, seeded_randn_like
 
 
 # at this threshold, the scheduler will stop using the Karras
@@ -141,9 +143,12 @@ class KSampler(Sampler):
             )
         return samples
 
-    # this is a no-op, provided here for compatibility with ddim and plms samplers
+    # this is a no-op, provided here for compatibility with ddim and plms samplers,
+    # apart from making one copy of x0 per row of a batch of noise
     @torch.no_grad()
     def stochastic_encode(self, x0, t, use_original_steps=False, noise=None):
+        if noise is not None and noise.shape[0] != x0.shape[0]:
+            return x0.expand(noise.shape[0], *x0.shape[1:])
         return x0
     
     # Most of these arguments are ignored and are only present for compatibility with
@@ -196,11 +201,11 @@ class KSampler(Sampler):
         # more randomness to the starting image.
         if x_T is not None:
             if x0 is not None:
-                x = x_T + torch.randn_like(x0, device=self.device) * sigmas[0]
+                x = x_T + seeded_randn(x_T.shape, self.device, x0.dtype) * sigmas[0]
             else:
                 x = x_T * sigmas[0]
         else:
-            x = torch.randn([batch_size, *shape], device=self.device) * sigmas[0]
+            x = seeded_randn([batch_size, *shape], self.device) * sigmas[0]
 
         model_wrap_cfg = CFGDenoiser(self.model, threshold=threshold, warmup=max(0.8*S,S-10))
         model_wrap_cfg.prepare_to_sample(S, extra_conditioning_info=extra_conditioning_info)
@@ -210,10 +215,15 @@ class KSampler(Sampler):
             'cond_scale': unconditional_guidance_scale,
         }
         print(f'>> Sampling with k_{self.schedule} starting at step {len(self.sigmas)-S-1} of {len(self.sigmas)-1} ({S} new sampling steps)')
+        sample_fn = K.sampling.__dict__[f'sample_{self.schedule}']
+        sample_kwargs = {}
+        if self.accepts_noise_sampler(sample_fn):
+            # draw the ancestral noise from the per-seed generators, if any
+            sample_kwargs['noise_sampler'] = lambda sigma, sigma_next: seeded_randn_like(x)
         sampling_result = (
-            K.sampling.__dict__[f'sample_{self.schedule}'](
+            sample_fn(
                 model_wrap_cfg, x, sigmas, extra_args=extra_args,
-                callback=route_callback
+                callback=route_callback, **sample_kwargs
             ),
             None,
         )
@@ -275,7 +285,7 @@ class KSampler(Sampler):
     # sample() which does work.
     def get_initial_image(self,x_T,shape,steps):
         print(f'WARNING: ksampler.get_initial_image(): get_initial_image needs testing')
-        x = (torch.randn(shape, device=self.device) * self.sigmas[0])
+        x = (seeded_randn(shape, self.device) * self.sigmas[0])
         if x_T is not None:
             return x_T + x
         else:
@@ -293,6 +303,22 @@ class KSampler(Sampler):
         '''
         return self.model.inner_model.q_sample(x0,ts)
 
+    @classmethod
+    def accepts_noise_sampler(cls, sample_fn)->bool:
+        '''
+        True if the k-diffusion sampling function lets the caller supply the
+        noise it adds at each step. Older k-diffusion releases do not.
+        '''
+        try:
+            return 'noise_sampler' in inspect.signature(sample_fn).parameters
+        except (TypeError, ValueError):
+            return False
+
+    def can_seed_noise(self)->bool:
+        if 'ancestral' not in self.schedule:
+            return True
+        return self.accepts_noise_sampler(K.sampling.__dict__[f'sample_{self.schedule}'])
+
     def conditioning_key(self)->str:
         return self.model.inner_model.model.conditioning_key
 
@@ -15,6 +15,8 @@ from ldm.modules.diffusionmodules.util import (
     make_ddim_timesteps,
     noise_like,
     extract_into_tensor,
+    seeded_randn,
+    seeded_randn_like,
 )
 
 class Sampler(object):
@@ -126,7 +128,7 @@ class Sampler(object):
             sqrt_one_minus_alphas_cumprod = self.ddim_sqrt_one_minus_alphas
 
         if noise is None:
-            noise = torch.randn_like(x0)
+            noise = seeded_randn_like(x0)
         return (
             extract_into_tensor(sqrt_alphas_cumprod, t, x0.shape) * x0
             + extract_into_tensor(sqrt_one_minus_alphas_cumprod, t, x0.shape)
@@ -382,7 +384,7 @@ class Sampler(object):
 
     def get_initial_image(self,x_T,shape,timesteps=None):
         if x_T is None:
-            return torch.randn(shape, device=self.device)
+            return seeded_randn(shape, self.device)
         else:
             return x_T
     
@@ -437,6 +439,13 @@ class Sampler(object):
     def uses_inpainting_model(self)->bool:
         return self.conditioning_key() in ('hybrid','concat')
 
+    def can_seed_noise(self)->bool:
+        '''
+        True if all the noise drawn while sampling honors seeded_noise(), so
+        that each row of a batch gets the noise of its own seed.
+        '''
+        return True
+
     def adjust_settings(self,**kwargs):
         '''
         This is a catch-all method for adjusting any instance variables
@@ -10,10 +10,12 @@
 
 import os
 import math
+import contextvars
 import torch
 import torch.nn as nn
 import numpy as np
 from einops import repeat
+from contextlib import contextmanager
 
 from ldm.util import instantiate_from_config
 
@@ -310,5 +312,42 @@ def noise_like(shape, device, repeat=False):
     repeat_noise = lambda: torch.randn((1, *shape[1:]), device=device).repeat(
         shape[0], *((1,) * (len(shape) - 1))
     )
-    noise = lambda: torch.randn(shape, device=device)
+    noise = lambda: seeded_randn(shape, device)
     return repeat_noise() if repeat else noise()
+
+
+# one torch.Generator per row of the batch being sampled, or None
+_noise_generators = contextvars.ContextVar('noise_generators', default=None)
+
+
+@contextmanager
+def seeded_noise(generators):
+    """
+    Within this context, the noise the samplers draw for row i of a batch
+    comes from generators[i] rather than from the global RNG. Pass None to
+    use the global RNG.
+    """
+    token = _noise_generators.set(generators)
+    try:
+        yield
+    finally:
+        _noise_generators.reset(token)
+
+
+def seeded_randn(shape, device, dtype=None):
+    generators = _noise_generators.get()
+    if generators is None:
+        return torch.randn(shape, device=device, dtype=dtype)
+    # drawing from the global RNG instead would quietly break reproducibility
+    assert len(generators) == shape[0], \
+        f'noise for a batch of {shape[0]} was drawn under seeded_noise() with {len(generators)} generators'
+    return torch.cat(
+        [
+            torch.randn((1, *shape[1:]), generator=g, device=g.device, dtype=dtype).to(device)
+            for g in generators
+        ]
+    )
+
+
+def seeded_randn_like(x):
+    return seeded_randn(x.shape, x.device, x.dtype)
@@ -9,7 +9,7 @@ from ldm.invoke.concepts_lib import Concepts
 from ldm.data.personalized import per_img_token_list
 from transformers import CLIPTokenizer
 from functools import partial
-from picklescan.scanner import scan_file_path
+from ldm.invoke.weights_index import weights_index
 
 PROGRESSIVE_SCALE = 2000
 
@@ -257,7 +257,7 @@ class EmbeddingManager(nn.Module):
 
     def _load(self, ckpt_path, full=True):
 
-        scan_result = scan_file_path(ckpt_path)
+        scan_result = weights_index.scan(ckpt_path)
         if scan_result.infected_files == 1:
             print(f'\n### Security Issues Found in Model: {scan_result.issues_count}')
             print('### For your safety, InvokeAI will not load this embed.')
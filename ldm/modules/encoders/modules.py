@@ -1,14 +1,21 @@
 import math
 import os.path
+import threading
 import torch
 import torch.nn as nn
 from functools import partial
 import clip
 from einops import rearrange, repeat
-from transformers import CLIPTokenizer, CLIPTextModel
+from transformers import CLIPTokenizer, CLIPTextModel, CLIPTextConfig
 import kornia
 from ldm.invoke.devices import choose_torch_device
 from ldm.invoke.globals import Globals
+from ldm.util import weight_init_skipped
+
+# transformers' no_init_weights() is a process-wide switch rather than a
+# per-thread one, so loads on the prefetch thread and the main thread take
+# turns with it instead of switching it off under each other
+_no_init_weights_lock = threading.Lock()
 
 from ldm.modules.x_transformer import (
     Encoder,
@@ -249,11 +256,21 @@ class FrozenCLIPEmbedder(AbstractEncoder):
             cache_dir=cache,
             local_files_only=True
         )
-        self.transformer = CLIPTextModel.from_pretrained(
-            version,
-            cache_dir=cache,
-            local_files_only=True
-        )
+        if weight_init_skipped():
+            # the checkpoint being loaded supplies the weights, so only the architecture is needed
+            self.transformer = self._uninitialized_transformer(
+                CLIPTextConfig.from_pretrained(
+                    version,
+                    cache_dir=cache,
+                    local_files_only=True
+                )
+            )
+        else:
+            self.transformer = CLIPTextModel.from_pretrained(
+                version,
+                cache_dir=cache,
+                local_files_only=True
+            )
         self.device = device
         self.max_length = max_length
         self.freeze()
@@ -437,6 +454,15 @@ class FrozenCLIPEmbedder(AbstractEncoder):
             self.transformer
         )
 
+    @staticmethod
+    def _uninitialized_transformer(config):
+        try:
+            from transformers.modeling_utils import no_init_weights
+        except ImportError:
+            return CLIPTextModel(config)
+        with _no_init_weights_lock, no_init_weights():
+            return CLIPTextModel(config)
+
     def freeze(self):
         self.transformer = self.transformer.eval()
         for param in self.parameters():
@@ -465,6 +491,11 @@ class WeightedFrozenCLIPEmbedder(FrozenCLIPEmbedder):
     fragment_weights_key = "fragment_weights"
     return_tokens_key = "return_tokens"
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # embeddings of the empty prompt, keyed on (device, dtype, weight dtype, autocast)
+        self.empty_embeddings = {}
+
     def forward(self, text: list, **kwargs):
         '''
 
@@ -504,10 +535,10 @@ class WeightedFrozenCLIPEmbedder(FrozenCLIPEmbedder):
 
             # handle weights >=1
             tokens, per_token_weights = self.get_tokens_and_weights(fragments, weights)
-            base_embedding = self.build_weighted_embedding_tensor(tokens, per_token_weights, **kwargs)
 
             # this is our starting point
-            embeddings = base_embedding.unsqueeze(0)
+            all_tokens = [tokens]
+            all_per_token_weights = [per_token_weights]
             per_embedding_weights = [1.0]
 
             # now handle weights <1
@@ -522,10 +553,9 @@ class WeightedFrozenCLIPEmbedder(FrozenCLIPEmbedder):
                 if fragment_weight < 1:
                     fragments_without_this = fragments[:index] + fragments[index+1:]
                     weights_without_this = weights[:index] + weights[index+1:]
-                    tokens, per_token_weights = self.get_tokens_and_weights(fragments_without_this, weights_without_this)
-                    embedding_without_this = self.build_weighted_embedding_tensor(tokens, per_token_weights, **kwargs)
-
-                    embeddings = torch.cat((embeddings, embedding_without_this.unsqueeze(0)), dim=1)
+                    tokens_without_this, per_token_weights_without_this = self.get_tokens_and_weights(fragments_without_this, weights_without_this)
+                    all_tokens.append(tokens_without_this)
+                    all_per_token_weights.append(per_token_weights_without_this)
                     # weight of the embedding *without* this fragment gets *stronger* as its weight approaches 0
                     # if fragment_weight = 0, basically we want embedding_without_this to completely overwhelm base_embedding
                     # therefore:
@@ -544,6 +574,11 @@ class WeightedFrozenCLIPEmbedder(FrozenCLIPEmbedder):
 
                     per_embedding_weights.append(embedding_lerp_weight)
 
+            # the prompt and all its fragment-less variants go through the transformer in a single batch
+            embeddings = self.build_weighted_embedding_tensor(torch.stack(all_tokens),
+                                                              torch.stack(all_per_token_weights),
+                                                              **kwargs).unsqueeze(0)
+
             lerped_embeddings = self.apply_embedding_weights(embeddings, per_embedding_weights, normalize=True).squeeze(0)
 
             #print(f"assembled tokens for '{fragments}' into tensor of shape {lerped_embeddings.shape}")
@@ -639,24 +674,21 @@ class WeightedFrozenCLIPEmbedder(FrozenCLIPEmbedder):
     def build_weighted_embedding_tensor(self, tokens: torch.Tensor, per_token_weights: torch.Tensor, weight_delta_from_empty=True, **kwargs) -> torch.Tensor:
         '''
         Build a tensor representing the passed-in tokens, each of which has a weight.
-        :param tokens: A tensor of shape (77) containing token ids (integers)
-        :param per_token_weights: A tensor of shape (77) containing weights (floats)
+        :param tokens: A tensor of shape (77) or (B, 77) containing token ids (integers)
+        :param per_token_weights: A tensor of the same shape as tokens containing weights (floats)
         :param method: Whether to multiply the whole feature vector for each token or just its distance from an "empty" feature vector
         :param kwargs: passed on to self.transformer()
-        :return: A tensor of shape (1, 77, 768) representing the requested weighted embeddings.
+        :return: A tensor of shape (B, 77, 768) representing the requested weighted embeddings, with B=1 for a single prompt.
         '''
         #print(f"building weighted embedding tensor for {tokens} with weights {per_token_weights}")
-        z = self.transformer(input_ids=tokens.unsqueeze(0), **kwargs)
+        if tokens.dim() == 1:
+            tokens = tokens.unsqueeze(0)
+            per_token_weights = per_token_weights.unsqueeze(0)
+        z = self.transformer(input_ids=tokens, **kwargs)
         batch_weights_expanded = per_token_weights.reshape(per_token_weights.shape + (1,)).expand(z.shape)
 
         if weight_delta_from_empty:
-            empty_tokens = self.tokenizer([''] * z.shape[0],
-                                         truncation=True,
-                                         max_length=self.max_length,
-                                         padding='max_length',
-                                         return_tensors='pt'
-                                         )['input_ids'].to(self.device)
-            empty_z = self.transformer(input_ids=empty_tokens, **kwargs)
+            empty_z = self.get_empty_embedding(z, **kwargs)
             z_delta_from_empty = z - empty_z
             weighted_z = empty_z + (z_delta_from_empty * batch_weights_expanded)
 
@@ -669,14 +701,30 @@ class WeightedFrozenCLIPEmbedder(FrozenCLIPEmbedder):
             return weighted_z
 
         else:
-            original_mean = z.mean()
+            original_mean = z.mean(dim=(1,2), keepdim=True)
             z *= batch_weights_expanded
-            after_weighting_mean = z.mean()
+            after_weighting_mean = z.mean(dim=(1,2), keepdim=True)
             # correct the mean. not sure if this is right but it's what the automatic1111 fork of SD does
             mean_correction_factor = original_mean/after_weighting_mean
             z *= mean_correction_factor
             return z
 
+    def get_empty_embedding(self, z: torch.Tensor, **kwargs) -> torch.Tensor:
+        '''
+        Returns the (1, 77, 768) embedding of the empty prompt, computed once and then
+        reused for as long as the device, weight dtype and autocast state of z stay the same.
+        '''
+        key = (z.device, z.dtype, next(self.transformer.parameters()).dtype, torch.is_autocast_enabled())
+        if key not in self.empty_embeddings:
+            empty_tokens = self.tokenizer([''],
+                                         truncation=True,
+                                         max_length=self.max_length,
+                                         padding='max_length',
+                                         return_tensors='pt'
+                                         )['input_ids'].to(self.device)
+            self.empty_embeddings[key] = self.transformer(input_ids=empty_tokens, **kwargs)
+        return self.empty_embeddings[key]
+
 
 class FrozenCLIPTextEmbedder(nn.Module):
     """
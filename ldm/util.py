@@ -5,9 +5,12 @@ import numpy as np
 import math
 from collections import abc
 from einops import rearrange
-from functools import partial
+from functools import partial, lru_cache
 
 import multiprocessing as mp
+import threading
+from contextlib import contextmanager
+from functools import wraps
 from threading import Thread
 from queue import Queue
 
@@ -92,6 +95,57 @@ def instantiate_from_config(config, **kwargs):
     )
 
 
+# torch.nn.init functions that no_weight_init() turns into no-ops
+SKIPPABLE_INITS = (
+    'uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_',
+    'eye_', 'dirac_', 'xavier_uniform_', 'xavier_normal_',
+    'kaiming_uniform_', 'kaiming_normal_', 'orthogonal_', 'sparse_',
+)
+_weight_init = threading.local()
+_weight_init_lock = threading.Lock()
+_weight_init_patched = False
+
+
+@contextmanager
+def no_weight_init():
+    '''
+    Within this context, modules constructed on the calling thread leave
+    their parameters uninitialized instead of drawing random weights, for
+    when a state dict is about to overwrite them anyway. Other threads are
+    not affected.
+    '''
+    global _weight_init_patched
+    with _weight_init_lock:
+        if not _weight_init_patched:
+            for name in SKIPPABLE_INITS:
+                if hasattr(torch.nn.init, name):
+                    setattr(torch.nn.init, name, _skippable_init(getattr(torch.nn.init, name)))
+            _weight_init_patched = True
+
+    previous = weight_init_skipped()
+    _weight_init.skip = True
+    try:
+        yield
+    finally:
+        _weight_init.skip = previous
+
+
+def weight_init_skipped() -> bool:
+    '''
+    True within no_weight_init() on the calling thread.
+    '''
+    return getattr(_weight_init, 'skip', False)
+
+
+def _skippable_init(init_fn):
+    @wraps(init_fn)
+    def init(tensor, *args, **kwargs):
+        if weight_init_skipped():
+            return tensor
+        return init_fn(tensor, *args, **kwargs)
+    return init
+
+
 def get_obj_from_str(string, reload=False):
     module, cls = string.rsplit('.', 1)
     if reload:
@@ -214,27 +268,48 @@ def parallel_data_prefetch(
     else:
         return gather_res
 
-def rand_perlin_2d(shape, res, device, fade = lambda t: 6*t**5 - 15*t**4 + 10*t**3):
+def perlin_fade(t):
+    return 6*t**5 - 15*t**4 + 10*t**3
+
+@lru_cache(maxsize=16)
+def perlin_grid(shape, res, device, fade = perlin_fade):
+    """
+    Returns the position of each pixel within its lattice cell and the fade
+    weights of those positions, for Perlin noise of the given shape and
+    resolution. Cached, since every image of one size needs the same ones.
+    """
     delta = (res[0] / shape[0], res[1] / shape[1])
+    grid = torch.stack(torch.meshgrid(torch.arange(0, res[0], delta[0]), torch.arange(0, res[1], delta[1]), indexing='ij'), dim = -1).to(device) % 1
+    grid = grid[:shape[0], :shape[1]]
+    return grid, fade(grid)
+
+def rand_perlin_2d(shape, res, device, fade = perlin_fade, generator=None):
+    return rand_perlin_2d_channels(shape, res, 1, device, fade, generator)[0]
+
+def rand_perlin_2d_channels(shape, res, channels, device, fade = perlin_fade, generator=None):
+    """
+    Returns a (channels, height, width) tensor of independent Perlin noise
+    fields, made in one vectorized pass. It draws the same random numbers in
+    the same order as calling rand_perlin_2d() once per channel does.
+    """
+    shape, res = tuple(shape), tuple(res)
     d = (shape[0] // res[0], shape[1] // res[1])
+    grid, t = perlin_grid(shape, res, torch.device(device), fade)
 
-    grid = torch.stack(torch.meshgrid(torch.arange(0, res[0], delta[0]), torch.arange(0, res[1], delta[1]), indexing='ij'), dim = -1).to(device) % 1
+    rand_val = torch.rand(channels, res[0]+1, res[1]+1, generator=generator)
 
-    rand_val = torch.rand(res[0]+1, res[1]+1)
-    
     angles = 2*math.pi*rand_val
     gradients = torch.stack((torch.cos(angles), torch.sin(angles)), dim = -1).to(device)
 
-    tile_grads = lambda slice1, slice2: gradients[slice1[0]:slice1[1], slice2[0]:slice2[1]].repeat_interleave(d[0], 0).repeat_interleave(d[1], 1)
+    tile_grads = lambda slice1, slice2: gradients[:, slice1[0]:slice1[1], slice2[0]:slice2[1]].repeat_interleave(d[0], 1).repeat_interleave(d[1], 2)
 
-    dot = lambda grad, shift: (torch.stack((grid[:shape[0],:shape[1],0] + shift[0], grid[:shape[0],:shape[1], 1] + shift[1]  ), dim = -1) * grad[:shape[0], :shape[1]]).sum(dim = -1)
+    dot = lambda grad, shift: ((grid + grid.new_tensor(shift)) * grad[:, :shape[0], :shape[1]]).sum(dim = -1)
 
-    n00 = dot(tile_grads([0, -1], [0, -1]), [0,  0]).to(device)
-    n10 = dot(tile_grads([1, None], [0, -1]), [-1, 0]).to(device)
-    n01 = dot(tile_grads([0, -1],[1, None]), [0, -1]).to(device)
-    n11 = dot(tile_grads([1, None], [1, None]), [-1,-1]).to(device)
-    t = fade(grid[:shape[0], :shape[1]])
-    return math.sqrt(2) * torch.lerp(torch.lerp(n00, n10, t[..., 0]), torch.lerp(n01, n11, t[..., 0]), t[..., 1]).to(device)
+    n00 = dot(tile_grads([0, -1], [0, -1]), [0,  0])
+    n10 = dot(tile_grads([1, None], [0, -1]), [-1, 0])
+    n01 = dot(tile_grads([0, -1],[1, None]), [0, -1])
+    n11 = dot(tile_grads([1, None], [1, None]), [-1,-1])
+    return math.sqrt(2) * torch.lerp(torch.lerp(n00, n10, t[..., 0]), torch.lerp(n01, n11, t[..., 0]), t[..., 1])
 
 def ask_user(question: str, answers: list):
     from itertools import chain, repeat
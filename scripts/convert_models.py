@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# Saves the converted weights (pruned, in the working precision and with
+# the VAE merged) of the models in models.yaml ahead of time, so that the
+# first load of each model by invoke.py --converted_weights_dir is fast too.
+
+import argparse
+import os
+import sys
+
+from omegaconf import OmegaConf
+from ldm.invoke.globals import Globals
+from ldm.invoke.model_cache import ModelCache
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert the models in models.yaml for fast loading with invoke.py --converted_weights_dir'
+    )
+    parser.add_argument(
+        '--root_dir',
+        type=str,
+        default=os.environ.get('INVOKEAI_ROOT') or '.',
+        help="Path to the InvokeAI install directory containing 'models', 'outputs' and 'configs'."
+    )
+    parser.add_argument(
+        '--conf',
+        type=str,
+        default='configs/models.yaml',
+        help='Path to the models configuration file, relative to the root directory'
+    )
+    parser.add_argument(
+        '--converted_weights_dir',
+        type=str,
+        required=True,
+        help='Directory to save the converted weights in; pass the same one to invoke.py'
+    )
+    parser.add_argument(
+        '--precision',
+        type=str,
+        choices=['float16', 'float32'],
+        default='float16',
+        help='Precision the models will be used in. float16 unless invoke.py runs with --precision float32'
+    )
+    parser.add_argument(
+        'models',
+        nargs='*',
+        help='Names of the models to convert. All models in the configuration file if none are given'
+    )
+    opt = parser.parse_args()
+
+    Globals.root = os.path.expanduser(opt.root_dir)
+    conf = opt.conf if os.path.isabs(opt.conf) else os.path.join(Globals.root, opt.conf)
+    config = OmegaConf.load(conf)
+
+    cache = ModelCache(config, 'cpu', opt.precision, converted_dir=opt.converted_weights_dir)
+    failed = []
+    for model_name in opt.models or list(config):
+        if not cache.valid_model(model_name):
+            print(f'** "{model_name}" is not a known model name. Please check your models.yaml file')
+            failed.append(model_name)
+            continue
+        print(f'>> Converting {model_name}')
+        try:
+            cache.convert_model(model_name)
+        except Exception as e:
+            print(f'** {model_name} could not be converted: {str(e)}')
+            failed.append(model_name)
+
+    if len(failed) > 0:
+        print(f'** Not converted: {", ".join(failed)}')
+        sys.exit(1)
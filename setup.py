@@ -35,6 +35,7 @@ REQUIREMENTS=[
     'torchvision',
     'transformers',
     'picklescan',
+    'safetensors',
     'clip',
     'clipseg',
     'gfpgan',
@@ -78,7 +79,8 @@ setup(
         'Topic :: Scientific/Engineering :: Image Processing',
     ],
     scripts = ['scripts/invoke.py','scripts/configure_invokeai.py', 'scripts/sd-metadata.py',
-               'scripts/preload_models.py', 'scripts/images2prompt.py','scripts/merge_embeddings.py'
+               'scripts/preload_models.py', 'scripts/images2prompt.py','scripts/merge_embeddings.py',
+               'scripts/convert_models.py'
     ],
     data_files=[('frontend/dist',list_files('frontend/dist')),
                 ('frontend/dist/assets',list_files('frontend/dist/assets')),
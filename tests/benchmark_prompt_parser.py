@@ -0,0 +1,80 @@
+'''
+Microbenchmark for ldm.invoke.prompt_parser, run over the prompts exercised by
+test_prompt_parser.py. Run from the repository root with:
+
+    python tests/benchmark_prompt_parser.py [--repeat N]
+'''
+import argparse
+import os
+import sys
+import timeit
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ldm.invoke.prompt_parser import PromptParser, build_parser_syntax
+import test_prompt_parser
+
+
+def collect_prompts() -> list[str]:
+    '''
+    Runs the parser test suite once, recording every prompt string that parses successfully.
+    '''
+    prompts = []
+    parse_conjunction = PromptParser.parse_conjunction
+
+    def recording_parse_conjunction(self, prompt):
+        result = parse_conjunction(self, prompt)
+        prompts.append(prompt)
+        return result
+
+    PromptParser.parse_conjunction = recording_parse_conjunction
+    try:
+        suite = unittest.defaultTestLoader.loadTestsFromModule(test_prompt_parser)
+        unittest.TextTestRunner(stream=open(os.devnull, 'w')).run(suite)
+    finally:
+        PromptParser.parse_conjunction = parse_conjunction
+    return list(dict.fromkeys(prompts))
+
+
+def report(label: str, seconds: float, count: int):
+    print(f'{label:<32} {seconds*1000:9.2f} ms total {seconds*1e6/count:9.1f} us/call')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time prompt parsing over the test_prompt_parser.py cases')
+    parser.add_argument('--repeat', type=int, default=20, help='number of passes over the prompts')
+    opt = parser.parse_args()
+
+    prompts = collect_prompts()
+    print(f'>> {len(prompts)} distinct prompts, {opt.repeat} passes')
+
+    def build_grammar():
+        build_parser_syntax.cache_clear()
+        PromptParser()
+    report('grammar build', timeit.timeit(build_grammar, number=opt.repeat), opt.repeat)
+
+    report('PromptParser()', timeit.timeit(PromptParser, number=opt.repeat * len(prompts)),
+           opt.repeat * len(prompts))
+
+    pp = PromptParser()
+    cache_size = PromptParser.parse_cache_size
+
+    def parse_all():
+        for prompt in prompts:
+            pp.parse_conjunction(prompt)
+
+    try:
+        PromptParser.parse_cache_size = 0
+        PromptParser.parse_cache.clear()
+        report('parse (uncached)', timeit.timeit(parse_all, number=opt.repeat), opt.repeat * len(prompts))
+    finally:
+        PromptParser.parse_cache_size = cache_size
+
+    parse_all()
+    report('parse (cached)', timeit.timeit(parse_all, number=opt.repeat), opt.repeat * len(prompts))
+
+
+if __name__ == '__main__':
+    main()
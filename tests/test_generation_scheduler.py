@@ -0,0 +1,163 @@
+import unittest
+
+from backend.modules.generation_scheduler import GenerationScheduler, GenerationJob
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.emitted = []
+
+    def start_background_task(self, target):
+        return target
+
+    def sleep(self, seconds):
+        pass
+
+    def emit(self, event, data=None, to=None):
+        self.emitted.append((event, to))
+
+
+class FakeGenerate:
+    '''
+    Records the runs it is asked for. A merged run hands every request one
+    image per iteration, after two steps with a batch of one row per image.
+    '''
+    def __init__(self, on_step=None):
+        self.merged = []
+        self.single = []
+        self.on_step = on_step
+
+    def prompts2images(self, requests, step_callback=None):
+        self.merged.append([r['prompt'] for r in requests])
+        rows = [(r['prompt'], i) for r in requests for i in range(r.get('iterations') or 1)]
+        step_callback(rows, 0)
+        if self.on_step is not None:
+            self.on_step()
+        step_callback(rows, 1)
+        results = []
+        for r in requests:
+            results.append([])
+            for i in range(r.get('iterations') or 1):
+                r['image_callback'](f"{r['prompt']}-{i}", i, first_seed=0)
+                results[-1].append([f"{r['prompt']}-{i}", i])
+        return results
+
+    def prompt2image(self, step_callback=None, image_callback=None, **parameters):
+        self.single.append(parameters['prompt'])
+        step_callback([parameters['prompt']], 0)
+        image_callback(f"{parameters['prompt']}-0", 0, first_seed=0)
+
+
+def web_parameters(prompt, **kwargs):
+    # what the stock frontend sends for a plain txt2img request
+    parameters = dict(
+        prompt=prompt,
+        iterations=1,
+        steps=30,
+        cfg_scale=7.5,
+        threshold=0,
+        perlin=0,
+        height=512,
+        width=512,
+        sampler_name='k_lms',
+        seed=42,
+        seamless=False,
+        hires_fix=False,
+        init_mask='',
+        ddim_eta=0.0,
+    )
+    parameters.update(kwargs)
+    return parameters
+
+
+class RecordingJob(GenerationJob):
+    def __init__(self, sid, parameters):
+        self.steps = []
+        self.images = []
+        super().__init__(sid, parameters,
+                         step_callback=lambda sample, step: self.steps.append((list(sample), step)),
+                         image_callback=lambda image, seed, first_seed=None: self.images.append(image))
+
+
+class GenerationSchedulerTestCase(unittest.TestCase):
+
+    def run_jobs(self, jobs, generate=None):
+        socketio = FakeSocketIO()
+        generate = generate or FakeGenerate()
+        scheduler = GenerationScheduler(generate, socketio, max_batch_size=4)
+        for job in jobs:
+            scheduler.queue.append(job)
+        scheduler.run()
+        return generate, socketio
+
+    def test_web_txt2img_requests_merge(self):
+        jobs = [RecordingJob('a', web_parameters('cat')), RecordingJob('b', web_parameters('dog'))]
+        self.assertIsNotNone(jobs[0].batch_key())
+        generate, _ = self.run_jobs(jobs)
+        self.assertEqual([['cat', 'dog']], generate.merged)
+        self.assertEqual(['cat-0'], jobs[0].images)
+        self.assertEqual(['dog-0'], jobs[1].images)
+
+    def test_init_image_runs_alone(self):
+        jobs = [RecordingJob('a', web_parameters('cat', init_img='data:image/png;base64,xyz')),
+                RecordingJob('b', web_parameters('dog', init_mask='data:image/png;base64,xyz'))]
+        self.assertIsNone(jobs[0].batch_key())
+        self.assertIsNone(jobs[1].batch_key())
+        generate, _ = self.run_jobs(jobs)
+        self.assertEqual([], generate.merged)
+        self.assertEqual(['cat', 'dog'], generate.single)
+
+    def test_split_on_eta_and_noise(self):
+        generate, _ = self.run_jobs([RecordingJob('a', web_parameters('cat')),
+                                     RecordingJob('b', web_parameters('dog', ddim_eta=0.5)),
+                                     RecordingJob('c', web_parameters('cow', use_mps_noise=True))])
+        self.assertEqual([], generate.merged)
+        self.assertEqual(['cat', 'dog', 'cow'], generate.single)
+
+    def test_step_callback_slices(self):
+        jobs = [RecordingJob('a', web_parameters('cat', iterations=2)),
+                RecordingJob('b', web_parameters('dog', iterations=1))]
+        self.run_jobs(jobs)
+        self.assertEqual([([('cat', 0), ('cat', 1)], 0), ([('cat', 0), ('cat', 1)], 1)], jobs[0].steps)
+        self.assertEqual([([('dog', 0)], 0), ([('dog', 0)], 1)], jobs[1].steps)
+
+    def test_cancel_reaches_the_right_client(self):
+        jobs = [RecordingJob('a', web_parameters('cat')), RecordingJob('b', web_parameters('dog'))]
+        scheduler = None
+
+        def cancel_a():
+            scheduler.cancel('a')
+
+        generate = FakeGenerate(on_step=cancel_a)
+        socketio = FakeSocketIO()
+        scheduler = GenerationScheduler(generate, socketio, max_batch_size=4)
+        scheduler.queue.extend(jobs)
+        scheduler.run()
+
+        self.assertEqual([('processingCanceled', 'a')], socketio.emitted)
+        self.assertEqual(1, len(jobs[0].steps))
+        self.assertEqual([], jobs[0].images)
+        self.assertEqual(2, len(jobs[1].steps))
+        self.assertEqual(['dog-0'], jobs[1].images)
+
+    def test_run_stops_when_every_job_is_canceled(self):
+        jobs = [RecordingJob('a', web_parameters('cat')), RecordingJob('b', web_parameters('dog'))]
+        scheduler = None
+
+        def cancel_all():
+            scheduler.cancel('a')
+            scheduler.cancel('b')
+
+        generate = FakeGenerate(on_step=cancel_all)
+        socketio = FakeSocketIO()
+        scheduler = GenerationScheduler(generate, socketio, max_batch_size=4)
+        scheduler.queue.extend(jobs)
+        scheduler.run()
+
+        self.assertEqual([('processingCanceled', 'a'), ('processingCanceled', 'b')], socketio.emitted)
+        self.assertEqual([[], []], [job.images for job in jobs])
+        self.assertEqual([], generate.single)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import time
+import unittest
+from types import SimpleNamespace
+
+try:
+    import torch
+    from ldm.invoke.generator.base import Generator
+    from ldm.modules.diffusionmodules.util import seeded_noise, seeded_randn
+except ImportError:    # the generators need the full torch install
+    torch = None
+    Generator = object
+
+
+class StubGenerator(Generator):
+    '''
+    Samples by calling the step callback until the images of the previous
+    batches have come out of the safety check, or a second has gone by, and
+    records how many images had been delivered when each sample finished.
+    '''
+    def __init__(self, fail_on=None):
+        super().__init__(SimpleNamespace(channels=4, device=torch.device('cpu')), 'float32')
+        self.delivered = []
+        self.delivered_when_sampled = []
+        self.fail_on = fail_on
+
+    def get_make_image(self, prompt, step_callback=None, **kwargs):
+        def make_image(x_T):
+            sampled = len(self.delivered_when_sampled)
+            if sampled == self.fail_on:
+                raise RuntimeError('out of memory')
+            for step in range(100):
+                step_callback(x_T, step)
+                if len(self.delivered) >= sampled:
+                    break
+                time.sleep(0.01)
+            self.delivered_when_sampled.append(len(self.delivered))
+            return f'image {sampled}'
+        return make_image
+
+    def get_noise(self, width, height):
+        return torch.zeros(1, 4, height // 8, width // 8)
+
+    def safety_check_images(self, images):
+        return images
+
+    def image_callback(self, image, seed, first_seed=None):
+        self.delivered.append(image)
+
+
+class NoiseRecordingGenerator(Generator):
+    '''
+    Records, per image, the initial noise and the noise the sampler draws
+    over two steps. Returns an image, or a list of them for a batch.
+    '''
+    supports_batching = True
+
+    def __init__(self):
+        super().__init__(SimpleNamespace(channels=4, device=torch.device('cpu')), 'float32')
+        self.noise = []
+
+    def get_make_image(self, prompt, **kwargs):
+        def make_image(x_T):
+            steps = [seeded_randn(x_T.shape, x_T.device) for _ in range(2)]
+            for row in range(x_T.shape[0]):
+                self.noise.append([x_T[row]] + [step[row] for step in steps])
+            images = [f'image {len(self.noise) - x_T.shape[0] + row}' for row in range(x_T.shape[0])]
+            return images[0] if len(images) == 1 else images
+        return make_image
+
+    def get_noise(self, width, height):
+        return torch.randn(1, 4, height // 8, width // 8, generator=self.rng('cpu'))
+
+
+@unittest.skipIf(torch is None, 'torch is not installed')
+class SeededNoiseTestCase(unittest.TestCase):
+
+    def test_batched_rows_match_single_draws(self):
+        shape = (2, 4, 8, 8)
+        with seeded_noise([torch.Generator().manual_seed(seed) for seed in (1, 2)]):
+            batched = [seeded_randn(shape, 'cpu') for _ in range(2)]
+        for row, seed in enumerate((1, 2)):
+            with seeded_noise([torch.Generator().manual_seed(seed)]):
+                single = [seeded_randn((1, *shape[1:]), 'cpu') for _ in range(2)]
+            for step in range(2):
+                self.assertTrue(torch.equal(single[step][0], batched[step][row]))
+
+    def test_batch_size_must_match_generators(self):
+        with seeded_noise([torch.Generator().manual_seed(1)]):
+            with self.assertRaises(AssertionError):
+                seeded_randn((2, 4, 8, 8), 'cpu')
+
+    def test_generate_batched_matches_single(self):
+        sampler = SimpleNamespace(can_seed_noise=lambda: True)
+        runs = []
+        for batch_size in (1, 3):
+            generator = NoiseRecordingGenerator()
+            results = generator.generate(None, None, 64, 64, sampler, iterations=3, seed=42,
+                                         batch_size=batch_size, ddim_eta=0.5)
+            runs.append(([seed for _, seed in results], generator.noise))
+        (single_seeds, single_noise), (batched_seeds, batched_noise) = runs
+        self.assertEqual(single_seeds, batched_seeds)
+        for single, batched in zip(single_noise, batched_noise):
+            for a, b in zip(single, batched):
+                self.assertTrue(torch.equal(a, b))
+
+
+@unittest.skipIf(torch is None, 'torch is not installed')
+class SafetyCheckDeliveryTestCase(unittest.TestCase):
+
+    def generate(self, generator, iterations):
+        return generator.generate(None, None, 64, 64, None, iterations=iterations, seed=42,
+                                  image_callback=generator.image_callback,
+                                  safety_checker={'checker': None, 'extractor': None})
+
+    def test_checked_images_arrive_while_the_next_batch_samples(self):
+        generator = StubGenerator()
+        results = self.generate(generator, 3)
+        self.assertEqual([0, 1, 2], generator.delivered_when_sampled)
+        self.assertEqual(['image 0', 'image 1', 'image 2'], generator.delivered)
+        self.assertEqual(generator.delivered, [image for image, _ in results])
+
+    def test_checked_images_survive_a_failed_batch(self):
+        generator = StubGenerator(fail_on=1)
+        with self.assertRaises(RuntimeError):
+            self.generate(generator, 3)
+        self.assertEqual(['image 0'], generator.delivered)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,7 @@ import unittest
 import pyparsing
 
 from ldm.invoke.prompt_parser import PromptParser, Blend, Conjunction, FlattenedPrompt, CrossAttentionControlSubstitute, \
-    Fragment
+    Fragment, build_parser_syntax
 
 
 def parse_prompt(prompt_string):
@@ -495,5 +495,58 @@ class PromptParserTestCase(unittest.TestCase):
         pass
 
 
+class PromptParserCacheTestCase(unittest.TestCase):
+
+    prompts = [
+        "fire flames",
+        "(flames)0.5 fire++ (smoke)--",
+        "a man (riding a horse)+ (in a (dark forest)++)-",
+        "mountain (man).swap(monkey)",
+        "(\"fire\", \"flames\").blend(0.7, 0.3)",
+        "(\"mountain man\", \"a person with a hat (riding a bicycle.swap(skateboard))++\").and(0.5, 0.5)",
+    ]
+
+    def setUp(self):
+        self.parse_cache_size = PromptParser.parse_cache_size
+        PromptParser.parse_cache.clear()
+
+    def tearDown(self):
+        PromptParser.parse_cache_size = self.parse_cache_size
+        PromptParser.parse_cache.clear()
+
+    def parse_uncached(self, prompt_string):
+        # a freshly built grammar, no parse cache and no packrat memoizing
+        PromptParser.parse_cache_size = 0
+        pyparsing.ParserElement.disable_memoization()
+        try:
+            pp = PromptParser()
+            pp.conjunction, pp.prompt = build_parser_syntax.__wrapped__(1.1, 0.9)
+            return pp.parse_conjunction(prompt_string)
+        finally:
+            pyparsing.ParserElement.enable_packrat()
+            PromptParser.parse_cache_size = self.parse_cache_size
+
+    def test_cached_matches_uncached(self):
+        for prompt_string in self.prompts:
+            expected = self.parse_uncached(prompt_string)
+            self.assertEqual(expected, parse_prompt(prompt_string))
+            # the second parse comes from the parse cache
+            self.assertIn(((1.1, 0.9), prompt_string), PromptParser.parse_cache)
+            self.assertEqual(expected, parse_prompt(prompt_string))
+
+    def test_cached_results_are_copies(self):
+        prompt_string = "fire (flames)0.5"
+        first = parse_prompt(prompt_string)
+        first.prompts[0].children.clear()
+        self.assertEqual(self.parse_uncached(prompt_string), parse_prompt(prompt_string))
+
+    def test_attention_bases_are_kept_apart(self):
+        prompt_string = "fire+ flames-"
+        self.assertEqual(make_weighted_conjunction([('fire', 1.1), ('flames', 0.9)]),
+                         PromptParser().parse_conjunction(prompt_string))
+        self.assertEqual(make_weighted_conjunction([('fire', 1.2), ('flames', 0.8)]),
+                         PromptParser(attention_plus_base=1.2, attention_minus_base=0.8).parse_conjunction(prompt_string))
+
+
 if __name__ == '__main__':
     unittest.main()